@@ -0,0 +1,122 @@
+# -*- coding: utf-8 -*-
+
+#  Tests of TcpTransport against a simulated Ethernet-RS485 gateway (pm_sim.SocketServer) on a local port. Run from
+#  the repository folder with:
+#      python -m unittest discover tests
+
+import os
+import socket
+import sys
+import time
+import unittest
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), "..", "thermiser.indigoPlugin",
+                                "Contents", "Server Plugin"))
+
+import pm_transport
+from pm_bus import Bus
+from pm_sim import SimulatedBus, SocketServer, make_thermostats
+from pm_transport import TcpTransport
+from pymiser import PyMiser
+
+RECONNECT_DELAY = 0.2  # shortened reconnect delay, so that the tests don't wait 5 s for each reconnect
+
+
+class _Owner(object):
+    """Minimal owner of a PyMiser or Bus, which collects the error log."""
+    detailed_debug = False
+    poll_interval = 60
+
+    def __init__(self, comm_port=None):
+        self.comm_port = comm_port
+        self.errors = []
+
+    def debugLog(self, msg):
+        pass
+
+    detailDebugLog = debugLog
+
+    def errorLog(self, msg):
+        self.errors.append(msg)
+
+
+def _free_port():
+    """Returns a local TCP port that nothing listens on."""
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.bind(("127.0.0.1", 0))
+    port = sock.getsockname()[1]
+    sock.close()
+    return port
+
+
+class TcpTransportTest(unittest.TestCase):
+
+    def setUp(self):
+        self.reconnect_delay = pm_transport.RECONNECT_DELAY
+        pm_transport.RECONNECT_DELAY = RECONNECT_DELAY
+        self.bus = SimulatedBus(make_thermostats(2, models=("PRT", "PRT-HW")))
+        self.servers = []
+
+    def tearDown(self):
+        pm_transport.RECONNECT_DELAY = self.reconnect_delay
+        for server in self.servers:
+            server.stop()
+
+    def _serve(self, port=0):
+        server = SocketServer(self.bus, port=port).start()
+        self.servers.append(server)
+        return server
+
+    def _read_after_reconnect(self, communicator, address):
+        """Reads the DCB of address once the reconnect delay has passed."""
+        time.sleep(RECONNECT_DELAY * 1.5)
+        return communicator.read_device_info(address)
+
+    def test_transactions(self):
+        server = self._serve()
+        transport = TcpTransport.from_url(server.url)
+        self.assertTrue(transport.open())
+        communicator = PyMiser(_Owner(transport))
+        for address in (1, 2):
+            record = communicator.read_device_info(address)
+            self.assertIsNotNone(record)
+            self.assertEqual(record.address, address)
+        self.assertIsNone(communicator.read_device_info(3))  # no thermostat at 3: the read times out
+        self.assertIsNotNone(communicator.read_device_info(1))
+        self.assertEqual(transport.connects, 1)
+        transport.close()
+
+    def test_initial_connect_failure(self):
+        port = _free_port()
+        owner = _Owner()
+        bus = Bus(owner, "1", "Bus 1", TcpTransport("127.0.0.1", port))
+        # the gateway can't be reached: the bus is open, but transactions fail until it can be:
+        self.assertTrue(bus.open())
+        self.assertTrue(bus.comm_port_open)
+        self.assertTrue(any("Unable to connect" in error for error in owner.errors))
+        self.assertIsNone(bus.communicator.read_device_info(1))
+        self._serve(port)
+        self.assertIsNotNone(self._read_after_reconnect(bus.communicator, 1))
+        self.assertEqual(bus.comm_port.connects, 1)
+        bus.close()
+
+    def test_connection_drop(self):
+        server = self._serve()
+        port = server.port
+        transport = TcpTransport.from_url(server.url)
+        self.assertTrue(transport.open())
+        communicator = PyMiser(_Owner(transport))
+        self.assertIsNotNone(communicator.read_device_info(1))
+        # the gateway goes away in the middle of the session, and comes back on the same port:
+        server.stop()
+        self.servers.remove(server)
+        self.assertIsNone(communicator.read_device_info(2))
+        self.assertIsNone(communicator.read_device_info(2))
+        self._serve(port)
+        self.assertIsNotNone(self._read_after_reconnect(communicator, 2))
+        self.assertEqual(transport.connects, 2)
+        transport.close()
+
+
+if __name__ == "__main__":
+    unittest.main()
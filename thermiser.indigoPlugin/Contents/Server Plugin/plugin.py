@@ -30,29 +30,58 @@
 # version 1.0.0
 # last modified 17 jun 2020
 
-import serial
+import io
+import json
+import os
+import threading
 import time
-from Queue import *
+from pm_breaker import *
+from pm_bus import *
+from pm_history import *
+from pm_queue import *
+from pm_schedule import *
 from pymiser import *
 
 # default name for discovered devices, followed by suffix, e.g. "Thermostat 1"
 DEFAULT_DEVICE_NAME = "Thermostat"
+# a poll is answered from the DCB cache if the device was read less than this many seconds ago
+POLL_MAX_CACHE_AGE = 10
+# key under which the last state image sent to the server is remembered alongside the device states
+STATE_IMAGE_KEY = "_stateImage"
+# clocks that are off by less than this many seconds are left alone by clock sync
+CLOCK_DRIFT_THRESHOLD = 30
+# bus addresses scanned by discovery
+DISCOVERY_ADDRESSES = range(1, 33)
+# thermostat model of each device type, until the model is read from the device itself
+DEVICE_TYPE_MODELS = {"PRT-N": "PRT", "PRT-HWN": "PRT-HW"}
+# device type of thermostats that control hot water
+HOT_WATER_DEVICE_TYPE = "PRT-HWN"
+# folder for the bus statistics variables, and the prefix of their names (followed by the bus id):
+STATISTICS_VARIABLE_FOLDER = "Thermiser"
+STATISTICS_VARIABLE_PREFIX = "thermiser_bus"
+# number of days of temperature history written by Export Temperature History
+HISTORY_EXPORT_DAYS = 7
 
 class Plugin(indigo.PluginBase):
 
     def __init__(self, pluginId, pluginDisplayName, pluginVersion, pluginPrefs):
         super(Plugin, self).__init__(pluginId, pluginDisplayName, pluginVersion, pluginPrefs)
-        self.comm_port = serial.Serial()
-        self.comm_port_open = False
-
-        self.q = Queue()
-        self.communicator = PyMiser(self)
         self.debug = pluginPrefs.get("showDebugInfo", False)
         self.detailed_debug = pluginPrefs.get("showDetailDebugInfo", False)
-        self.last_poll_time = 0
-        self.last_clock_sync_time = 0
-        self.poll_interval = int(pluginPrefs.get('pollInterval'), 5) * 60
+        # base poll interval; each device is polled more or less often depending on its state (see pm_poll):
+        self.poll_interval = int(pluginPrefs.get('pollInterval', 5)) * 60
         self.clock_sync_interval = int(pluginPrefs.get('clockSyncInterval', 2400)) * 60
+        self.buses = self._createBuses(pluginPrefs)  # bus id -> Bus
+        self.last_clock_sync_time = 0
+        self.sent_states = dict()  # device id -> {state key: last value sent to the server}
+        self.state_lock = threading.Lock()  # states are updated from the scheduler threads of all buses
+        self.ipc_calls = 0
+        self.ipc_calls_saved = 0
+        self.last_state_report_time = time.time()
+        self.publish_statistics = pluginPrefs.get("publishStatistics", False)
+        self.last_statistics_time = 0
+        self.statistics_busy_time = dict()  # bus id -> (time, bus busy time) when variables were last published
+        self.record_history = pluginPrefs.get("recordHistory", True)
 
     def __generateUniqueName(self):
         """Generates a unique name based on DEFAULT_DEVICE_NAME and a trailing number."""
@@ -71,10 +100,18 @@ class Plugin(indigo.PluginBase):
 
     def startup(self):
         self.debugLog(u"startup called")
-        self.comm_port_open = self.openCommPort()
+        for bus in self.buses.values():
+            if self.record_history:
+                self._openHistory(bus)
+            bus.open()
+            bus.start()
 
     def shutdown(self):
         self.debugLog(u"shutdown called")
+        for bus in self.buses.values():
+            bus.stop()
+            bus.close()
+            self._closeHistory(bus)
 
     def detailDebugLog(self, msg):
         if self.detailed_debug:
@@ -83,8 +120,10 @@ class Plugin(indigo.PluginBase):
     def validatePrefsConfigUi(self, valuesDict):
         # Validate the plugin configuration
         errorsDict = indigo.Dict()
-        # use indigo-provided serial port validation:
-        self.validateSerialPortUi(valuesDict, errorsDict, u"devicePortFieldId")
+        # use indigo-provided serial port validation for each bus that is used:
+        for bus_id in bus_ids():
+            if bus_id == DEFAULT_BUS_ID or valuesDict.get("bus%sEnabled" % bus_id, False):
+                self.validateSerialPortUi(valuesDict, errorsDict, bus_port_field(bus_id))
 
         # check clock sync interval
         if not unicode.isdigit(valuesDict["clockSyncInterval"]):
@@ -112,12 +151,23 @@ class Plugin(indigo.PluginBase):
             self.detailed_debug = False
             valuesDict["showDetailDebugInfo"] = False
 
+        self.publish_statistics = valuesDict.get("publishStatistics", False)
+
+        self.record_history = valuesDict.get("recordHistory", True)
+        for bus in self.buses.values():
+            if self.record_history and bus.history is None:
+                self._openHistory(bus)
+            elif not self.record_history:
+                self._closeHistory(bus)
+
         try:
             self.poll_interval = int(valuesDict['pollInterval']) * 60
         except Exception as e:
             self.debugLog("Error: cannot read poll interval from preferences - defaulting to 5 minutes.")
             self.debugLog(e)
             self.poll_interval = 300
+        for bus in self.buses.values():
+            bus.poll_scheduler.base_interval = self.poll_interval
 
         try:
             self.clock_sync_interval = int(valuesDict['clockSyncInterval']) * 60
@@ -126,60 +176,138 @@ class Plugin(indigo.PluginBase):
             self.debugLog(e)
             self.clock_sync_interval = 86400
 
-    def openCommPort(self):
-
-        if self.pluginPrefs["devicePortFieldId_serialConnType"] != "local":
-            self.debugLog("Warning: only local serial ports have been tested.")
-
-        self.comm_port.port = self.pluginPrefs['devicePortFieldId_serialPortLocal']
-        self.comm_port.baudrate = 4800
-        self.comm_port.bytesize = serial.EIGHTBITS
-        self.comm_port.parity = serial.PARITY_NONE
-        self.comm_port.stopbits = serial.STOPBITS_ONE
-        self.comm_port.timeout = 1
-
-        try:
-            self.comm_port.open()
-            self.debugLog(u"Opened COMM port: %s" % self.comm_port.port)
-            return True
-        except Exception as e:
-            self.errorLog(u"Unable to open COMM port: %s" % self.comm_port.port)
-            self.errorLog(e)
-            return False
+        configured = dict((bus_id, (bus.name, bus.port_name)) for bus_id, bus in self._createBuses(valuesDict).items())
+        if configured != dict((bus_id, (bus.name, bus.port_name)) for bus_id, bus in self.buses.items()):
+            indigo.server.log(u"Bus settings changed - restart the plugin to apply them")
+
+    def _createBuses(self, prefs):
+        """Returns a dictionary with a Bus for each bus enabled in the plugin preferences. The first bus is
+        always enabled."""
+        buses = dict()
+        for bus_id in bus_ids():
+            if bus_id != DEFAULT_BUS_ID and not prefs.get("bus%sEnabled" % bus_id, False):
+                continue
+            name = prefs.get("bus%sName" % bus_id, "") or u"Bus %s" % bus_id
+            try:
+                transport = transport_for_prefs(prefs, bus_port_field(bus_id))
+            except Exception as e:
+                self.errorLog(u"Invalid port settings for %s" % name)
+                self.errorLog(e)
+                continue
+            buses[bus_id] = Bus(self, bus_id, name, transport)
+        return buses
+
+    def _busForDevice(self, device):
+        """Returns the Bus that device is connected to, or None if its bus is not enabled."""
+        return self.buses.get(device.pluginProps.get("bus", DEFAULT_BUS_ID) or DEFAULT_BUS_ID)
+
+    def busList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        """Dynamic list of the enabled buses for the device configuration dialog."""
+        return [(bus_id, self.buses[bus_id].name) for bus_id in sorted(self.buses)]
 
     def deviceStartComm(self, device):
         self.debugLog("Starting comms for: " + device.name)
         device.stateListOrDisplayStateIdChanged()
+        # states may have been changed while we weren't looking, so send everything on the first poll:
+        self.sent_states.pop(device.id, None)
+
+        bus = self._busForDevice(device)
+        if bus is None:
+            self.errorLog(u"Device %s is connected to bus %s, which is not enabled in the plugin configuration"
+                          % (device.name, device.pluginProps.get("bus")))
+            return
+
+        found, address = self._addressFromProps(device)
+        if found:
+            previous = bus.registry.add(device, address, DEVICE_TYPE_MODELS.get(device.deviceTypeId))
+            if previous is not None and previous.device_id != device.id:
+                self.errorLog(u"Devices %s and %s are both configured with address %d on %s - only %s will be polled"
+                              % (previous.device.name, device.name, address, bus.name, device.name))
         return
 
     def deviceStopComm(self, device):
         self.debugLog("Stopping comms for: " + device.name)
+        self.sent_states.pop(device.id, None)
+        # the device may have been moved to another bus, so look for it on all of them:
+        for bus in self.buses.values():
+            bus.registry.remove(device.id)
+
+    def deviceUpdated(self, origDev, newDev):
+        # keep the registered device object current, e.g. after a rename:
+        super(Plugin, self).deviceUpdated(origDev, newDev)
+        if newDev.pluginId == self.pluginId:
+            for bus in self.buses.values():
+                bus.registry.update_device(newDev)
+
+    def didDeviceCommPropertyChange(self, origDev, newDev):
+        # only a change of address or bus requires comms to be restarted (which re-registers the device):
+        return origDev.pluginProps.get("address") != newDev.pluginProps.get("address") or \
+            origDev.pluginProps.get("bus") != newDev.pluginProps.get("bus")
+
+    def _updateStates(self, device, states, image=None):
+        """Sends the states in states (a list of (key, value) tuples) that changed since they were last sent for
+        this device to the server in a single updateStatesOnServer call. The state image is only sent if it
+        changed as well."""
+        with self.state_lock:
+            sent = self.sent_states.setdefault(device.id, dict())
+            changed = []
+            for key, value in states:
+                if key not in sent or sent[key] != value:
+                    sent[key] = value
+                    changed.append({'key': key, 'value': value})
+            send_image = image is not None and sent.get(STATE_IMAGE_KEY) != image
+            if send_image:
+                sent[STATE_IMAGE_KEY] = image
+            calls = (1 if changed else 0) + (1 if send_image else 0)
+            self.ipc_calls = self.ipc_calls + calls
+            # compared to one call per state:
+            self.ipc_calls_saved = self.ipc_calls_saved + len(states) + (1 if image is not None else 0) - calls
+
+        if changed:
+            device.updateStatesOnServer(changed)
+        if send_image:
+            device.updateStateImageOnServer(image)
 
     def runConcurrentThread(self):
+        """Runs the poll and clock sync timers. The jobs they queue are run by the scheduler thread of each bus."""
         try:
             while True:
-                self.sleep(1)
                 now = time.time()
 
-                if not self.q.empty():
-                    # run the next job in the queue:
-                    job = self.q.get()
-                    if job:
-                        f = job[0]
-                        args = job[1]
-                        f(*args)
+                self._pollDueDevices()
 
-                if (now - self.last_poll_time) > self.poll_interval:
-                    self.last_poll_time = now
-                    self.pollAllDevices()
-
-                if (now - self.last_clock_sync_time) > self.clock_sync_interval:
+                if (now - self.last_clock_sync_time) >= self.clock_sync_interval:
                     self.last_clock_sync_time = now
                     self.syncAllDeviceClocks()
 
+                self._reportStateUpdates()
+                if self.publish_statistics and now - self.last_statistics_time >= THROUGHPUT_REPORT_INTERVAL:
+                    self.last_statistics_time = now
+                    self._publishStatistics()
+
+                # polls are checked every SCHEDULER_IDLE_TIMEOUT seconds:
+                next_timer = self.last_clock_sync_time + self.clock_sync_interval
+                self.sleep(max(0, min(next_timer - now, SCHEDULER_IDLE_TIMEOUT)))
+
         except self.StopThread:
             self.debugLog("Thermiser main thread stopping ")
+            for bus in self.buses.values():
+                bus.stop()
+
+    def _reportStateUpdates(self):
+        """Logs the number of state update calls to the server once every THROUGHPUT_REPORT_INTERVAL seconds.
+        Each bus reports its own job throughput."""
+        now = time.time()
+        if now - self.last_state_report_time < THROUGHPUT_REPORT_INTERVAL:
+            return
 
+        with self.state_lock:
+            if self.ipc_calls > 0 or self.ipc_calls_saved > 0:
+                self.debugLog(u"Indigo server: %d state update calls, %d calls saved by batching and change detection"
+                              % (self.ipc_calls, self.ipc_calls_saved))
+            self.ipc_calls = 0
+            self.ipc_calls_saved = 0
+        self.last_state_report_time = now
 
     def validateDeviceConfigUi(self, valuesDict, typeId, devId):
         """ Gets called when the settings for an individual thermostat are validated"""
@@ -195,152 +323,291 @@ class Plugin(indigo.PluginBase):
         except Exception as e:
             errorsDict["address"] = "Address must be a positive integer between 1 and 32."
 
+        if valuesDict.get("bus", DEFAULT_BUS_ID) not in self.buses:
+            errorsDict["bus"] = "Select a bus that is enabled in the plugin configuration."
+
         if len(errorsDict) > 0:
             return False, valuesDict, errorsDict
         return True, valuesDict
 
     def validateActionConfigUi(self, valuesDict, typeId, devId):
         self.debugLog(u"validateActionConfigUi for type: " + typeId)
+        errorsDict = indigo.Dict()
+        if typeId in ("setGroupRoomTemp", "setGroupHotWater", "uploadGroupSchedule"):
+            if valuesDict.get("groupType", "devices") == "devices" and not valuesDict.get("devices"):
+                errorsDict["devices"] = "Select at least one thermostat."
+        if typeId == "uploadGroupSchedule" and "%%" not in valuesDict.get("schedule", ""):
+            try:
+                parse_schedule(valuesDict.get("schedule", ""), MIN_TEMP_C, MAX_TEMP_C)
+            except ValueError as error:
+                errorsDict["schedule"] = u"Invalid schedule: %s" % error
+
+        if len(errorsDict) > 0:
+            return False, valuesDict, errorsDict
         return True, valuesDict
 
+    def thermostatList(self, filter="", valuesDict=None, typeId="", targetId=0):
+        """Dynamic list of the thermostats for group actions; with filter "hotWater" only those that control
+        hot water."""
+        return [(str(dev.id), dev.name) for dev in indigo.devices.iter("self")
+                if filter != "hotWater" or dev.deviceTypeId == HOT_WATER_DEVICE_TYPE]
+
     def _addressFromProps(self, device):
         """Returns a tuple with a boolean that indicates the address was found and the actual address"""
         props = device.pluginProps
 
         if "address" not in props:
             self.errorLog("Device %s has no address property" % device.name)
-            return False
+            return False, None
         try:
             address = int(props['address'])
         except Exception as e:
             self.errorLog("Invalid address in device pluginProps for %s" % device.name)
             self.errorLog(e)
-            return False
+            return False, None
 
         return True, address
 
+    def _deviceAddress(self, bus, device):
+        """Returns the address of device from the registry of its bus, or from its plugin props if its comms
+        haven't been started. Returns None if the device has no valid address."""
+        entry = bus.registry.by_device_id(device.id)
+        if entry is not None:
+            return entry.address
+        found, address = self._addressFromProps(device)
+        return address
+
+    def _queueJob(self, device, function, args, priority, key, replace=False):
+        """Queues function(bus, *args) on the bus that device is connected to."""
+        bus = self._busForDevice(device)
+        if bus is None:
+            self.errorLog(u"Device %s is not connected to an enabled bus" % device.name)
+            return
+        bus.q.put((function, [bus] + list(args)), priority, key, replace=replace)
+
 
-    def pollAllDevices(self):
-        """Iterates through all devices owned by this plugin, and calls pollDevice for each device"""
-        self.detailDebugLog("Polling all devices...")
-        for device in indigo.devices.iter("self"):
-            self.pollDevice(device)
+    def _pollDueDevices(self):
+        """Queues a poll for each device whose poll interval has passed, within the poll budget of its bus."""
+        for bus in self.buses.values():
+            for address in bus.poll_scheduler.due(bus.registry.addresses()):
+                entry = bus.registry.by_address(address)
+                if entry is not None:
+                    bus.q.put((self._pollDevice, [bus, entry.device]), PRIORITY_POLL, ("poll", entry.device_id))
 
-    def pollDevice(self, device):
-        """ Queues a poll"""
+    def pollDevice(self, device, priority=PRIORITY_POLL, max_age=POLL_MAX_CACHE_AGE):
+        """ Queues a poll. A poll that must read the device (max_age 0) replaces a pending poll that might be
+        served from the cache."""
         self.detailDebugLog("Queueing poll for %s" % device.name)
-        self.q.put((self._pollDevice, [device]))
+        self._queueJob(device, self._pollDevice, [device, max_age], priority, ("poll", device.id),
+                       replace=max_age == 0)
 
-    def _pollDevice(self, device):
-        """ the worker function that polls a single device and updates its indigo states"""
+    def _pollDevice(self, bus, device, max_age=POLL_MAX_CACHE_AGE):
+        """ the worker function that polls a single device and updates its indigo states. A DCB cached less than
+        max_age seconds ago is used instead of reading the device."""
 
-        if not self.comm_port_open:
-            device.updateStateOnServer("status", u"(No COMMS)")
+        if not bus.comm_port_open:
+            self._updateStates(device, [(u"status", u"(No COMMS)")])
             return
 
 
         self.detailDebugLog("Executing poll for %s" % device.name)
 
-        found, address = self._addressFromProps(device)
-        if not found:
+        address = self._deviceAddress(bus, device)
+        if address is None:
             self.debugLog("No address configured for device %s." % device.name)
             return
 
-        device.updateStateOnServer("status", u"(polling)")
-
-        if not self.communicator.update_device_info(address):
-            self.debugLog("Device with address %d did not reply - re-queueing..." % address)
-            device.updateStateOnServer("status", u"(no reply)")
-            self.q.put((self._pollDevice, [device]))
+        if not bus.breaker.allow(address):
+            self.detailDebugLog("Skipping poll for %s: circuit open" % device.name)
             return
 
-        device.updateStateOnServer(u"airTemp", self.communicator.deviceInfo['airTemp'])
-        device.updateStateOnServer(u"setRoomTemp", self.communicator.deviceInfo['setRoomTemp'])
-        device.updateStateOnServer(u"heatingOn", self.communicator.deviceInfo['heatingOn'])
-        device.updateStateOnServer(u"temperatureFormat", self.communicator.deviceInfo['temperatureFormat'])
-        device.updateStateOnServer(u"rateOfChange", self.communicator.deviceInfo['rateOfChange'])
+        if bus.breaker.state(address) == BREAKER_HALF_OPEN:
+            self._updateStates(device, [(u"status", u"(probing)")])
 
-        # update thermostat icon to reflect heating state:
-        if self.communicator.deviceInfo['heatingOn']:
-            device.updateStateImageOnServer(indigo.kStateImageSel.HvacHeating)
+        start = time.time()
+        deviceInfo = bus.communicator.read_device_info(address, max_age)
+        if deviceInfo is None:
+            self._retryJob(bus, device, address, "poll", OP_POLL, (self._pollDevice, [bus, device, max_age]),
+                           PRIORITY_POLL, ("poll", device.id))
+            return
+        bus.breaker.record_success(address)
+        bus.registry.update_summary(address, deviceInfo)
+        record, read_time = bus.communicator.cache.peek(address)
+        # only a poll that read the bus says something about the bus time a poll takes, and a record served from
+        # the cache may have written values patched in that the thermostat hasn't reported yet:
+        if read_time >= start:
+            bus.poll_scheduler.polled(address, deviceInfo, time.time() - start)
+            if bus.history is not None:
+                bus.history.record(address, read_time, deviceInfo.airTempRaw, deviceInfo.setRoomTemp,
+                                   deviceInfo.heatingOn, deviceInfo.hotWaterOn)
         else:
-            device.updateStateImageOnServer(indigo.kStateImageSel.HvacOff)
+            bus.poll_scheduler.polled(address, deviceInfo)
+
+        states = [(u"airTemp", deviceInfo.airTemp),
+                  (u"setRoomTemp", deviceInfo.setRoomTemp),
+                  (u"heatingOn", deviceInfo.heatingOn),
+                  (u"temperatureFormat", deviceInfo.temperatureFormat),
+                  (u"rateOfChange", deviceInfo.rateOfChange)]
 
-        if 'hotWaterOn' in self.communicator.deviceInfo:
-            device.updateStateOnServer(u"hotWaterOn", self.communicator.deviceInfo['hotWaterOn'])
+        if deviceInfo.hotWaterOn is not None:
+            states.append((u"hotWaterOn", deviceInfo.hotWaterOn))
 
         # show temperature in state column:
-        if self.communicator.deviceInfo['temperatureFormat'] == 'C':
-            device.updateStateOnServer("status", u"%d ℃" % self.communicator.deviceInfo['airTemp'])
-        elif self.communicator.deviceInfo['temperatureFormat'] == 'F':
-            device.updateStateOnServer("status", u"%d ℉" % self.communicator.deviceInfo['airTemp'])
+        if deviceInfo.airTemp is None:
+            states.append((u"status", u"(no air sensor)"))
+        elif deviceInfo.temperatureFormat == 'C':
+            states.append((u"status", u"%d ℃" % deviceInfo.airTemp))
+        elif deviceInfo.temperatureFormat == 'F':
+            states.append((u"status", u"%d ℉" % deviceInfo.airTemp))
+
+        # update thermostat icon to reflect heating state:
+        if deviceInfo.heatingOn:
+            image = indigo.kStateImageSel.HvacHeating
+        else:
+            image = indigo.kStateImageSel.HvacOff
+
+        # one call to the server, with only the states that changed since the last poll:
+        self._updateStates(device, states, image)
 
     def syncAllDeviceClocks(self):
-        """Iterates through all devices owned by this plugin, and calls syncDeviceClock for each device"""
+        """Iterates through all devices on all buses, and queues a clock sync for each device"""
         self.detailDebugLog("Synchronizing all device clocks...")
-        for device in indigo.devices.iter("self"):
-            self.syncDeviceClock(device)
+        for bus in self.buses.values():
+            entries = bus.registry.entries()
+            # the drift of all clocks is logged once the last one has been checked:
+            bus.clock_sync_pending = set(entry.address for entry in entries)
+            bus.clock_drifts = []
+            bus.clocks_synced = 0
+            for entry in entries:
+                bus.q.put((self._syncDeviceClock, [bus, entry.device]), PRIORITY_CLOCK_SYNC,
+                          ("clockSync", entry.device_id))
 
     def syncDeviceClock(self, device):
         """Queues a clock sync for the specified device."""
         self.detailDebugLog("Queueing clock sync for %s" % device.name)
-        self.q.put( (self._syncDeviceClock, [device]) )
+        self._queueJob(device, self._syncDeviceClock, [device], PRIORITY_CLOCK_SYNC, ("clockSync", device.id))
 
-    def _syncDeviceClock(self, device):
-        """Worker function that carries out a clock sync. """
+    def _syncDeviceClock(self, bus, device):
+        """Worker function that carries out a clock sync, if the clock of the device is more than
+        CLOCK_DRIFT_THRESHOLD seconds off."""
         self.detailDebugLog("Executing clock sync for %s" % device.name)
-        found, address = self._addressFromProps(device)
-        if not found:
+        address = self._deviceAddress(bus, device)
+        if address is None:
             return
 
-        if not "setRoomTemp" in device.states:
-            self.errorLog("_syncDeviceClock: Device %s has no setRoomTemp state" % device.name)
-            return False
+        if not bus.breaker.allow(address):
+            self.detailDebugLog("Skipping clock sync for %s: circuit open" % device.name)
+            self._clockChecked(bus, address)
+            return
 
-        try:
-            if device.states.get("temperatureFormat", "") == "F":
-                temperatureUnit = TEMP_UNIT_FAHRENHEIT
-                currentRoomSetTemp = int(device.states.get('setRoomTemp', self.communicator.fahrenheit(20)))
-            else:
-                temperatureUnit = TEMP_UNIT_CELSIUS
-                currentRoomSetTemp = int(device.states.get('setRoomTemp', 20))
+        # the clock is compared with the last poll, and the set temperature is re-sent after the clock sync;
+        # both are taken from the DCB cache if it is fresh:
+        deviceInfo = bus.communicator.read_device_info(address, None, ("setRoomTemp",) + CLOCK_FIELD_NAMES)
+        if deviceInfo is None:
+            self._clockChecked(bus, address)
+            self._retryJob(bus, device, address, "clock sync", OP_CLOCK_SYNC,
+                           (self._syncDeviceClock, [bus, device]), PRIORITY_CLOCK_SYNC, ("clockSync", device.id))
+            return
+        # the device answered (or was polled recently), which closes a half open circuit even if no sync follows:
+        bus.breaker.record_success(address)
 
-        except Exception as e:
-            self.errorLog("Invalid setRoomTemp in device states for %s. Defaulting to %d" % (device.name,currentRoomSetTemp))
-            self.errorLog(e)
+        drift = bus.communicator.clock_drift(address)
+        if drift is None:
+            self.detailDebugLog("Skipping clock sync for %s: %s has no clock" % (device.name, deviceInfo.model))
+            self._clockChecked(bus, address)
+            return
+        if abs(drift) < CLOCK_DRIFT_THRESHOLD:
+            self.detailDebugLog("Skipping clock sync for %s: clock is %+d s off" % (device.name, drift))
+            self._clockChecked(bus, address, drift)
+            return
+        bus.debugLog("Clock of %s is %+d s off - synchronizing" % (device.name, drift))
+
+        if deviceInfo.temperatureFormat == "F":
+            temperatureUnit = TEMP_UNIT_FAHRENHEIT
+        else:
+            temperatureUnit = TEMP_UNIT_CELSIUS
+        currentRoomSetTemp = deviceInfo.setRoomTemp
 
-        if not self.communicator.syncClock(address,currentRoomSetTemp, temperatureUnit):
-            self.debugLog("Device with address %d did not reply to clock sync request - re-queueing..." % address)
-            self.q.put((self._syncDeviceClock, [device]))
+        if not bus.communicator.syncClock(address,currentRoomSetTemp, temperatureUnit):
+            self._clockChecked(bus, address, drift)
+            self._retryJob(bus, device, address, "clock sync", OP_CLOCK_SYNC,
+                           (self._syncDeviceClock, [bus, device]), PRIORITY_CLOCK_SYNC, ("clockSync", device.id))
+            return
+        bus.breaker.record_success(address)
+        self._clockChecked(bus, address, drift, synced=True)
+
+    def _clockNeedsSync(self, bus, address):
+        """Returns True if the clock of the device at address was more than CLOCK_DRIFT_THRESHOLD seconds off when
+        it was last read, so that a write to an adjacent register can set the clock as well."""
+        drift = bus.communicator.clock_drift(address)
+        return drift is not None and abs(drift) >= CLOCK_DRIFT_THRESHOLD
+
+    def _clockChecked(self, bus, address, drift=None, synced=False):
+        """Records the clock drift of a device checked by the running clock sync round, and logs the drift of
+        all clocks on the bus once the round is done."""
+        if address not in bus.clock_sync_pending:
+            return
+        bus.clock_sync_pending.discard(address)
+        if drift is not None:
+            bus.clock_drifts.append(drift)
+        if synced:
+            bus.clocks_synced = bus.clocks_synced + 1
+        if bus.clock_sync_pending or not bus.clock_drifts:
             return
 
+        drifts = sorted(bus.clock_drifts)
+        offsets = sorted(abs(drift) for drift in drifts)
+        bus.debugLog(u"Clock sync: drift of %d clocks median %+d s, 90%% within %d s, largest %+d s; "
+                     u"%d clocks synchronized (threshold %d s)"
+                     % (len(drifts), drifts[len(drifts) // 2], offsets[(len(offsets) * 9 - 1) // 10],
+                        max(drifts, key=abs), bus.clocks_synced, CLOCK_DRIFT_THRESHOLD))
+
+    def _retryJob(self, bus, device, address, description, operation, job, priority, key):
+        """Records a failed transaction with address and re-queues job after a jittered exponential backoff delay.
+        Once the circuit for the address opens the job is dropped, and the device is only probed occasionally.
+        Retries are counted in the bus metrics under operation (one of the OP_ constants)."""
+        delay = bus.breaker.record_failure(address)
+        failures = bus.breaker.failures(address)
+        if delay is None:
+            bus.debugLog("Device with address %d did not reply to %s request (%d failures in a row) - circuit open, "
+                         "probing every %d s" % (address, description, failures, bus.breaker.probe_interval))
+            self._updateStates(device, [(u"status", u"(offline, breaker open)")])
+            return
 
-    def _indigoDeviceWithAddress(self, address):
-        """Returns the indigo device that matches address"""
-        for dev in indigo.devices.iter("self"):
-            props = dev.pluginProps
-            if "address" in props:
-                if props['address'] == address:
-                    return dev
-        return None
-
-    def _knownDeviceAddresses(self):
-        """Returns a list containing the addresses of all known devices"""
-        knownAddresses = []
+        bus.debugLog("Device with address %d did not reply to %s request - retrying in %.1f s..."
+                     % (address, description, delay))
+        bus.communicator.metrics.count(address, operation, COUNTER_RETRIES)
+        self._updateStates(device, [(u"status", u"(no reply, retry %d of %d)"
+                                     % (failures, bus.breaker.failure_threshold - 1))])
+        # don't replace a newer command queued in the meantime:
+        bus.q.put(job, priority, key, delay=delay)
+
+
+    def _indigoDeviceWithAddress(self, bus, address):
+        """Returns the indigo device that matches address on bus"""
+        entry = bus.registry.by_address(address)
+        if entry is None:
+            return None
+        return entry.device
+
+    def _knownDeviceAddresses(self, bus):
+        """Returns a set containing the addresses of all known devices on bus"""
+        knownAddresses = bus.registry.addresses()
+        # disabled devices are not registered, but we don't want discovery to create duplicates of them.
+        # Discovery is rare, so walking the device list here is fine:
         for dev in indigo.devices.iter("self"):
-            props = dev.pluginProps
-            if "address" in props:
+            if not dev.enabled and "address" in dev.pluginProps and self._busForDevice(dev) is bus:
                 try:
-                    knownAddresses.append(int(props["address"]))
+                    knownAddresses.add(int(dev.pluginProps["address"]))
                 except:
                     pass
         return knownAddresses
 
-    def _addNewDevice(self, deviceInfo):
+    def _addNewDevice(self, bus, deviceInfo):
         new_device = None
 
         try:
-            modelID = deviceInfo['modelID']
+            modelID = deviceInfo.modelID
 
         except Exception as e:
             self.errorLog("_addNewDevice: missing model ID in device info block.")
@@ -348,12 +615,12 @@ class Plugin(indigo.PluginBase):
             return
 
         if modelID == 2:
-            self.debugLog("Creating device for model: %s" % deviceInfo['model'])
+            self.debugLog("Creating device for model: %s" % deviceInfo.model)
             new_device = indigo.device.create(indigo.kProtocol.Plugin,
                                              self.__generateUniqueName(),
                                              None, deviceTypeId="PRT-N")
         elif modelID == 4:
-            self.debugLog("Creating device for model: %s" % deviceInfo['model'])
+            self.debugLog("Creating device for model: %s" % deviceInfo.model)
             new_device = indigo.device.create(indigo.kProtocol.Plugin,
                                              self.__generateUniqueName(),
                                              None, deviceTypeId="PRT-HWN")
@@ -363,8 +630,9 @@ class Plugin(indigo.PluginBase):
 
         if new_device is not None:
             props = new_device.pluginProps
-            props["address"] = str(deviceInfo['address'])
-            props["version"] = str(deviceInfo['softwareVersion'])
+            props["address"] = str(deviceInfo.address)
+            props["bus"] = bus.bus_id
+            props["version"] = str(deviceInfo.softwareVersion)
             new_device.replacePluginPropsOnServer(props)
 
     ########################################
@@ -372,22 +640,242 @@ class Plugin(indigo.PluginBase):
     ########################################
 
     def discoverDevices(self):
-        self.debugLog(u"Scanning RS485 bus to discover devices. This takes up to 35 seconds.")
-        known_addresses = self._knownDeviceAddresses()
-
-        for address in range(1, 33):
-            if address not in known_addresses:
-                self.q.put((self._discoverDevice, [address]))
+        """Scans the addresses for which no device has been configured yet, on all buses."""
+        for bus in self.buses.values():
+            known_addresses = self._knownDeviceAddresses(bus)
+            self._startDiscovery(bus, [address for address in DISCOVERY_ADDRESSES if address not in known_addresses],
+                                 known_addresses)
+
+    def discoverAllDevices(self):
+        """Scans all addresses on all buses, and also reports the devices that have been configured already."""
+        for bus in self.buses.values():
+            self._startDiscovery(bus, list(DISCOVERY_ADDRESSES), self._knownDeviceAddresses(bus))
+
+    def _startDiscovery(self, bus, addresses, known_addresses):
+        """Queues a quick probe of each of the addresses on bus. Addresses that answer are reported as soon as they
+        are found, and their full device info is only read (to create the device) once all probes are done.
+        Each bus runs its own scan, so the buses are scanned in parallel."""
+        if not bus.comm_port_open:
+            self.errorLog(u"Cannot discover devices on %s: COMM port is not open" % bus.name)
+            return
+        if bus.discovery_pending:
+            indigo.server.log(u"Discovery is already running on %s (%d addresses left to scan)"
+                              % (bus.name, len(bus.discovery_pending)))
+            return
+        if not addresses:
+            indigo.server.log(u"All addresses on %s have a device configured - nothing to scan" % bus.name)
+            return
 
-    def _discoverDevice(self, address):
-        self.detailDebugLog("Looking for device at address %s" % address)
+        indigo.server.log(u"Scanning %d addresses on %s for thermostats..." % (len(addresses), bus.name))
+        bus.discovery_pending = set(addresses)
+        bus.discovery_known = known_addresses
+        bus.discovery_found = []
+        bus.discovery_silent = 0
+        bus.discovery_invalid = []
+        bus.discovery_start_time = time.time()
+        for address in addresses:
+            bus.q.put((self._probeAddress, [bus, address]), PRIORITY_DISCOVERY, ("discover", address))
+
+    def _probeAddress(self, bus, address, timeout=PROBE_TIMEOUT):
+        """Worker function that probes a single address during discovery. An address that answers with an invalid
+        reply is probed once more, with the full reply timeout."""
+        probe_again = False
+        try:
+            model_id = bus.communicator.probe(address, timeout)
+            if model_id is None and bus.communicator.last_outcome == OUTCOME_TIMEOUT:
+                bus.discovery_silent = bus.discovery_silent + 1
+                bus.detailDebugLog(u"No device found at address %d" % address)
+            elif model_id is None and timeout < REPLY_TIMEOUT:
+                bus.debugLog(u"Invalid reply to the discovery probe of address %d - probing it again" % address)
+                bus.q.put((self._probeAddress, [bus, address, REPLY_TIMEOUT]), PRIORITY_DISCOVERY,
+                          ("discover", address))
+                probe_again = True
+            elif model_id is None:
+                bus.discovery_invalid.append(address)
+                bus.errorLog(u"Address %d answered the discovery probe twice, but not with a valid reply" % address)
+            else:
+                bus.discovery_found.append(address)
+                model = model_name(model_id)
+                if address in bus.discovery_known:
+                    device = self._indigoDeviceWithAddress(bus, address)
+                    indigo.server.log(u"Found %s at address %d on %s (configured as %s)"
+                                      % (model, address, bus.name,
+                                         device.name if device is not None else u"a disabled device"))
+                else:
+                    indigo.server.log(u"Found %s at address %d on %s - adding device" % (model, address, bus.name))
+                    # the full read goes to the back of the discovery queue, after the remaining probes:
+                    bus.q.put((self._discoverDevice, [bus, address]), PRIORITY_DISCOVERY, ("discoverRead", address))
+        finally:
+            if not probe_again:
+                bus.discovery_pending.discard(address)
+            if not bus.discovery_pending:
+                indigo.server.log(u"Scan of %s finished in %.1f s: %d devices found%s; %d addresses did not answer, "
+                                  u"%d answered with an invalid reply%s"
+                                  % (bus.name, time.time() - bus.discovery_start_time, len(bus.discovery_found),
+                                     u" at addresses " + u", ".join(str(a) for a in sorted(bus.discovery_found))
+                                     if bus.discovery_found else u"", bus.discovery_silent,
+                                     len(bus.discovery_invalid),
+                                     u" (addresses " + u", ".join(str(a) for a in sorted(bus.discovery_invalid)) + u")"
+                                     if bus.discovery_invalid else u""))
+
+    def _discoverDevice(self, bus, address):
+        bus.detailDebugLog("Reading device info for new device at address %s" % address)
+        if self._indigoDeviceWithAddress(bus, address) is not None:
+            return
         # ask communicator to try to get a device info block from the address:
-        if not self.communicator.update_device_info(address):
-            # no response from this address
-            self.debugLog(u"No device found at address %d" % address)
+        deviceInfo = bus.communicator.read_device_info(address, full_read=True)
+        if deviceInfo is None:
+            bus.errorLog(u"Device at address %d answered the discovery probe, but its device info could not be read"
+                         % address)
+        else:
+            bus.debugLog(u"New device found at address %d" % address)
+            self._addNewDevice(bus, deviceInfo)
+
+    def showBusStatistics(self):
+        """Logs the transaction metrics of each bus, and writes all metrics per address to the statistics file."""
+        statistics = dict()
+        for bus_id in sorted(self.buses):
+            bus = self.buses[bus_id]
+            statistics[bus_id] = bus.statistics()
+            indigo.server.log(u"%s (%s, %d devices):" % (bus.name, bus.port_name, len(bus.registry)))
+            for line in bus.communicator.metrics.report():
+                indigo.server.log(u"  %s" % line)
+            indigo.server.log(u"  frames: %s" % bus.communicator.decoder.report())
+            for line in bus.q.metrics_report():
+                indigo.server.log(u"  queue: %s" % line)
+
+        path = self._statisticsFilePath()
+        try:
+            with open(path, "w") as statistics_file:
+                json.dump({'time': time.time(), 'buses': statistics}, statistics_file, indent=2, sort_keys=True)
+            indigo.server.log(u"Bus statistics per address written to %s" % path)
+        except (IOError, OSError) as e:
+            self.errorLog(u"Unable to write bus statistics to %s" % path)
+            self.errorLog(e)
+
+    def _statisticsFilePath(self):
+        """Returns the path of the bus statistics file, next to the plugin preferences."""
+        return os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins",
+                            "%s.statistics.json" % self.pluginId)
+
+    def _historyFilePath(self, bus):
+        """Returns the path of the temperature history file of bus, next to the plugin preferences."""
+        return os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins",
+                            "%s.history.bus%s.dat" % (self.pluginId, bus.bus_id))
+
+    def _openHistory(self, bus):
+        """Opens (or creates) the temperature history file of bus, so that polls are recorded in it. The buses
+        share the history size, so a file created for another number of buses is converted first."""
+        path = self._historyFilePath(bus)
+        minutes = history_minutes(len(self.buses))
+        try:
+            history = TemperatureHistory(path, minutes=minutes)
+            if history.minutes != minutes:
+                bus.debugLog(u"Converting temperature history from %d to %d days per thermostat"
+                             % (history.minutes // 1440, minutes // 1440))
+                history = history.resized(minutes)
+            bus.history = history
+            bus.debugLog(u"Recording temperature history in %s" % path)
+        except (IOError, OSError, ValueError) as e:
+            bus.errorLog(u"Unable to open temperature history file %s" % path)
+            bus.errorLog(e)
+
+    def _closeHistory(self, bus):
+        if bus.history is not None:
+            bus.history.close()
+            bus.history = None
+
+    def _deviceHistory(self, device, start, end):
+        """Returns the recorded samples of device between start and end (seconds since the epoch), see
+        TemperatureHistory.query, or None if no history is recorded for it."""
+        bus = self._busForDevice(device)
+        if bus is None or bus.history is None:
+            return None
+        address = self._deviceAddress(bus, device)
+        if address is None:
+            return None
+        return bus.history.query(address, start, end)
+
+    def exportTemperatureHistory(self):
+        """Writes the temperature history of the last HISTORY_EXPORT_DAYS days of all thermostats to a CSV
+        file."""
+        if not self.record_history:
+            self.errorLog(u"Temperature history is not recorded - enable it in the plugin configuration")
+            return
+        end = time.time()
+        start = end - HISTORY_EXPORT_DAYS * 86400
+        path = os.path.join(indigo.server.getInstallFolderPath(), "Preferences", "Plugins",
+                            "%s.history.csv" % self.pluginId)
+        rows = 0
+        try:
+            with io.open(path, "w", encoding="utf-8") as history_file:
+                history_file.write(u"device,time,airTemp,setRoomTemp,heatingOn,hotWaterOn\n")
+                for device in indigo.devices.iter("self"):
+                    for sample_time, air_temp, set_temp, heating_on, hot_water_on in \
+                            self._deviceHistory(device, start, end) or []:
+                        history_file.write(u'"%s",%s,%s,%d,%d,%d\n'
+                                           % (device.name.replace(u'"', u'""'),
+                                              time.strftime("%Y-%m-%d %H:%M", time.localtime(sample_time)),
+                                              u"" if air_temp is None else u"%.1f" % air_temp, set_temp,
+                                              heating_on, hot_water_on))
+                        rows = rows + 1
+            indigo.server.log(u"Temperature history of the last %d days (%d samples) written to %s"
+                              % (HISTORY_EXPORT_DAYS, rows, path))
+        except (IOError, OSError) as e:
+            self.errorLog(u"Unable to write temperature history to %s" % path)
+            self.errorLog(e)
+
+    def getTemperatureHistory(self, pluginAction, device):
+        """Hidden action for scripts: returns the temperature history of device as a JSON list of [time, air
+        temperature, set temperature, heating on, hot water on] samples. The props "start" and "end" are in
+        seconds since the epoch (default: the last 24 hours), e.g.
+            plugin.executeAction("getTemperatureHistory", deviceId=123, props={"start": time.time() - 3600},
+                                 waitUntilDone=True)"""
+        try:
+            end = float(pluginAction.props.get("end", time.time()))
+            start = float(pluginAction.props.get("start", end - 86400))
+        except (TypeError, ValueError):
+            self.errorLog(u"getTemperatureHistory: start and end must be seconds since the epoch")
+            return None
+        samples = self._deviceHistory(device, start, end)
+        if samples is None:
+            self.errorLog(u"getTemperatureHistory: no temperature history is recorded for %s" % device.name)
+            return None
+        return json.dumps(samples)
+
+    def _publishStatistics(self):
+        """Updates the statistics variables of each bus. Counters are totals since startup, the busy percentage is
+        measured since the variables were last updated."""
+        if STATISTICS_VARIABLE_FOLDER in indigo.variables.folders:
+            folder_id = indigo.variables.folders[STATISTICS_VARIABLE_FOLDER].id
         else:
-            self.debugLog(u"New device found at address %d" % address)
-            self._addNewDevice(self.communicator.deviceInfo)
+            folder_id = indigo.variables.folder.create(STATISTICS_VARIABLE_FOLDER).id
+
+        now = time.time()
+        for bus_id, bus in self.buses.items():
+            metrics = bus.communicator.metrics
+            totals = metrics.snapshot()['operations']
+            transactions = sum(values['latency_ms']['count'] for values in totals.values())
+            failed = sum(values['latency_ms']['count'] - values['ok'] for values in totals.values())
+            previous_time, previous_busy = self.statistics_busy_time.get(bus_id, (metrics.start_time, 0.0))
+            self.statistics_busy_time[bus_id] = (now, metrics.busy_time)
+            busy = 100 * (metrics.busy_time - previous_busy) / (now - previous_time) if now > previous_time else 0.0
+            poll_latency = totals.get('poll', {}).get('latency_ms', {})
+
+            values = [("transactions", transactions),
+                      ("busyPercent", "%.1f" % busy),
+                      ("failedPercent", "%.1f" % (100.0 * failed / transactions if transactions else 0.0)),
+                      ("timeouts", sum(values['timeouts'] for values in totals.values())),
+                      ("crcErrors", sum(values['crc_errors'] for values in totals.values())),
+                      ("retries", sum(values['retries'] for values in totals.values())),
+                      ("resyncs", bus.communicator.decoder.resyncs),
+                      ("pollLatencyP95ms", "%d" % poll_latency.get('p95', 0))]
+            for name, value in values:
+                variable_name = "%s%s_%s" % (STATISTICS_VARIABLE_PREFIX, bus_id, name)
+                if variable_name in indigo.variables:
+                    indigo.variable.updateValue(variable_name, value=str(value))
+                else:
+                    indigo.variable.create(variable_name, value=str(value), folder=folder_id)
 
     def toggleDebugging(self):
         if self.debug:
@@ -405,9 +893,11 @@ class Plugin(indigo.PluginBase):
     ################################################################################
     def setRoomTemp(self, pluginAction, device):
         self.detailDebugLog("Queueing setRoomTemp for %s" % device.name)
-        self.q.put((self._setRoomTemp, [pluginAction, device]))
+        # a newer set temperature command replaces one that has not been sent yet:
+        self._queueJob(device, self._setRoomTemp, [pluginAction, device], PRIORITY_INTERACTIVE,
+                       ("setRoomTemp", device.id), replace=True)
 
-    def _setRoomTemp(self, pluginAction, device):
+    def _setRoomTemp(self, bus, pluginAction, device):
         self.detailDebugLog("Executing setRoomTemp for %s" % device.name)
         try:
             temp = int(self.substitute(pluginAction.props.get("setRoomTemp", "")))
@@ -418,56 +908,256 @@ class Plugin(indigo.PluginBase):
                               % (device.name,), isError=True)
             return
 
-        found, address = self._addressFromProps(device)
-        if not found:
+        address = self._deviceAddress(bus, device)
+        if address is None:
             self.debugLog("No address configured for device %s." % device.name)
             return
 
         if device.states["temperatureFormat"] == "F":
             temperature_format = TEMP_UNIT_FAHRENHEIT
         else:
-            temperature_format = TEMP_UNIT_SYMBOL_CELSIUS
+            temperature_format = TEMP_UNIT_CELSIUS
 
-        sendSuccess = self.communicator.set_temp(address, temp, temperature_format)
+        sendSuccess = bus.communicator.set_temp(address, temp, temperature_format)
 
-        if sendSuccess:
+        if sendSuccess == WRITE_INVALID:
+            return
+        elif sendSuccess:
+            bus.breaker.record_success(address)
             # If success then log that the command was successfully sent.
             indigo.server.log(u"Sucessfully sent \"%s\" %s to %d" % (device.name, "set room temperature", temp))
-            # poll device:
-            self.pollDevice(device)
+            self._writeAcknowledged(bus, device, address, sendSuccess, u"setRoomTemp", temp)
         else:
             # Else log failure but do NOT update state on Indigo Server.
-            self.debugLog("Device with address %d did not reply to setRoomTemp request - re-queueing..." % address)
-            self.q.put( (self._setRoomTemp, [pluginAction, device]) )
+            self._retryJob(bus, device, address, "setRoomTemp", OP_SET_TEMP,
+                           (self._setRoomTemp, [bus, pluginAction, device]), PRIORITY_INTERACTIVE,
+                           ("setRoomTemp", device.id))
 
-    def _setHotWaterOnState(self, pluginAction, device, state):
+    def _setHotWaterOnState(self, bus, pluginAction, device, state):
         """ Overrides hot water to on (state == 1) or runs the thermostat's programmed schedule (state == 0)"""
         self.detailDebugLog("Executing setHotWaterOnState for %s" % device.name)
-        found, address = self._addressFromProps(device)
-        if not found:
+        address = self._deviceAddress(bus, device)
+        if address is None:
             self.debugLog("No address configured for device %s." % device.name)
             return
 
-        sendSuccess = self.communicator.set_hw_on_state(address, state)
+        sync_clock = self._clockNeedsSync(bus, address)
+        sendSuccess = bus.communicator.set_hw_on_state(address, state, sync_clock)
+        if sendSuccess and sync_clock:
+            bus.debugLog(u"Clock of %s synchronized in the same write as the hot water state" % device.name)
 
-        if sendSuccess:
+        if sendSuccess == WRITE_INVALID:
+            return
+        elif sendSuccess:
+            bus.breaker.record_success(address)
             # If success then log that the command was successfully sent.
             if self.detailed_debug:
                 indigo.server.log(u"Sucessfully sent \"%s\" %s to %d" % (device.name, "set hot water state", state))
-            # poll device:
-            self.pollDevice(device)
+            self._writeAcknowledged(bus, device, address, sendSuccess, u"hotWaterOn", state)
         else:
             # Else log failure but do NOT update state on Indigo Server.
-            self.debugLog("Device with address %d did not reply to setHotWaterState request - re-queueing..." % address)
-            self.q.put((self._setHotWaterOnState, [pluginAction, device, state]))
+            self._retryJob(bus, device, address, "setHotWaterState", OP_SET_HW,
+                           (self._setHotWaterOnState, [bus, pluginAction, device, state]),
+                           PRIORITY_INTERACTIVE, ("hotWater", device.id))
+
+    def _writeAcknowledged(self, bus, device, address, result, state_key, value):
+        """Updates the state that was written right away, and brings the next poll forward to see how the
+        thermostat reacts. Only if the acknowledgement could not be trusted is a confirming poll queued right
+        away (replacing any pending poll); it reads the device, as the cached DCB has the written field marked
+        stale."""
+        self._updateStates(device, [(state_key, value)])
+        bus.poll_scheduler.after_write(address)
+        if result == WRITE_UNCONFIRMED:
+            self.debugLog("Write to %s was not properly acknowledged - queueing confirming poll" % device.name)
+            self.pollDevice(device, PRIORITY_REFRESH, 0)
+
+    def setGroupRoomTemp(self, pluginAction):
+        """Sets the same temperature on a group of thermostats."""
+        try:
+            temp = int(self.substitute(pluginAction.props.get("setRoomTemp", "")))
+        except ValueError:
+            indigo.server.log(u"set group temperature action -- invalid temperature value", isError=True)
+            return
+        self._queueGroupWrite(pluginAction, u"Set temperature to %d" % temp, u"setRoomTemp", temp)
+
+    def setGroupHotWater(self, pluginAction):
+        """Overrides hot water to on, or returns it to the programmed schedule, on a group of thermostats."""
+        if pluginAction.props.get("hotWaterState", "on") == "on":
+            self._queueGroupWrite(pluginAction, u"Hot water override", u"hotWaterOn", 1)
+        else:
+            self._queueGroupWrite(pluginAction, u"Hot water back to schedule", u"hotWaterOn", 0)
+
+    def _groupEntries(self, props, field):
+        """Returns a dictionary with, for each bus, the list of RegisteredDevices in the group selected by props:
+        either the listed devices, or all thermostats of a model. Hot water writes only go to thermostats that
+        control hot water."""
+        by_model = props.get("groupType", "devices") == "model"
+        model = props.get("model", "all")
+        device_ids = set(int(device_id) for device_id in props.get("devices", []))
+        groups = dict()
+        for bus_id, bus in self.buses.items():
+            entries = []
+            for entry in bus.registry.entries():
+                if field == "hotWaterOn" and entry.device.deviceTypeId != HOT_WATER_DEVICE_TYPE:
+                    continue
+                if (by_model and model in ("all", entry.model)) or (not by_model and entry.device_id in device_ids):
+                    entries.append(entry)
+            if entries:
+                groups[bus_id] = entries
+        return groups
+
+    def _queueGroupWrite(self, pluginAction, description, field, value):
+        """Queues one job per bus that writes value to field of all thermostats of the group on that bus. The
+        Heatmiser protocol has no broadcast write, so each thermostat gets its own write frame, but they are sent
+        back-to-back without queueing and polling in between, and the buses work in parallel."""
+        groups = self._groupEntries(pluginAction.props, field)
+        if not groups:
+            self.errorLog(u"%s: no thermostats in the group are enabled" % description)
+            return
+        started = time.time()
+        for bus_id, entries in groups.items():
+            bus = self.buses[bus_id]
+            key = ("group", field, tuple(entry.device_id for entry in entries))
+            # a newer group command for the same thermostats replaces one that has not been sent yet:
+            bus.q.put((self._writeGroup, [bus, pluginAction, description, entries, field, value, started]),
+                      PRIORITY_INTERACTIVE, key, replace=True)
+
+    def _writeGroup(self, bus, pluginAction, description, entries, field, value, started):
+        """Worker function that writes value to field (setRoomTemp or hotWaterOn) of a group of thermostats on bus,
+        back-to-back. Thermostats that did not acknowledge are retried one by one; the others are confirmed by a
+        single job that polls them all once they have had time to react."""
+        acknowledged = []
+        failed = 0
+        skipped = 0
+        for entry in entries:
+            device = entry.device
+            address = entry.address
+            if device.states.get("temperatureFormat") == "F":
+                temperature_unit = TEMP_UNIT_FAHRENHEIT
+            else:
+                temperature_unit = TEMP_UNIT_CELSIUS
+            if field == u"setRoomTemp":
+                # checked before asking the breaker, which expects an outcome once it allows a transaction:
+                minimum, maximum = bus.communicator.set_temp_range(temperature_unit)
+                if not minimum <= value <= maximum:
+                    self.errorLog(u"%s: %d is outside the range of %s (%d to %d)"
+                                  % (description, value, device.name, minimum, maximum))
+                    skipped = skipped + 1
+                    continue
+            if not bus.breaker.allow(address):
+                skipped = skipped + 1
+                continue
+
+            if field == u"setRoomTemp":
+                result = bus.communicator.set_temp(address, value, temperature_unit)
+                retry = (self._setRoomTemp, [bus, pluginAction, device])
+                operation = OP_SET_TEMP
+                key = ("setRoomTemp", device.id)
+            else:
+                result = bus.communicator.set_hw_on_state(address, value, self._clockNeedsSync(bus, address))
+                retry = (self._setHotWaterOnState, [bus, pluginAction, device, value])
+                operation = OP_SET_HW
+                key = ("hotWater", device.id)
+
+            if result == WRITE_INVALID:
+                skipped = skipped + 1
+            elif result:
+                bus.breaker.record_success(address)
+                self._updateStates(device, [(field, value)])
+                acknowledged.append((entry, time.time()))
+            else:
+                failed = failed + 1
+                self._retryJob(bus, device, address, description, operation, retry, PRIORITY_INTERACTIVE, key)
+
+        indigo.server.log(u"%s for %d thermostats on %s: %d acknowledged, %d retrying, %d skipped, in %.1f s"
+                          % (description, len(entries), bus.name, len(acknowledged), failed, skipped,
+                             time.time() - started))
+        if acknowledged:
+            bus.q.put((self._confirmGroup, [bus, description, acknowledged, field, value, started]),
+                      PRIORITY_REFRESH, delay=AFTER_WRITE_DELAY)
+
+    def _confirmGroup(self, bus, description, acknowledged, field, value, started):
+        """Worker function that polls the thermostats of a group write, given as (RegisteredDevice, time the write
+        was acknowledged) tuples, and logs how many report the new value."""
+        confirmed = 0
+        for entry, acknowledged_at in acknowledged:
+            # the acknowledged value is patched into the cached DCB, so only a DCB read after that confirms it:
+            self._pollDevice(bus, entry.device, time.time() - acknowledged_at)
+            record, read_time = bus.communicator.cache.peek(entry.address)
+            if record is not None and read_time > acknowledged_at and getattr(record, field) == value:
+                confirmed = confirmed + 1
+        bus.debugLog(u"%s: %d of %d thermostats confirmed by polling, %.1f s after the action"
+                     % (description, confirmed, len(acknowledged), time.time() - started))
+
+    def uploadGroupSchedule(self, pluginAction):
+        """Programs the same heating and/or hot water schedule (see pm_schedule for the syntax) into a group of
+        thermostats. Only the days that differ from what a thermostat has are written."""
+        try:
+            schedules = parse_schedule(self.substitute(pluginAction.props.get("schedule", "")), MIN_TEMP_C,
+                                       MAX_TEMP_C)
+        except ValueError as error:
+            indigo.server.log(u"upload schedule action -- invalid schedule: %s" % error, isError=True)
+            return
+        groups = self._groupEntries(pluginAction.props, "schedule")
+        if not groups:
+            self.errorLog(u"Schedule upload: no thermostats in the group are enabled")
+            return
+        started = time.time()
+        for bus_id, entries in groups.items():
+            bus = self.buses[bus_id]
+            key = ("schedule", tuple(entry.device_id for entry in entries))
+            bus.q.put((self._uploadSchedule, [bus, entries, schedules, started]), PRIORITY_INTERACTIVE, key,
+                      replace=True)
+
+    def _uploadSchedule(self, bus, entries, schedules, started):
+        """Worker function that programs schedules into the thermostats of a group on bus. Each thermostat's
+        schedules are compared with its DCB, so thermostats that already have the schedule cost no writes.
+        Thermostats that did not acknowledge are retried one by one."""
+        updated = 0
+        unchanged = 0
+        written = 0
+        failed = 0
+        skipped = 0
+        for entry in entries:
+            device = entry.device
+            address = entry.address
+            if not bus.breaker.allow(address):
+                skipped = skipped + 1
+                continue
+
+            results, missing = bus.communicator.write_schedules(address, schedules)
+            if missing:
+                bus.debugLog(u"Schedule upload: %s does not have %s" % (device.name, u", ".join(sorted(missing))))
+            if results is not None and all(results.values()):
+                bus.breaker.record_success(address)
+                if results:
+                    updated = updated + 1
+                    written = written + len(results)
+                    bus.poll_scheduler.after_write(address)
+                elif len(missing) < len(schedules):
+                    unchanged = unchanged + 1
+                else:
+                    skipped = skipped + 1
+            else:
+                failed = failed + 1
+                self._retryJob(bus, device, address, "schedule upload", OP_SCHEDULE,
+                               (self._uploadSchedule, [bus, [entry], schedules, started]), PRIORITY_INTERACTIVE,
+                               ("schedule", (entry.device_id,)))
+
+        indigo.server.log(u"Schedule upload to %d thermostats on %s: %d updated (%d days written), %d unchanged, "
+                          u"%d retrying, %d skipped, in %.1f s"
+                          % (len(entries), bus.name, updated, written, unchanged, failed, skipped,
+                             time.time() - started))
 
     def setHotWaterOn (self, pluginAction, device):
         """Convenience function to override hot water to on"""
         self.detailDebugLog("Queueing setHotWaterOn for %s" % device.name)
-        self.q.put( (self._setHotWaterOnState,[pluginAction, device, 1]) )
+        self._queueJob(device, self._setHotWaterOnState, [pluginAction, device, 1], PRIORITY_INTERACTIVE,
+                       ("hotWater", device.id), replace=True)
 
     def setHotWaterAsScheduled (self, pluginAction, device):
         """Convenience function to set hot water to run according to thermostat's program"""
         self.detailDebugLog("Queueing setHotWaterAsScheduled for %s" % device.name)
-        self.q.put( (self._setHotWaterOnState,[pluginAction, device, 0]) )
+        self._queueJob(device, self._setHotWaterOnState, [pluginAction, device, 0], PRIORITY_INTERACTIVE,
+                       ("hotWater", device.id), replace=True)
 
@@ -0,0 +1,413 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#  Benchmark suite for the Thermiser protocol stack: CRC, frame forming, DCB decoding per model, and complete poll
+#  cycles against a simulated bus (see pm_sim). Not used by the plugin itself; run from this folder with:
+#      python pm_bench.py                              # all cases
+#      python pm_bench.py --cases poll --devices 1,8,32
+#      python pm_bench.py --json results.json          # machine-readable results
+#      python pm_bench.py --json new.json --compare old.json
+#  The JSON file holds one flat dictionary of metrics per case, plus the plugin and Python versions, so results of
+#  different versions can be compared with --compare.
+
+import argparse
+import json
+import os
+import platform
+import re
+import sys
+import time
+import timeit
+
+from pm_crc import *
+from pm_dcb import *
+from pm_queue import *
+from pm_sim import *
+from pymiser import PyMiser
+
+DCB_FRAME_SIZE = 9 + 148 + 2  # reply header, PRT 7-day DCB and CRC
+
+
+class nibble_crc(object):
+    """The original nibble-at-a-time CRC implementation, kept as a reference for the benchmarks."""
+
+    ltH = [0x00, 0x10, 0x20, 0x30, 0x40, 0x50, 0x60, 0x70, 0x81, 0x91, 0xa1, 0xb1, 0xc1, 0xd1, 0xe1, 0xf1]
+    ltL = [0x00, 0x21, 0x42, 0x63, 0x84, 0xa5, 0xc6, 0xe7, 0x08, 0x29, 0x4a, 0x6b, 0x8c, 0xad, 0xce, 0xef]
+
+    def __init__(self):
+        self.hi = 0xFF
+        self.lo = 0xFF
+
+    def _updateNibble(self, byte):
+        t = self.hi >> 4
+        t = t ^ byte
+        self.hi = ((self.hi << 4) | (self.lo >> 4)) & 0xFF
+        self.hi = self.hi ^ self.ltH[t]
+        self.hi = self.hi & 0xFF
+        self.lo = (self.lo << 4) & 0xFF
+        self.lo = self.lo ^ self.ltL[t]
+        self.lo = self.lo & 0xFF
+
+    def ccitt(self, data):
+        self.hi = 0xFF
+        self.lo = 0xFF
+        for byte in data:
+            self._updateNibble(byte >> 4)
+            self._updateNibble(byte & 0x0f)
+        return [self.lo, self.hi]
+
+    def verifyCCITTfromByteArray(self, data):
+        lo, hi = self.ccitt(data[:(len(data)-2)])
+        return data[len(data)-2] == lo and data[len(data)-1] == hi
+
+
+def legacy_parse_dcb(dcb):
+    """The original dict based DCB parser, kept as a reference for the benchmarks."""
+    result = {'frameLength': dcb[2] * 256 + dcb[1], 'address': dcb[3]}
+    dcb_offset = 9  # type: int
+    result['dcbLen'] = dcb[dcb_offset] * 256 + dcb[dcb_offset+1]
+    vendor_id = dcb[dcb_offset+2]
+    if vendor_id == 0:
+        result['vendor'] = 'Heatmiser'
+    else:
+        result['vendor'] = 'o.e.m.'
+
+    result['softwareVersion'] = dcb[dcb_offset + 3] & 0x7f
+    result['floorLimitState'] = dcb[dcb_offset + 3] >> 7
+
+    model_id = dcb[dcb_offset + 4]
+    result['modelID'] = model_id
+    if 0 <= model_id < len(MODEL_NAMES):
+        result['model'] = MODEL_NAMES[model_id]
+    else:
+        result['model'] = UNKNOWN_NAME
+
+    if dcb[dcb_offset + 5] == 0:
+        result['temperatureFormat'] = 'C'
+    else:
+        result['temperatureFormat'] = 'F'
+
+    result['switchDifferential'] = dcb[dcb_offset + 6]
+
+    frost_protection_code = dcb[dcb_offset + 7]
+    if 0 <= frost_protection_code < len(FROST_PROTECTION_NAMES):
+        result['frostProtection'] = FROST_PROTECTION_NAMES[frost_protection_code]
+    else:
+        result['frostProtection'] = UNKNOWN_NAME
+
+    result['calibrationOffset'] = dcb[dcb_offset +8] * 256 + dcb[dcb_offset+9]
+    result['outputDelay'] = dcb[dcb_offset+10]
+    # offset +11 is the address, which we already know, so we're ignoring it.
+    result['upDownKeyLimit'] = dcb[dcb_offset+12]
+
+    sensor_selection_code = dcb[dcb_offset+13]
+    result['sensorSelectionCode'] = sensor_selection_code
+    if 0 <= sensor_selection_code < len(SENSOR_NAMES):
+        result['sensor'] = SENSOR_NAMES[sensor_selection_code]
+    else:
+        result['sensor'] = UNKNOWN_NAME
+
+    result['optimumStart'] = dcb[dcb_offset+14]
+    result['rateOfChange'] = dcb[dcb_offset+15]
+
+    program_mode_code = dcb[dcb_offset+16]
+    result['programModeCode'] = program_mode_code
+    if 0 <= program_mode_code < len(PROGRAM_MODE_NAMES):
+        result['programMode'] = PROGRAM_MODE_NAMES[program_mode_code]
+
+    result['frostProtectTemp'] = dcb[dcb_offset+17]
+    result['setRoomTemp'] = dcb[dcb_offset+18]
+    result['floorMaxLimit'] = dcb[dcb_offset + 19]
+    result['floorMaxLimitEnable'] = dcb[dcb_offset + 19]
+    result['On'] = dcb[dcb_offset + 21]
+    result['keyLock'] = dcb[dcb_offset + 22]
+
+    run_mode_code = dcb[dcb_offset + 23]
+    if 0 <= run_mode_code < len(RUN_MODE_NAMES):
+        result['runMode'] = RUN_MODE_NAMES[run_mode_code]
+    else:
+        result['runMode'] = UNKNOWN_NAME
+
+    result['holidayHours'] = dcb[dcb_offset + 24] * 256 + dcb[dcb_offset+25]
+    result['tempHoldMinutes'] = dcb[dcb_offset + 26] * 256 + dcb[dcb_offset+27]
+
+    remote_air_temp = (dcb[dcb_offset + 28] * 256 + dcb[dcb_offset+29]) / 10
+    if remote_air_temp == 0xFFFF:
+        remote_air_temp = None
+    result['remoteAirTemp'] = remote_air_temp
+
+    floor_temp = (dcb[dcb_offset + 30] * 256 + dcb[dcb_offset + 31]) / 10
+    if floor_temp == 0xFFFF:
+        floor_temp = None
+    result['floorTemp'] = floor_temp
+
+    air_temp = (dcb[dcb_offset + 32] * 256 + dcb[dcb_offset + 33]) / 10
+    if air_temp == 0xFFFF:
+        air_temp = None
+    result['airTemp'] = air_temp
+    result['heatingOn'] = dcb[dcb_offset+35]
+
+    # This is where the DCB finishes for DT / DT-E model
+    if model_id == 0 or model_id == 1:
+        return result
+
+    # PRT-HW has an extra byte in the DCB for hot water, so after this everything shifts by one byte.
+    if model_id == 4:
+        result['hotWaterOn'] = dcb[dcb_offset+36]
+        # shift subsequent offsets:
+        dcb_offset = dcb_offset + 1
+
+    result['weekDayNumber'] = dcb[dcb_offset+36]
+    result['timeHour'] = dcb[dcb_offset+37]
+    result['timeMinute'] = dcb[dcb_offset+38]
+    result['timeSecond'] = dcb[dcb_offset+39]
+
+    return result
+
+
+def _sample_frame(size=DCB_FRAME_SIZE):
+    frame = bytearray((i * 7 + 3) & 0xFF for i in range(size))
+    return crc().addCCITTtoBytearray(frame)
+
+
+def _time(function, number):
+    """Returns the best time per call in microseconds over three runs."""
+    return min(timeit.repeat(function, number=number, repeat=3)) / number * 1e6
+
+
+def bench_crc(number=2000):
+    """Compares the nibble-wise reference CRC with the table driven CRC on a DCB-sized frame."""
+    frame = _sample_frame()
+    reference = nibble_crc()
+    table = crc()
+    assert reference.ccitt(frame) == table.ccitt(frame)
+
+    nibble_us = _time(lambda: reference.verifyCCITTfromByteArray(frame), number)
+    table_us = _time(lambda: table.verifyCCITTfromByteArray(frame), number)
+    view = memoryview(frame)
+    view_us = _time(lambda: verify_ccitt(view, 0, len(frame)), number)
+    frames = [frame] * 100
+    batch_us = _time(lambda: table.verifyFrames(frames), max(1, number // 100)) / len(frames)
+    ccitt_us = _time(lambda: table.ccitt(frame), number)
+
+    print(u"CRC verify, %d byte frame:" % len(frame))
+    print(u"  nibble-wise (reference): %8.1f us" % nibble_us)
+    print(u"  table driven:            %8.1f us  (%.1fx)" % (table_us, nibble_us / table_us))
+    print(u"  table driven, memoryview:%8.1f us  (%.1fx)" % (view_us, nibble_us / view_us))
+    print(u"  table driven, batch:     %8.1f us  (%.1fx)" % (batch_us, nibble_us / batch_us))
+    print(u"  crc.ccitt throughput:    %8.2f MB/s" % (len(frame) / ccitt_us))
+    return {'frame_bytes': len(frame), 'nibble_verify_us': nibble_us, 'table_verify_us': table_us,
+            'memoryview_verify_us': view_us, 'batch_verify_us': batch_us, 'ccitt_mb_per_s': len(frame) / ccitt_us}
+
+
+def bench_form_frame(number=20000):
+    """Times forming a read request, a one byte write (set temperature) and a four byte write (clock)."""
+    communicator = PyMiser(None)
+    read_us = _time(lambda: communicator._form_frame(1, 0, READ_ALL, None), number)
+    setpoint = bytearray([21])
+    write_us = _time(lambda: communicator._form_frame(1, 18, 1, setpoint), number)
+    clock = bytearray([5, 12, 30, 0])
+    clock_us = _time(lambda: communicator._form_frame(1, 43, 4, clock), number)
+
+    print(u"Frame forming:")
+    print(u"  read request:            %8.2f us" % read_us)
+    print(u"  1 byte write:            %8.2f us" % write_us)
+    print(u"  4 byte write:            %8.2f us" % clock_us)
+    return {'read_us': read_us, 'write_1_byte_us': write_us, 'write_4_bytes_us': clock_us}
+
+
+def sample_dcb_frame(layout, model_id, variant=0, seven_day=True):
+    """Returns a read reply frame with a plausible DCB for the given layout and model."""
+    values = {'vendorID': 0, 'versionByte': 0x0c, 'modelID': model_id, 'switchDifferential': 1,
+              'frostProtectionCode': 1, 'address': 1 + variant % 32, 'rateOfChange': 20,
+              'programModeCode': 1 if seven_day else 0, 'frostProtectTemp': 12, 'setRoomTemp': 18 + variant % 5,
+              'On': 1, 'remoteAirTempRaw': TEMPERATURE_NOT_CONNECTED, 'floorTempRaw': TEMPERATURE_NOT_CONNECTED,
+              'airTempRaw': 190 + variant % 40, 'heatingOn': variant % 2, 'hotWaterOn': variant % 2,
+              'weekDayNumber': 1 + variant % 7, 'timeHour': variant % 24, 'timeMinute': variant % 60,
+              'timeSecond': variant % 60}
+    dcb_length = layout.size
+    for table, (offset, size) in layout.schedules.items():
+        if seven_day or not table.startswith('sevenDay'):
+            dcb_length = max(dcb_length, offset + size)
+    values['dcbLen'] = dcb_length
+    dcb = layout.encode(values, dcb_length)
+    for table, (offset, size) in layout.schedules.items():
+        for i in range(offset, min(offset + size, dcb_length)):
+            dcb[i] = (i * 3 + variant) % 24
+    frame = bytearray([0x81, 0, 0, values['address'], 0, 0, 0, dcb_length & 0xFF, dcb_length >> 8]) + dcb + bytearray(2)
+    frame[1] = len(frame) & 0xFF
+    frame[2] = len(frame) >> 8
+    return crc().addCCITTtoBytearray(frame)
+
+
+def _retained_size(objects):
+    """Returns the approximate number of bytes allocated for objects, using tracemalloc where available."""
+    try:
+        import tracemalloc
+    except ImportError:
+        tracemalloc = None
+    if tracemalloc is not None:
+        tracemalloc.start()
+        start = tracemalloc.get_traced_memory()[0]
+        retained = objects()
+        size = tracemalloc.get_traced_memory()[0] - start
+        tracemalloc.stop()
+        return size, len(retained)
+    # Python 2: the record containers dominate, their values are shared small ints and constant strings.
+    retained = objects()
+    return sum(sys.getsizeof(x) for x in retained), len(retained)
+
+
+def _decode_rate(parser, stream):
+    start = timeit.default_timer()
+    for frame in stream:
+        parser(frame)
+    return (timeit.default_timer() - start) / len(stream) * 1e6
+
+
+def bench_decode(frames=1000000, retained=10000):
+    """Decodes a stream of captured-style frames of all models with the legacy dict parser and the compiled
+    struct decoder, and compares time per frame and memory per retained record. Then times the struct decoder
+    for each model separately."""
+    samples = []
+    models = [('DT', DT_LAYOUT, MODEL_DT), ('PRT', PRT_LAYOUT, MODEL_PRT), ('PRT-HW', PRT_HW_LAYOUT, MODEL_PRT_HW)]
+    per_model = dict((name, []) for name, layout, model_id in models)
+    for variant in range(30):
+        for name, layout, model_id in models:
+            frame = sample_dcb_frame(layout, model_id, variant, seven_day=name == 'DT' or variant % 2 == 0)
+            samples.append(frame)
+            per_model[name].append(frame)
+    for frame in samples:
+        legacy = legacy_parse_dcb(frame)
+        record = decode_dcb(frame)
+        for name in ('airTemp', 'setRoomTemp', 'heatingOn', 'modelID', 'temperatureFormat', 'rateOfChange',
+                     'softwareVersion', 'timeHour', 'timeSecond', 'hotWaterOn'):
+            if name in legacy or getattr(record, name) is not None:
+                legacy_value = legacy[name]
+                if isinstance(legacy_value, float):
+                    # the legacy parser relies on Python 2 integer division for temperatures
+                    legacy_value = int(legacy_value)
+                assert legacy_value == getattr(record, name), name
+    stream = (samples * (frames // len(samples) + 1))[:frames]
+
+    legacy_us = _decode_rate(legacy_parse_dcb, stream)
+    struct_us = _decode_rate(decode_dcb, stream)
+    subset = stream[:retained]
+    legacy_bytes, count = _retained_size(lambda: [legacy_parse_dcb(frame) for frame in subset])
+    struct_bytes, _ = _retained_size(lambda: [decode_dcb(frame) for frame in subset])
+
+    print(u"DCB decode, %d frames (DT, PRT and PRT-HW):" % len(stream))
+    print(u"  dict parser (reference): %8.2f us/frame  %6d bytes/record" % (legacy_us, legacy_bytes / count))
+    print(u"  compiled struct decoder: %8.2f us/frame  %6d bytes/record  (%.1fx faster, %.1fx smaller)"
+          % (struct_us, struct_bytes / count, legacy_us / struct_us, float(legacy_bytes) / struct_bytes))
+    results = {'legacy_us': legacy_us, 'struct_us': struct_us, 'legacy_bytes_per_record': legacy_bytes / count,
+               'struct_bytes_per_record': struct_bytes / count}
+
+    for name, layout, model_id in models:
+        model_stream = (per_model[name] * (frames // 3 // len(per_model[name]) + 1))[:max(1, frames // 3)]
+        model_us = _decode_rate(decode_dcb, model_stream)
+        print(u"  %-6s struct decoder:    %8.2f us/frame  (%d frames/s)" % (name, model_us, 1e6 / model_us))
+        results['%s_us' % name] = model_us
+    return results
+
+
+class _BenchOwner(object):
+    """Minimal PyMiser owner: the comm port, and logging that goes nowhere."""
+    detailed_debug = False
+
+    def __init__(self, comm_port):
+        self.comm_port = comm_port
+
+    def debugLog(self, msg):
+        pass
+
+    detailDebugLog = debugLog
+    errorLog = debugLog
+
+
+def bench_poll_cycle(devices, cycles=3, time_scale=1.0):
+    """Polls devices simulated thermostats through the job queue, once cold (full DCB reads, as after startup)
+    and then cycles times warm (partial reads). Times are bus time, i.e. wall time divided by time_scale; with
+    time_scale 0 only the processing time is measured."""
+    bus = SimulatedBus(make_thermostats(devices), seed=devices)
+    communicator = PyMiser(_BenchOwner(SimulatorPort(bus, time_scale)))
+    queue = JobQueue()
+
+    def cycle():
+        for address in range(1, devices + 1):
+            queue.put((communicator.read_device_info, [address]), PRIORITY_POLL, ("poll", address))
+        start = timeit.default_timer()
+        failures = 0
+        while not queue.empty():
+            function, args = queue.get(False)
+            if function(*args) is None:
+                failures = failures + 1
+        elapsed = timeit.default_timer() - start
+        return elapsed / time_scale if time_scale else elapsed, failures
+
+    cold_s, cold_failures = cycle()
+    warm = [cycle() for _ in range(cycles)]
+    warm_s = sum(elapsed for elapsed, failures in warm) / len(warm)
+    failures = cold_failures + sum(failures for elapsed, failures in warm)
+    print(u"Poll cycle, %d devices (%s):" % (devices, u"bus time" if time_scale else u"processing time only"))
+    print(u"  cold (full reads):       %8.3f s  (%.1f ms/device)" % (cold_s, cold_s / devices * 1000))
+    print(u"  warm (partial reads):    %8.3f s  (%.1f ms/device)" % (warm_s, warm_s / devices * 1000))
+    if failures:
+        print(u"  %d failed reads" % failures)
+    return {'devices': devices, 'cold_s': cold_s, 'warm_s': warm_s, 'warm_ms_per_device': warm_s / devices * 1000,
+            'bytes_read': communicator.dcb_bytes_read, 'failures': failures}
+
+
+def plugin_version():
+    """Returns the plugin version from Info.plist, or None."""
+    try:
+        with open(os.path.join(os.path.dirname(os.path.abspath(__file__)), os.pardir, 'Info.plist')) as plist:
+            match = re.search(r'<key>PluginVersion</key>\s*<string>([^<]*)</string>', plist.read())
+        return match.group(1) if match else None
+    except IOError:
+        return None
+
+
+def compare(results, baseline):
+    """Prints the ratio of each metric to the same metric in a baseline result file."""
+    print(u"Compared to %s (plugin %s, Python %s):" % (baseline.get('timestamp'), baseline.get('plugin_version'),
+                                                       baseline.get('python')))
+    for case in sorted(results['cases']):
+        for metric, value in sorted(results['cases'][case].items()):
+            old = baseline.get('cases', {}).get(case, {}).get(metric)
+            if old and isinstance(value, (int, float)):
+                print(u"  %-12s %-26s %12.3f -> %12.3f  (%.2fx)" % (case, metric, old, value, float(value) / old))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Thermiser protocol benchmarks")
+    parser.add_argument('--cases', default="crc,frame,decode,poll", help="comma separated cases to run")
+    parser.add_argument('--frames', type=int, default=1000000, help="number of frames to decode")
+    parser.add_argument('--devices', default="1,8,32", help="comma separated bus sizes for the poll cycle")
+    parser.add_argument('--cycles', type=int, default=3, help="number of warm poll cycles")
+    parser.add_argument('--time-scale', type=float, default=1.0, dest='time_scale',
+                        help="speed of the simulated bus: 1 is real time, 0 measures processing time only")
+    parser.add_argument('--json', metavar="FILE", help="write the results to FILE as JSON")
+    parser.add_argument('--compare', metavar="FILE", help="compare the results with an earlier JSON result file")
+    arguments = parser.parse_args()
+
+    cases = arguments.cases.split(',')
+    results = {'plugin_version': plugin_version(), 'python': platform.python_version(),
+               'platform': platform.platform(), 'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'), 'cases': {}}
+    if 'crc' in cases:
+        results['cases']['crc'] = bench_crc()
+    if 'frame' in cases:
+        results['cases']['frame'] = bench_form_frame()
+    if 'decode' in cases:
+        results['cases']['decode'] = bench_decode(arguments.frames)
+    if 'poll' in cases:
+        for devices in arguments.devices.split(','):
+            results['cases']['poll_%s' % devices] = bench_poll_cycle(int(devices), arguments.cycles,
+                                                                     arguments.time_scale)
+
+    if arguments.json:
+        with open(arguments.json, 'w') as output:
+            json.dump(results, output, indent=2, sort_keys=True)
+    if arguments.compare:
+        with open(arguments.compare) as baseline_file:
+            compare(results, json.load(baseline_file))
@@ -0,0 +1,77 @@
+# -*- coding: utf-8 -*-
+
+#  Per-address circuit breaker for the RS485 bus. Failed transactions are retried with jittered exponential
+#  backoff. After FAILURE_THRESHOLD consecutive failures the circuit for that address opens, and the address
+#  is only probed once every PROBE_INTERVAL seconds until it replies again, so that a missing thermostat
+#  does not take bus time away from the healthy ones.
+
+import random
+import threading
+import time
+
+BREAKER_CLOSED = 0  # device is healthy (or has failed fewer than FAILURE_THRESHOLD times in a row)
+BREAKER_OPEN = 1  # device is considered offline, only occasional probes are allowed
+BREAKER_HALF_OPEN = 2  # a probe of an offline device is in progress
+BREAKER_STATE_NAMES = ['closed', 'open', 'half-open']
+FAILURE_THRESHOLD = 5  # consecutive failures after which the circuit opens
+RETRY_BASE_DELAY = 1.0  # seconds before the first retry
+RETRY_MAX_DELAY = 60.0  # upper limit for the retry delay
+PROBE_INTERVAL = 900.0  # seconds between probes of an address with an open circuit
+
+
+class CircuitBreaker(object):
+    """Keeps track of consecutive failures and circuit state for each address."""
+
+    def __init__(self, failure_threshold=FAILURE_THRESHOLD, probe_interval=PROBE_INTERVAL):
+        self._lock = threading.Lock()
+        self.failure_threshold = failure_threshold
+        self.probe_interval = probe_interval
+        self._failures = dict()  # address -> number of consecutive failures
+        self._states = dict()  # address -> BREAKER_OPEN / BREAKER_HALF_OPEN, closed addresses are not stored
+        self._opened_at = dict()  # address -> time at which the circuit (re-)opened
+
+    def state(self, address):
+        """Returns the circuit state for address."""
+        with self._lock:
+            return self._states.get(address, BREAKER_CLOSED)
+
+    def failures(self, address):
+        """Returns the number of consecutive failures for address."""
+        with self._lock:
+            return self._failures.get(address, 0)
+
+    def allow(self, address):
+        """Returns True if a transaction with address may be attempted now. When the circuit is open and the
+        probe interval has expired, the circuit becomes half-open and a single probe is allowed."""
+        with self._lock:
+            state = self._states.get(address, BREAKER_CLOSED)
+            if state == BREAKER_CLOSED:
+                return True
+            if state == BREAKER_OPEN and time.time() - self._opened_at[address] >= self.probe_interval:
+                self._states[address] = BREAKER_HALF_OPEN
+                return True
+            return False
+
+    def record_success(self, address):
+        """Closes the circuit for address and clears its failure count."""
+        with self._lock:
+            self._failures.pop(address, None)
+            self._states.pop(address, None)
+            self._opened_at.pop(address, None)
+
+    def record_failure(self, address):
+        """Records a failed transaction with address. Returns the delay in seconds after which the transaction
+        should be retried, or None if it should not be retried because the circuit is (now) open."""
+        with self._lock:
+            failures = self._failures.get(address, 0) + 1
+            self._failures[address] = failures
+            if self._states.get(address, BREAKER_CLOSED) != BREAKER_CLOSED or failures >= self.failure_threshold:
+                self._states[address] = BREAKER_OPEN
+                self._opened_at[address] = time.time()
+                return None
+            return self.retry_delay(failures)
+
+    def retry_delay(self, failures):
+        """Returns a jittered exponential backoff delay for the given number of consecutive failures."""
+        delay = min(RETRY_MAX_DELAY, RETRY_BASE_DELAY * (2 ** (failures - 1)))
+        return random.uniform(delay / 2, delay)
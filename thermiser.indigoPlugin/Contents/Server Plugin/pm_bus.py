@@ -0,0 +1,184 @@
+# -*- coding: utf-8 -*-
+
+#  An RS485 bus: one serial port or serial server (see pm_transport) with the thermostats connected to it. Each bus
+#  has its own job queue, PyMiser communicator, circuit breaker and device registry, and runs its jobs on its own
+#  scheduler thread. Serial I/O releases the GIL, so transactions on different buses (i.e. different USB-RS485
+#  adapters) run in parallel.
+
+import threading
+import time
+from pm_breaker import *
+from pm_poll import *
+from pm_queue import *
+from pm_registry import *
+from pm_transport import *
+from pymiser import *
+
+MAX_BUSES = 4  # number of buses that can be configured in the plugin preferences
+DEFAULT_BUS_ID = "1"  # bus of devices that were created before multiple buses were supported
+# longest time a bus scheduler blocks on an empty queue before checking for a stop request (seconds)
+SCHEDULER_IDLE_TIMEOUT = 1.0
+# interval at which each bus reports its measured throughput in the debug log (seconds)
+THROUGHPUT_REPORT_INTERVAL = 60
+
+
+def bus_port_field(bus_id):
+    """Returns the id of the serial port field of a bus in the plugin preferences."""
+    if bus_id == DEFAULT_BUS_ID:
+        return "devicePortFieldId"
+    return "bus%sPortFieldId" % bus_id
+
+
+def bus_ids():
+    """Returns the ids of all buses that can be configured."""
+    return [str(number) for number in range(1, MAX_BUSES + 1)]
+
+
+class Bus(object):
+    """One transport and the scheduler that serializes all transactions on it."""
+
+    def __init__(self, owner, bus_id, name, transport):
+        self.owner = owner
+        self.bus_id = bus_id
+        self.name = name
+        self.port_name = transport.name
+        self.comm_port = transport  # PyMiser talks to the comm port of its owner
+        self.comm_port_open = False
+
+        self.q = JobQueue()
+        self.poll_scheduler = PollScheduler(owner.poll_interval)
+        self.breaker = CircuitBreaker()
+        self.registry = DeviceRegistry()
+        self.communicator = PyMiser(self)
+        self.history = None  # TemperatureHistory the plugin records polls in, if enabled
+
+        self.discovery_pending = set()  # addresses still to be probed by the running discovery scan
+        self.discovery_known = set()
+        self.discovery_found = []
+        self.discovery_silent = 0  # addresses that did not answer the probe at all
+        self.discovery_invalid = []  # addresses that answered the probe, but not with a valid reply
+        self.discovery_start_time = 0
+
+        self.clock_sync_pending = set()  # addresses still to be checked by the running clock sync round
+        self.clock_drifts = []  # clock drift (seconds) of each device checked in this round
+        self.clocks_synced = 0
+
+        self.jobs_run = 0
+        self.jobs_busy_time = 0.0
+        self.last_throughput_report_time = time.time()
+        self._stop = threading.Event()
+        self._thread = None
+
+    # PyMiser logs through its owner, which is the bus:
+    @property
+    def detailed_debug(self):
+        return self.owner.detailed_debug
+
+    def debugLog(self, msg):
+        self.owner.debugLog(u"[%s] %s" % (self.name, msg))
+
+    def detailDebugLog(self, msg):
+        self.owner.detailDebugLog(u"[%s] %s" % (self.name, msg))
+
+    def errorLog(self, msg):
+        self.owner.errorLog(u"[%s] %s" % (self.name, msg))
+
+    def open(self):
+        """Opens the transport. Returns True if the port is open. A serial server that can't be reached yet
+        leaves the port open but disconnected; the transport keeps trying to connect."""
+        try:
+            if self.comm_port.open():
+                self.debugLog(u"Opened COMM port: %s" % self.port_name)
+            else:
+                self.errorLog(u"Unable to connect to %s (%s) - retrying every %d s"
+                              % (self.port_name, self.comm_port.last_error, RECONNECT_DELAY))
+            self.comm_port_open = True
+        except Exception as e:
+            self.errorLog(u"Unable to open COMM port: %s" % self.port_name)
+            self.errorLog(e)
+            self.comm_port_open = False
+        return self.comm_port_open
+
+    def close(self):
+        if self.comm_port_open:
+            self.comm_port.close()
+            self.comm_port_open = False
+
+    def start(self):
+        """Starts the scheduler thread of this bus."""
+        self._stop.clear()
+        self._thread = threading.Thread(target=self.run, name="Thermiser %s" % self.name)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self, timeout=None):
+        """Asks the scheduler thread to stop, and waits for it to finish its current job."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join(timeout)
+            self._thread = None
+
+    def run(self):
+        """Bus scheduler: runs queued jobs back-to-back while there is work, and otherwise blocks on the
+        queue until a job arrives."""
+        self.debugLog(u"Scheduler started")
+        while not self._stop.is_set():
+            try:
+                job = self.q.get(True, SCHEDULER_IDLE_TIMEOUT)
+            except Empty:
+                job = None
+
+            if job and not self._stop.is_set():
+                self.run_job(job)
+
+            self.report_throughput()
+        self.debugLog(u"Scheduler stopped")
+
+    def run_job(self, job):
+        """Runs a single queued job and keeps track of the time spent on it."""
+        f = job[0]
+        args = job[1]
+        start = time.time()
+        try:
+            f(*args)
+        except Exception as e:
+            self.errorLog(u"Error while running job %s" % f.__name__)
+            self.errorLog(e)
+        self.jobs_run = self.jobs_run + 1
+        self.jobs_busy_time = self.jobs_busy_time + (time.time() - start)
+
+    def report_throughput(self):
+        """Logs the measured job throughput once every THROUGHPUT_REPORT_INTERVAL seconds."""
+        now = time.time()
+        elapsed = now - self.last_throughput_report_time
+        if elapsed < THROUGHPUT_REPORT_INTERVAL:
+            return
+
+        if self.jobs_run > 0:
+            busy_rate = self.jobs_run / self.jobs_busy_time if self.jobs_busy_time > 0 else 0.0
+            self.debugLog(u"Scheduler: %d jobs in %d s (%.2f jobs/s overall, %.2f jobs/s while busy, bus busy %d%%)"
+                          % (self.jobs_run, elapsed, self.jobs_run / elapsed, busy_rate,
+                             100 * self.jobs_busy_time / elapsed))
+            for line in self.q.metrics_report():
+                self.debugLog(u"Scheduler queue: %s" % line)
+            self.debugLog(u"Bus: %s" % self.communicator.wire_savings_report())
+            self.debugLog(u"DCB cache: %s" % self.communicator.cache.report())
+            self.debugLog(u"Transactions: %s" % self.communicator.metrics.report()[0])
+            self.debugLog(u"Frames: %s" % self.communicator.decoder.report())
+            self.debugLog(u"Polling: %s" % self.poll_scheduler.report())
+            if getattr(self.comm_port, "connects", 0) > 1:
+                self.debugLog(u"Transport: connection to %s re-established %d times since startup"
+                              % (self.port_name, self.comm_port.connects - 1))
+            self.communicator.cache.reset_counters()
+            self.poll_scheduler.reset_counters()
+            self.q.reset_metrics()
+
+        self.jobs_run = 0
+        self.jobs_busy_time = 0.0
+        self.last_throughput_report_time = now
+
+    def statistics(self):
+        """Returns the transaction metrics and queue wait times of this bus since startup as a dictionary."""
+        return {'name': self.name, 'port': self.port_name, 'devices': len(self.registry),
+                'transactions': self.communicator.metrics.snapshot(), 'queue_wait_s': self.q.wait_snapshot(),
+                'frames': self.communicator.decoder.snapshot()}
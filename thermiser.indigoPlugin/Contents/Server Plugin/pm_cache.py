@@ -0,0 +1,94 @@
+# -*- coding: utf-8 -*-
+
+#  Per-address cache of the last decoded DCB record of each thermostat, with the time it was read.
+#  Reads within the time-to-live are served from the cache instead of the bus. Acknowledged writes patch
+#  the affected fields of the cached record; fields that can't be patched are marked stale, so only reads
+#  that need them go back to the bus.
+
+import threading
+import time
+
+DEFAULT_TTL = 600.0  # seconds a cached DCB is considered fresh, unless the reader asks for a maximum age
+
+
+class DCBCache(object):
+    """Thread-safe cache of DCB records by address, with hit and miss counters."""
+
+    def __init__(self, ttl=DEFAULT_TTL):
+        self._lock = threading.Lock()
+        self.ttl = ttl
+        self._entries = dict()  # address -> [record, time read, set of stale field names]
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.hits = 0  # reads served from the cache, i.e. bus transactions avoided
+        self.misses = 0
+        self.patches = 0
+
+    def get(self, address, max_age=None, fields=None):
+        """Returns the cached record for address if it is younger than max_age (default: the cache ttl) and
+        none of the given fields are stale, otherwise None."""
+        if max_age is None:
+            max_age = self.ttl
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry is None or time.time() - entry[1] > max_age or (fields and entry[2].intersection(fields)):
+                self.misses = self.misses + 1
+                return None
+            self.hits = self.hits + 1
+            return entry[0]
+
+    def peek(self, address):
+        """Returns a tuple of the cached record (or None) and the time it was read, regardless of its age.
+        Does not count as a hit or miss."""
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry is None:
+                return None, 0
+            return entry[0], entry[1]
+
+    def current(self, address, max_age=None):
+        """Returns a tuple of the cached record for address, the time it was read and the set of its stale field
+        names, if it is younger than max_age (default: the cache ttl); otherwise (None, 0, None).
+        Does not count as a hit or miss."""
+        if max_age is None:
+            max_age = self.ttl
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry is None or time.time() - entry[1] > max_age:
+                return None, 0, None
+            return entry[0], entry[1], set(entry[2])
+
+    def put(self, address, record, timestamp=None):
+        """Stores a freshly read record."""
+        with self._lock:
+            self._entries[address] = [record, timestamp or time.time(), set()]
+
+    def patch(self, address, **fields):
+        """Updates fields of the cached record for address after an acknowledged write, without changing
+        the time it was read. Fields the record doesn't have (e.g. hotWaterOn of a PRT) are left out.
+        Returns False if there is no cached record for address."""
+        with self._lock:
+            entry = self._entries.get(address)
+            if entry is None:
+                return False
+            known = dict((name, value) for name, value in fields.items() if name in entry[0]._fields)
+            entry[0] = entry[0]._replace(**known)
+            entry[2].difference_update(fields)
+            self.patches = self.patches + 1
+            return True
+
+    def invalidate(self, address, fields=None):
+        """Marks the given fields of the cached record for address as stale, or drops the record entirely
+        if no fields are given."""
+        with self._lock:
+            if fields is None:
+                self._entries.pop(address, None)
+            elif address in self._entries:
+                self._entries[address][2].update(fields)
+
+    def report(self):
+        """Returns a string with the cache counters."""
+        with self._lock:
+            return u"%d addresses cached, %d hits (bus reads avoided), %d misses, %d writes patched in" \
+                   % (len(self._entries), self.hits, self.misses, self.patches)
@@ -1,50 +1,95 @@
-class crc(object):
+from itertools import islice
+
+CRC_POLYNOMIAL = 0x1021  # CRC-16/CCITT, initial value 0xFFFF
+
+
+def _make_tables():
+    """Returns two 256-entry tables with the high and low bytes of the CRC contribution of each byte value."""
+    table_hi = []
+    table_lo = []
+    for byte in range(256):
+        value = byte << 8
+        for _ in range(8):
+            if value & 0x8000:
+                value = ((value << 1) ^ CRC_POLYNOMIAL) & 0xFFFF
+            else:
+                value = (value << 1) & 0xFFFF
+        table_hi.append(value >> 8)
+        table_lo.append(value & 0xFF)
+    return table_hi, table_lo
+
+TABLE_HI, TABLE_LO = _make_tables()
+
+# Python 2 memoryviews return 1-byte strings instead of ints when indexed:
+_MEMORYVIEW_ITEMS_ARE_INTS = isinstance(memoryview(b'\x00')[0], int)
 
-    ltH = [0x00, 0x10, 0x20, 0x30, 0x40, 0x50, 0x60, 0x70,0x81, 0x91, 0xa1, 0xb1, 0xc1, 0xd1, 0xe1, 0xf1]
-    ltL = [0x00, 0x21, 0x42, 0x63, 0x84, 0xa5, 0xc6, 0xe7,0x08, 0x29, 0x4a, 0x6b, 0x8c, 0xad, 0xce, 0xef]
 
-    def __init__(self):
-        self.hi = 0XFF
-        self.lo = 0XFF
+def ccitt_crc(data, offset=0, length=None):
+    """Calculates a CCITT CRC over length bytes of data starting at offset, without copying the data.
+    data can be a bytearray, a list of ints or a memoryview. Returns a tuple containing low and high bytes."""
+    if not _MEMORYVIEW_ITEMS_ARE_INTS and isinstance(data, memoryview):
+        data = bytearray(data.tobytes())
+    if length is None:
+        length = len(data) - offset
 
-    def _updateNibble(self, byte):
-        t = self.hi >> 4
-        t = t ^ byte
+    if offset == 0 and length == len(data):
+        view = data
+    elif _MEMORYVIEW_ITEMS_ARE_INTS and not isinstance(data, list):
+        view = memoryview(data)[offset:offset + length]
+    else:
+        view = islice(data, offset, offset + length)
 
-        self.hi = ((self.hi << 4) | (self.lo >> 4)) & 0xFF
-        self.hi = self.hi ^ self.ltH[t]
-        self.hi = self.hi & 0xFF
+    hi = 0xFF
+    lo = 0xFF
+    table_hi = TABLE_HI
+    table_lo = TABLE_LO
+    for byte in view:
+        index = hi ^ byte
+        hi = lo ^ table_hi[index]
+        lo = table_lo[index]
+    return lo, hi
 
-        self.lo = (self.lo << 4) & 0xFF
-        self.lo = self.lo ^ self.ltL[t]
-        self.lo = self.lo & 0xFF
 
-    def ccitt(self, data):
-        """Calculates a CCITT CRC and returns a tuple containing low and high bytes"""
-        self.hi = 0XFF
-        self.lo = 0XFF
-        for byte in data:
-            self._updateNibble(byte>>4)
-            self._updateNibble(byte & 0x0f)
-        return [self.lo, self.hi]
+def verify_ccitt(data, offset=0, length=None):
+    """Returns True if the last two bytes of the length bytes of data starting at offset hold the CCITT CRC
+    of the bytes before them."""
+    if data is None:
+        return False
+    if length is None:
+        length = len(data) - offset
+    if length < 3:
+        return False
+    end = offset + length
+    lo, hi = ccitt_crc(data, offset, length - 2)
+    return data[end - 2] == lo and data[end - 1] == hi
+
+
+class crc(object):
+    """Stateless wrapper around the table driven CCITT CRC functions."""
+
+    def ccitt(self, data, offset=0, length=None):
+        """Calculates a CCITT CRC and returns a list containing low and high bytes"""
+        return list(ccitt_crc(data, offset, length))
 
     def addCCITTtoBytearray(self, data):
         """Calculates CCITT CRC over first (n-2) bytes of the buffer and stores result at end of buffer"""
-        lo, hi = self.ccitt(data[:(len(data)-2)])
+        lo, hi = ccitt_crc(data, 0, len(data) - 2)
         data[len(data)-2] = lo
         data[len(data)-1] = hi
         return data
 
-    def verifyCCITTfromByteArray(self, data):
+    def verifyCCITTfromByteArray(self, data, offset=0, length=None):
         """Calculates CCITT CRC over first (n-2) bytes of data and compares
         with crc stored as last two bytes of data."""
-        if data is None:
-            return False
-        if len(data) < 3:
-            return False
-        lo, hi = self.ccitt(data[:(len(data)-2)])
-
-        if data[len(data)-2] == lo and data[len(data)-1] == hi:
-            return True
-        else:
-            return False
+        return verify_ccitt(data, offset, length)
+
+    def verifyFrames(self, frames):
+        """Verifies a batch of frames in one call. frames is an iterable of buffers or of (buffer, offset, length)
+        tuples; returns a list of booleans in the same order."""
+        results = []
+        for frame in frames:
+            if isinstance(frame, tuple):
+                results.append(verify_ccitt(*frame))
+            else:
+                results.append(verify_ccitt(frame))
+        return results
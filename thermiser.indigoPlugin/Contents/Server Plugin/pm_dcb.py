@@ -0,0 +1,339 @@
+# -*- coding: utf-8 -*-
+
+#  Device Control Block (DCB) layouts for the Heatmiser DT / DT-E / PRT / PRT-E / PRT-HW thermostats.
+#  Each model's layout is declared once as a list of fields, and compiled into a struct.Struct decoder and a
+#  compact record class (a namedtuple, so no per-record dict). Derived values such as model and temperature
+#  names, temperatures in degrees and the schedule tables are only decoded when they are accessed.
+#  The write register table below is used to encode values for write frames.
+
+import struct
+from collections import namedtuple
+
+MODEL_NAMES = ['DT', 'DT-E', 'PRT', 'PRT-E', 'PRT-HW']
+SENSOR_NAMES = ['built-in air only', 'remote air only', 'floor only', 'built-in air + floor', 'remote-air + floor']
+FROST_PROTECTION_NAMES = ['disabled', 'enabled']
+RUN_MODE_NAMES = ['heating', 'frost protection']
+PROGRAM_MODE_NAMES = ['5/2 mode', '7 day mode']
+UNKNOWN_NAME = '(unknown)'
+
+MODEL_DT = 0
+MODEL_DT_E = 1
+MODEL_PRT = 2
+MODEL_PRT_E = 3
+MODEL_PRT_HW = 4
+
+DCB_OFFSET = 9  # offset of the DCB in a read reply, after destination, length, source, function, start and count
+TEMPERATURE_NOT_CONNECTED = 0xFFFF  # sensor reading reported for a sensor that is not fitted
+
+# Fields present in the DCB of all models: (name, offset in DCB, struct format). Multi-byte values are
+# stored high byte first. Temperatures are stored in tenths of a degree.
+COMMON_FIELDS = [
+    ('dcbLen', 0, 'H'),
+    ('vendorID', 2, 'B'),
+    ('versionByte', 3, 'B'),  # software version in the low 7 bits, floor limit state in the top bit
+    ('modelID', 4, 'B'),
+    ('temperatureFormatCode', 5, 'B'),
+    ('switchDifferential', 6, 'B'),
+    ('frostProtectionCode', 7, 'B'),
+    ('calibrationOffset', 8, 'H'),
+    ('outputDelay', 10, 'B'),
+    ('address', 11, 'B'),
+    ('upDownKeyLimit', 12, 'B'),
+    ('sensorSelectionCode', 13, 'B'),
+    ('optimumStart', 14, 'B'),
+    ('rateOfChange', 15, 'B'),
+    ('programModeCode', 16, 'B'),
+    ('frostProtectTemp', 17, 'B'),
+    ('setRoomTemp', 18, 'B'),
+    ('floorMaxLimit', 19, 'B'),
+    ('floorMaxLimitEnable', 20, 'B'),
+    ('On', 21, 'B'),
+    ('keyLock', 22, 'B'),
+    ('runModeCode', 23, 'B'),
+    ('holidayHours', 24, 'H'),
+    ('tempHoldMinutes', 26, 'H'),
+    ('remoteAirTempRaw', 28, 'H'),
+    ('floorTempRaw', 30, 'H'),
+    ('airTempRaw', 32, 'H'),
+    ('errorCode', 34, 'B'),
+    ('heatingOn', 35, 'B'),
+]
+
+
+CLOCK_FIELD_NAMES = ('weekDayNumber', 'timeHour', 'timeMinute', 'timeSecond')
+
+
+def _clock_fields(offset):
+    return [('weekDayNumber', offset, 'B'), ('timeHour', offset + 1, 'B'),
+            ('timeMinute', offset + 2, 'B'), ('timeSecond', offset + 3, 'B')]
+
+# Schedule tables: (name, offset in DCB, number of periods, bytes per period). Heating periods are
+# (hour, minute, temperature), hot water periods are (on hour, on minute, off hour, off minute).
+# The 7-day tables hold 7 consecutive day tables, starting on Monday. Unused periods have hour 24.
+HEATING_PERIODS = 4
+HEATING_PERIOD_SIZE = 3
+HOT_WATER_PERIODS = 4
+HOT_WATER_PERIOD_SIZE = 4
+HEATING_DAY_SIZE = HEATING_PERIODS * HEATING_PERIOD_SIZE
+HOT_WATER_DAY_SIZE = HOT_WATER_PERIODS * HOT_WATER_PERIOD_SIZE
+
+# Write registers: name -> (register address, struct format). Note that register addresses are not the same
+# as DCB offsets. The 7-day tables are written per day, e.g. sevenDaySchedule1 (Monday) to sevenDaySchedule7.
+WRITE_REGISTERS = {
+    'frostProtectTemp': (17, 'B'),
+    'setRoomTemp': (18, 'B'),
+    'floorMaxLimit': (19, 'B'),
+    'On': (21, 'B'),
+    'keyLock': (22, 'B'),
+    'runModeCode': (23, 'B'),
+    'holidayHours': (24, 'H'),
+    'tempHoldMinutes': (32, 'H'),
+    'hotWaterOn': (42, 'B'),
+    'clock': (43, '4B'),  # week day (1 = Monday), hour, minute, second
+    'weekdaySchedule': (47, '%dB' % HEATING_DAY_SIZE),
+    'weekendSchedule': (59, '%dB' % HEATING_DAY_SIZE),
+    'weekdayHotWater': (71, '%dB' % HOT_WATER_DAY_SIZE),
+    'weekendHotWater': (87, '%dB' % HOT_WATER_DAY_SIZE),
+}
+SCHEDULE_NAMES = ('weekdaySchedule', 'weekendSchedule', 'weekdayHotWater', 'weekendHotWater', 'sevenDaySchedule',
+                  'sevenDayHotWater')
+# schedule write register -> (schedule table, offset of its bytes in the table):
+SCHEDULE_REGISTERS = dict((name, (name, 0)) for name in SCHEDULE_NAMES[:4])
+for _day in range(7):
+    WRITE_REGISTERS['sevenDaySchedule%d' % (_day + 1)] = (103 + _day * HEATING_DAY_SIZE, '%dB' % HEATING_DAY_SIZE)
+    WRITE_REGISTERS['sevenDayHotWater%d' % (_day + 1)] = (187 + _day * HOT_WATER_DAY_SIZE,
+                                                          '%dB' % HOT_WATER_DAY_SIZE)
+    SCHEDULE_REGISTERS['sevenDaySchedule%d' % (_day + 1)] = ('sevenDaySchedule', _day * HEATING_DAY_SIZE)
+    SCHEDULE_REGISTERS['sevenDayHotWater%d' % (_day + 1)] = ('sevenDayHotWater', _day * HOT_WATER_DAY_SIZE)
+
+
+class DCB(object):
+    """Base class of the compiled DCB record classes. Fields that a model does not have read as None.
+    Only the raw field values are stored; everything else is derived on access."""
+    __slots__ = ()
+
+    hotWaterOn = None
+    weekDayNumber = None
+    timeHour = None
+    timeMinute = None
+    timeSecond = None
+    layout = None  # set on each compiled record class
+
+    @staticmethod
+    def _name(names, code):
+        if 0 <= code < len(names):
+            return names[code]
+        return UNKNOWN_NAME
+
+    @staticmethod
+    def _degrees(raw):
+        if raw == TEMPERATURE_NOT_CONNECTED:
+            return None
+        return raw // 10
+
+    @property
+    def vendor(self):
+        return 'Heatmiser' if self.vendorID == 0 else 'o.e.m.'
+
+    @property
+    def softwareVersion(self):
+        return self.versionByte & 0x7f
+
+    @property
+    def floorLimitState(self):
+        return self.versionByte >> 7
+
+    @property
+    def model(self):
+        return self._name(MODEL_NAMES, self.modelID)
+
+    @property
+    def temperatureFormat(self):
+        return 'C' if self.temperatureFormatCode == 0 else 'F'
+
+    @property
+    def frostProtection(self):
+        return self._name(FROST_PROTECTION_NAMES, self.frostProtectionCode)
+
+    @property
+    def sensor(self):
+        return self._name(SENSOR_NAMES, self.sensorSelectionCode)
+
+    @property
+    def programMode(self):
+        return self._name(PROGRAM_MODE_NAMES, self.programModeCode)
+
+    @property
+    def runMode(self):
+        return self._name(RUN_MODE_NAMES, self.runModeCode)
+
+    @property
+    def remoteAirTemp(self):
+        return self._degrees(self.remoteAirTempRaw)
+
+    @property
+    def floorTemp(self):
+        return self._degrees(self.floorTempRaw)
+
+    @property
+    def airTemp(self):
+        return self._degrees(self.airTempRaw)
+
+    def _table(self, name):
+        """Returns the raw bytes of a schedule table, or None if the model or the DCB does not contain it."""
+        if name not in self.layout.schedules:
+            return None
+        offset, size = self.layout.schedules[name]
+        if offset + size > self.dcbLen or DCB_OFFSET + offset + size > len(self.raw):
+            return None
+        start = DCB_OFFSET + offset
+        return self.raw[start:start + size]
+
+    def _periods(self, name, period_size):
+        table = self._table(name)
+        if table is None:
+            return None
+        return [tuple(table[i:i + period_size]) for i in range(0, len(table), period_size)]
+
+    @property
+    def weekdaySchedule(self):
+        """List of (hour, minute, temperature) heating periods for weekdays (5/2 mode)"""
+        return self._periods('weekdaySchedule', HEATING_PERIOD_SIZE)
+
+    @property
+    def weekendSchedule(self):
+        """List of (hour, minute, temperature) heating periods for weekends (5/2 mode)"""
+        return self._periods('weekendSchedule', HEATING_PERIOD_SIZE)
+
+    @property
+    def weekdayHotWater(self):
+        """List of (on hour, on minute, off hour, off minute) hot water periods for weekdays (5/2 mode)"""
+        return self._periods('weekdayHotWater', HOT_WATER_PERIOD_SIZE)
+
+    @property
+    def weekendHotWater(self):
+        """List of (on hour, on minute, off hour, off minute) hot water periods for weekends (5/2 mode)"""
+        return self._periods('weekendHotWater', HOT_WATER_PERIOD_SIZE)
+
+    @property
+    def sevenDaySchedule(self):
+        """List of 7 lists (Monday first) of (hour, minute, temperature) heating periods (7 day mode)"""
+        periods = self._periods('sevenDaySchedule', HEATING_PERIOD_SIZE)
+        if periods is None:
+            return None
+        return [periods[day * HEATING_PERIODS:(day + 1) * HEATING_PERIODS] for day in range(7)]
+
+    @property
+    def sevenDayHotWater(self):
+        """List of 7 lists (Monday first) of hot water periods (7 day mode)"""
+        periods = self._periods('sevenDayHotWater', HOT_WATER_PERIOD_SIZE)
+        if periods is None:
+            return None
+        return [periods[day * HOT_WATER_PERIODS:(day + 1) * HOT_WATER_PERIODS] for day in range(7)]
+
+    def schedule_register(self, name):
+        """Returns the raw bytes of schedule write register name (e.g. sevenDaySchedule3) as currently stored in
+        the DCB, or None if the model or the DCB does not contain its table."""
+        table_name, start = SCHEDULE_REGISTERS[name]
+        table = self._table(table_name)
+        if table is None:
+            return None
+        return table[start:start + struct.calcsize('>' + WRITE_REGISTERS[name][1])]
+
+    def as_dict(self):
+        """Returns the decoded fields (raw and derived, without the schedule tables) as a dictionary."""
+        result = dict(zip(self._fields, self))
+        del result['raw']
+        for name in ('vendor', 'softwareVersion', 'floorLimitState', 'model', 'temperatureFormat',
+                     'frostProtection', 'sensor', 'programMode', 'runMode', 'remoteAirTemp', 'floorTemp', 'airTemp'):
+            result[name] = getattr(self, name)
+        return result
+
+
+class DCBLayout(object):
+    """The DCB layout of one model family, compiled into a struct decoder and a record class."""
+
+    def __init__(self, name, fields, schedules):
+        self.name = name
+        self.fields = sorted(fields, key=lambda field: field[1])
+        self.schedules = dict((table, (offset, size)) for table, offset, size in schedules)
+        # schedule registers are writable if the model has their table:
+        self.writable = set(name for name in WRITE_REGISTERS
+                            if name not in SCHEDULE_REGISTERS or SCHEDULE_REGISTERS[name][0] in self.schedules)
+        if not any(field[0] == 'hotWaterOn' for field in fields):
+            self.writable.discard('hotWaterOn')
+        if 'weekdaySchedule' not in self.schedules:
+            self.writable.discard('clock')
+
+        # compile the fields into a single big-endian struct, with pad bytes for offsets we don't decode:
+        format_string = '>'
+        position = 0
+        for field_name, offset, field_format in self.fields:
+            if offset > position:
+                format_string = format_string + '%dx' % (offset - position)
+            format_string = format_string + field_format
+            position = offset + struct.calcsize('>' + field_format)
+        self.struct = struct.Struct(format_string)
+        self.size = self.struct.size  # DCB bytes needed to decode all scalar fields
+
+        names = [field[0] for field in self.fields] + ['raw']
+        self.record_class = type('DCB_' + name.replace('-', '_'), (namedtuple('_DCBFields_' + name.replace('-', '_'), names), DCB),
+                                 {'__slots__': (), 'layout': self})
+
+    def decode(self, frame):
+        """Decodes a read reply frame. Returns a record, or None if the frame is too short for this layout."""
+        if len(frame) < DCB_OFFSET + self.size:
+            return None
+        # tuple.__new__ skips the keyword handling of the namedtuple constructor:
+        return tuple.__new__(self.record_class, self.struct.unpack_from(frame, DCB_OFFSET) + (frame,))
+
+    def encode(self, values, dcb_length=None):
+        """Encodes a dictionary of raw field values (missing fields are 0) into a DCB bytearray."""
+        dcb = bytearray(dcb_length or self.size)
+        self.struct.pack_into(dcb, 0, *[values.get(field[0], 0) for field in self.fields])
+        return dcb
+
+
+DT_LAYOUT = DCBLayout('DT', COMMON_FIELDS, [])
+PRT_LAYOUT = DCBLayout('PRT', COMMON_FIELDS + _clock_fields(36), [
+    ('weekdaySchedule', 40, HEATING_DAY_SIZE),
+    ('weekendSchedule', 52, HEATING_DAY_SIZE),
+    ('sevenDaySchedule', 64, 7 * HEATING_DAY_SIZE),
+])
+# PRT-HW has an extra byte in the DCB for hot water, so after this everything shifts by one byte.
+PRT_HW_LAYOUT = DCBLayout('PRT-HW', COMMON_FIELDS + [('hotWaterOn', 36, 'B')] + _clock_fields(37), [
+    ('weekdaySchedule', 41, HEATING_DAY_SIZE),
+    ('weekendSchedule', 53, HEATING_DAY_SIZE),
+    ('weekdayHotWater', 65, HOT_WATER_DAY_SIZE),
+    ('weekendHotWater', 81, HOT_WATER_DAY_SIZE),
+    ('sevenDaySchedule', 97, 7 * HEATING_DAY_SIZE),
+    ('sevenDayHotWater', 181, 7 * HOT_WATER_DAY_SIZE),
+])
+LAYOUTS = {MODEL_DT: DT_LAYOUT, MODEL_DT_E: DT_LAYOUT, MODEL_PRT: PRT_LAYOUT, MODEL_PRT_E: PRT_LAYOUT,
+           MODEL_PRT_HW: PRT_HW_LAYOUT}
+
+
+def layout_for_model(model_id):
+    """Returns the layout for a model ID. Unknown models are decoded as PRT."""
+    return LAYOUTS.get(model_id, PRT_LAYOUT)
+
+
+def model_name(model_id):
+    """Returns the name of a model ID."""
+    return DCB._name(MODEL_NAMES, model_id)
+
+
+def decode_dcb(frame):
+    """Decodes a full DCB read reply frame into a record, or returns None if the frame is too short."""
+    if len(frame) < DCB_OFFSET + 5:
+        return None
+    return layout_for_model(frame[DCB_OFFSET + 4]).decode(frame)
+
+
+def encode_field(name, value):
+    """Encodes a value for a write register. Returns a tuple of register address and payload bytearray.
+    value is a number, or a sequence of numbers for multi-byte registers such as the clock and schedules."""
+    register, field_format = WRITE_REGISTERS[name]
+    if isinstance(value, (list, tuple, bytearray)):
+        return register, bytearray(struct.pack('>' + field_format, *value))
+    return register, bytearray(struct.pack('>' + field_format, value))
@@ -0,0 +1,109 @@
+# -*- coding: utf-8 -*-
+
+#  Incremental decoder of reply frames from the bus. Received bytes go into a rolling buffer, which is scanned for
+#  a plausible frame header: the master address followed by a frame length within the reply size limits. A frame
+#  is returned once its CRC checks out, so bytes around it, such as line noise, the echo of the request on
+#  half-duplex adapters or the rest of an earlier reply, only cost the bytes themselves instead of the whole
+#  transaction. Bytes that can no longer be the start of a valid frame are discarded; a frame found after discarded
+#  bytes counts as a resync.
+
+from pm_crc import *
+
+MASTER_ADDRESS = 0x81  # address of 'master' unit, i.e. this computer, and the first byte of each reply
+REPLY_HEADER_SIZE = 3  # destination followed by two frame length bytes (low byte first)
+MIN_REPLY_SIZE = 7  # a write acknowledgement: header, source address, function and CRC
+MAX_REPLY_SIZE = 320  # the largest reply is a PRT-HW DCB in 7 day mode: 9 header + 293 DCB + 2 CRC bytes
+_HEADER_BYTE = bytearray([MASTER_ADDRESS])
+
+
+class FrameDecoder(object):
+    """Finds valid reply frames in the bytes fed to it, with counters of the bytes it had to skip."""
+
+    def __init__(self):
+        self.buffer = bytearray()
+        self.wanted = REPLY_HEADER_SIZE  # bytes needed to complete the nearest candidate frame
+        self._rejected = set()  # buffer positions of candidate frames that were already counted as rejected
+        self._skipped = 0  # bytes discarded since the last frame
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.frames = 0
+        self.resyncs = 0  # frames found after discarding bytes in front of them
+        self.bytes_discarded = 0
+        self.crc_rejects = 0  # complete candidate frames with a plausible header but an incorrect CRC
+        self.foreign_frames = 0  # valid frames from another device than the one asked, e.g. late replies
+
+    def feed(self, data):
+        self.buffer.extend(bytearray(data))
+
+    def clear(self):
+        """Discards everything in the buffer, e.g. before a new request."""
+        self._discard(len(self.buffer))
+        self._skipped = 0
+
+    def _discard(self, count):
+        del self.buffer[:count]
+        self._rejected = set(position - count for position in self._rejected if position >= count)
+        self.bytes_discarded = self.bytes_discarded + count
+        self._skipped = self._skipped + count
+
+    def _reject(self, position):
+        """Returns True the first time the candidate frame at position is rejected."""
+        if position in self._rejected:
+            return False
+        self._rejected.add(position)
+        return True
+
+    def next_frame(self, source=None):
+        """Returns the next valid frame in the buffer (from the device at address source, if given) and removes
+        it and the bytes before it, or returns None if there is no complete valid frame yet. Bytes before the
+        first candidate frame that may still complete are discarded, and wanted is set to the number of bytes
+        needed to complete the nearest candidate."""
+        buffer = self.buffer
+        keep = len(buffer)  # position of the first candidate that may still complete
+        wanted = None
+        position = buffer.find(_HEADER_BYTE)
+        while position >= 0:
+            needed = None
+            available = len(buffer) - position
+            if available < REPLY_HEADER_SIZE:
+                needed = REPLY_HEADER_SIZE - available
+            else:
+                length = buffer[position + 1] + buffer[position + 2] * 256
+                if MIN_REPLY_SIZE <= length <= MAX_REPLY_SIZE:
+                    if available < length:
+                        needed = length - available
+                    elif not verify_ccitt(buffer, position, length):
+                        if self._reject(position):
+                            self.crc_rejects = self.crc_rejects + 1
+                    elif source is not None and buffer[position + 3] != source:
+                        if self._reject(position):
+                            self.foreign_frames = self.foreign_frames + 1
+                    else:
+                        frame = buffer[position:position + length]
+                        self._discard(position)
+                        del buffer[:length]
+                        self._rejected = set(rejected - length for rejected in self._rejected if rejected >= length)
+                        if self._skipped:
+                            self.resyncs = self.resyncs + 1
+                            self._skipped = 0
+                        self.frames = self.frames + 1
+                        self.wanted = REPLY_HEADER_SIZE
+                        return frame
+            if needed is not None:
+                keep = min(keep, position)
+                wanted = needed if wanted is None else min(wanted, needed)
+            position = buffer.find(_HEADER_BYTE, position + 1)
+        if keep:
+            self._discard(keep)
+        self.wanted = wanted or REPLY_HEADER_SIZE
+        return None
+
+    def snapshot(self):
+        return {'frames': self.frames, 'resyncs': self.resyncs, 'bytes_discarded': self.bytes_discarded,
+                'crc_rejects': self.crc_rejects, 'foreign_frames': self.foreign_frames}
+
+    def report(self):
+        """Returns a string with the decoder counters."""
+        return u"%d frames, %d resyncs (%d bytes discarded), %d CRC rejects, %d frames from other devices" \
+               % (self.frames, self.resyncs, self.bytes_discarded, self.crc_rejects, self.foreign_frames)
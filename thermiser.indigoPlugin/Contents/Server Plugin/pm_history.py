@@ -0,0 +1,226 @@
+# -*- coding: utf-8 -*-
+
+#  Temperature history of the thermostats on a bus, kept in a memory-mapped file so that it survives restarts and
+#  opens without reading anything. Each address (zone) has a ring of one-minute slots; the time of a sample is
+#  implied by its slot, so a sample takes 4 bytes: the air temperature in tenths of a degree, the set temperature
+#  and a byte of flags (heating on, hot water on). The slots of a zone are stored as three typed columns, so a
+#  range query converts a block of the file to arrays in one go.
+#  A year of samples for 32 zones takes 32 x 525600 x 4 bytes = 67 MB. That is the size of the history of all buses
+#  together: with more buses, each bus file holds a proportionally shorter history (see history_minutes), and a file
+#  of another size is converted when it is opened. Files are created sparse, so disk space is only used as zones
+#  are recorded.
+
+import mmap
+import os
+import struct
+import sys
+import threading
+from array import array
+from pm_dcb import *
+
+HISTORY_MAGIC = b'THMHIST1'
+HISTORY_ZONES = 32  # zones per file: the addresses 1..32 of one bus
+HISTORY_MINUTES = 365 * 24 * 60  # slots per zone of all buses together, i.e. a year of one-minute samples
+SAMPLE_SIZE = 4  # bytes per slot: air temperature (2), set temperature (1) and flags (1)
+HEADER_SIZE = 4096  # magic, zone count and capacity, followed by the last recorded minute of each zone
+_HEADER = struct.Struct('<8sII')
+_LAST_MINUTE = struct.Struct('<q')
+NO_SAMPLE = -1  # last recorded minute of a zone without samples
+# flags:
+FLAG_SAMPLE = 0x80  # the slot holds a sample
+FLAG_HEATING_ON = 0x01
+FLAG_HOT_WATER_ON = 0x02
+
+
+def history_minutes(buses):
+    """Returns the number of slots per zone of the history file of each of buses buses, so that the files
+    together hold HISTORY_MINUTES per zone."""
+    return HISTORY_MINUTES // max(1, buses)
+
+
+def _bytes(values):
+    """Returns the little-endian bytes of an array, for writing to the file."""
+    if sys.byteorder == 'big' and values.itemsize > 1:
+        values = array(values.typecode, values)
+        values.byteswap()
+    if hasattr(values, 'tobytes'):
+        return values.tobytes()
+    return values.tostring()
+
+
+def _array(typecode, data):
+    """Returns an array of little-endian values decoded from a block of the file."""
+    values = array(typecode)
+    if hasattr(values, 'frombytes'):
+        values.frombytes(data)
+    else:
+        values.fromstring(data)
+    if sys.byteorder == 'big' and values.itemsize > 1:
+        values.byteswap()
+    return values
+
+
+class TemperatureHistory(object):
+    """Ring buffers of one-minute samples per address, in a memory-mapped file that is created if it doesn't
+    exist. The number of zones and slots are taken from an existing file."""
+
+    def __init__(self, path, zones=HISTORY_ZONES, minutes=HISTORY_MINUTES):
+        self.path = path
+        self._lock = threading.Lock()
+        exists = os.path.exists(path) and os.path.getsize(path) >= HEADER_SIZE
+        self._file = open(path, 'r+b' if exists else 'w+b')
+        if exists:
+            magic, zones, minutes = _HEADER.unpack(self._file.read(_HEADER.size))
+            if magic != HISTORY_MAGIC or os.path.getsize(path) != HEADER_SIZE + zones * minutes * SAMPLE_SIZE:
+                self._file.close()
+                raise ValueError(u"%s is not a temperature history file" % path)
+        else:
+            # truncate extends the file with zeroes, i.e. empty slots, without writing them:
+            self._file.truncate(HEADER_SIZE + zones * minutes * SAMPLE_SIZE)
+        self.zones = zones
+        self.minutes = minutes
+        self._map = mmap.mmap(self._file.fileno(), 0)
+        if not exists:
+            self._map[0:_HEADER.size] = _HEADER.pack(HISTORY_MAGIC, zones, minutes)
+            for zone in range(zones):
+                self._set_last_minute(zone, NO_SAMPLE)
+
+    def close(self):
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+                self._map.close()
+                self._file.close()
+                self._map = None
+
+    def flush(self):
+        """Writes recorded samples to disk. The operating system does this by itself, even if the plugin
+        crashes; this only makes sure it has happened."""
+        with self._lock:
+            if self._map is not None:
+                self._map.flush()
+
+    def _last_minute(self, zone):
+        return _LAST_MINUTE.unpack_from(self._map, _HEADER.size + zone * _LAST_MINUTE.size)[0]
+
+    def _set_last_minute(self, zone, minute):
+        _LAST_MINUTE.pack_into(self._map, _HEADER.size + zone * _LAST_MINUTE.size, minute)
+
+    def _column(self, zone, column):
+        """Returns the file offset of column 0 (air temperatures), 1 (set temperatures) or 2 (flags) of zone."""
+        return HEADER_SIZE + zone * self.minutes * SAMPLE_SIZE + (0, 2, 3)[column] * self.minutes
+
+    def _clear(self, zone, first, last):
+        """Empties the slots of minutes first..last of zone (at most a full ring)."""
+        flags = self._column(zone, 2)
+        first = max(first, last - self.minutes + 1)
+        while first <= last:
+            index = first % self.minutes
+            count = min(last - first + 1, self.minutes - index)
+            self._map[flags + index:flags + index + count] = b'\x00' * count
+            first = first + count
+
+    def record(self, address, timestamp, air_temp_raw, set_temp, heating_on, hot_water_on=None):
+        """Records a sample for address (1..zones) at timestamp (seconds since the epoch), replacing an earlier
+        sample in the same minute. air_temp_raw is in tenths of a degree, as in the DCB. Samples older than the
+        last one recorded for address are ignored. Returns False if the sample was not recorded."""
+        zone = address - 1
+        if not 0 <= zone < self.zones:
+            return False
+        minute = int(timestamp // 60)
+        flags = FLAG_SAMPLE
+        if heating_on:
+            flags = flags | FLAG_HEATING_ON
+        if hot_water_on:
+            flags = flags | FLAG_HOT_WATER_ON
+        with self._lock:
+            if self._map is None:
+                return False
+            last = self._last_minute(zone)
+            if minute < last:
+                return False
+            if last != NO_SAMPLE and minute > last + 1:
+                # minutes without a poll since the last sample:
+                self._clear(zone, last + 1, minute - 1)
+            index = minute % self.minutes
+            struct.pack_into('<H', self._map, self._column(zone, 0) + 2 * index, air_temp_raw & 0xFFFF)
+            struct.pack_into('B', self._map, self._column(zone, 1) + index, set_temp & 0xFF)
+            struct.pack_into('B', self._map, self._column(zone, 2) + index, flags)
+            self._set_last_minute(zone, minute)
+        return True
+
+    def _write_columns(self, zone, first, columns):
+        """Writes arrays of the air temperatures, set temperatures and flags of minutes first onwards of zone."""
+        done = 0
+        total = len(columns[2])
+        while done < total:
+            index = (first + done) % self.minutes
+            count = min(total - done, self.minutes - index)
+            for column, values in enumerate(columns):
+                size = values.itemsize
+                offset = self._column(zone, column) + size * index
+                self._map[offset:offset + size * count] = _bytes(values[done:done + count])
+            done = done + count
+
+    def resized(self, minutes):
+        """Converts the file to minutes slots per zone, keeping the most recent samples of each zone, and returns
+        the history of the converted file. This history is closed."""
+        new_path = self.path + '.new'
+        if os.path.exists(new_path):
+            os.remove(new_path)
+        resized = TemperatureHistory(new_path, self.zones, minutes)
+        with self._lock:
+            for zone in range(self.zones):
+                last = self._last_minute(zone)
+                if last == NO_SAMPLE:
+                    continue
+                first = last - min(self.minutes, minutes) + 1
+                resized._write_columns(zone, first, self._columns(zone, first, last))
+                resized._set_last_minute(zone, last)
+        resized.close()
+        self.close()
+        os.rename(new_path, self.path)
+        return TemperatureHistory(self.path)
+
+    def _columns(self, zone, first, last):
+        """Returns arrays of the air temperatures, set temperatures and flags of minutes first..last of zone."""
+        columns = [array('H'), array('B'), array('B')]
+        while first <= last:
+            index = first % self.minutes
+            count = min(last - first + 1, self.minutes - index)
+            for column, typecode in enumerate('HBB'):
+                size = array(typecode).itemsize
+                offset = self._column(zone, column) + size * index
+                columns[column].extend(_array(typecode, self._map[offset:offset + size * count]))
+            first = first + count
+        return columns
+
+    def query(self, address, start, end):
+        """Returns the samples of address from start up to and including end (seconds since the epoch) as a list of
+        (time, air temperature in degrees or None, set temperature, heating on, hot water on) tuples, oldest
+        first. The time is the start of the minute of the sample."""
+        zone = address - 1
+        if not 0 <= zone < self.zones:
+            return []
+        with self._lock:
+            if self._map is None:
+                return []
+            last = self._last_minute(zone)
+            if last == NO_SAMPLE:
+                return []
+            first = max(int(start // 60), last - self.minutes + 1)
+            end_minute = min(int(end // 60), last)
+            if first > end_minute:
+                return []
+            air_temps, set_temps, flags = self._columns(zone, first, end_minute)
+        samples = []
+        for offset, sample_flags in enumerate(flags):
+            if sample_flags & FLAG_SAMPLE:
+                air_temp = air_temps[offset]
+                if air_temp == TEMPERATURE_NOT_CONNECTED:
+                    air_temp = None
+                else:
+                    air_temp = air_temp / 10.0
+                samples.append(((first + offset) * 60, air_temp, set_temps[offset],
+                                bool(sample_flags & FLAG_HEATING_ON), bool(sample_flags & FLAG_HOT_WATER_ON)))
+        return samples
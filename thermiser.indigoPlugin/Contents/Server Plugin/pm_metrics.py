@@ -0,0 +1,204 @@
+# -*- coding: utf-8 -*-
+
+#  Transaction metrics of a bus: round-trip latency histograms and outcome counters per address and operation.
+#  All counters live in arrays that are allocated up front, so recording a transaction only increments a few
+#  array elements. Metrics are cumulative since startup; reports, the statistics file and the Indigo variables
+#  are derived from them on demand.
+
+import bisect
+import threading
+import time
+from array import array
+
+# operations, i.e. the reason a transaction was sent:
+OP_POLL = 0
+OP_SET_TEMP = 1
+OP_SET_HW = 2
+OP_CLOCK_SYNC = 3
+OP_PROBE = 4
+OP_SCHEDULE = 5
+OPERATION_NAMES = ['poll', 'set_temp', 'set_hw', 'clock_sync', 'probe', 'schedule']
+# outcome of a transaction, as counted per address and operation:
+OUTCOME_OK = 0
+OUTCOME_TIMEOUT = 1  # no reply at all
+OUTCOME_CRC_ERROR = 2  # a complete reply with an incorrect CRC
+OUTCOME_FRAME_ERROR = 3  # a reply with an invalid header, or one that stopped halfway
+# counters kept per address and operation, besides the outcomes:
+COUNTER_UNEXPECTED = 4  # valid frames that did not answer the request, e.g. an acknowledgement from another address
+COUNTER_RETRIES = 5  # transactions re-queued by the plugin after a failure
+COUNTER_NAMES = ['ok', 'timeouts', 'crc_errors', 'frame_errors', 'unexpected', 'retries']
+MAX_ADDRESS = 32  # metrics of higher addresses are counted under address 0
+# upper bounds (milliseconds) of the latency histogram buckets; the last bucket counts everything slower.
+# A full PRT-HW DCB takes about 650 ms at 4800 baud, a timeout 500 ms.
+LATENCY_BOUNDS_MS = (25, 50, 100, 150, 200, 300, 400, 500, 600, 750, 1000, 1500)
+# upper bounds (seconds) of the queue wait histogram buckets:
+WAIT_BOUNDS_S = (0.1, 0.5, 1, 2, 5, 10, 30, 60, 120, 300)
+
+
+class Histogram(object):
+    """Counts of values in fixed buckets, plus their number, sum and maximum."""
+
+    def __init__(self, bounds):
+        self.bounds = bounds
+        self.counts = array('L', [0] * (len(bounds) + 1))
+        self.count = 0
+        self.total = 0.0
+        self.maximum = 0.0
+
+    def record(self, value):
+        self.counts[bisect.bisect_left(self.bounds, value)] += 1
+        self.count = self.count + 1
+        self.total = self.total + value
+        if value > self.maximum:
+            self.maximum = value
+
+    def average(self):
+        return self.total / self.count if self.count else 0.0
+
+    def percentile(self, fraction):
+        """Returns the upper bound of the bucket that holds the given fraction of the values (the maximum for
+        the last bucket), or 0 if there are none."""
+        if not self.count:
+            return 0.0
+        needed = fraction * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen = seen + count
+            if seen >= needed:
+                break
+        if bucket < len(self.bounds):
+            return min(self.bounds[bucket], self.maximum)
+        return self.maximum
+
+    def merge(self, other):
+        """Adds the values of another histogram with the same bounds."""
+        for bucket, count in enumerate(other.counts):
+            self.counts[bucket] += count
+        self.count = self.count + other.count
+        self.total = self.total + other.total
+        self.maximum = max(self.maximum, other.maximum)
+
+    def as_dict(self):
+        return {'count': self.count, 'average': self.average(), 'p50': self.percentile(0.5),
+                'p95': self.percentile(0.95), 'max': self.maximum, 'bounds': list(self.bounds),
+                'counts': list(self.counts)}
+
+
+class TransactionMetrics(object):
+    """Latency histograms (milliseconds) and counters per address and operation, and the total time the bus
+    spent on transactions."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        slots = (MAX_ADDRESS + 1) * len(OPERATION_NAMES)
+        self._latency = [Histogram(LATENCY_BOUNDS_MS) for _ in range(slots)]
+        self._counters = array('L', [0] * (slots * len(COUNTER_NAMES)))
+        # number of and seconds spent in successful transactions that answered the request, e.g. writes that were
+        # acknowledged:
+        self._answered = array('L', [0] * slots)
+        self._answered_time = array('d', [0.0] * slots)
+        self.start_time = time.time()
+        self.busy_time = 0.0  # seconds spent in transactions
+
+    @staticmethod
+    def _slot(address, operation):
+        if not 0 < address <= MAX_ADDRESS:
+            address = 0
+        return address * len(OPERATION_NAMES) + operation
+
+    def record(self, address, operation, elapsed, outcome, answered=True):
+        """Records a transaction with address that took elapsed seconds and had one of the OUTCOME_ results.
+        answered is False for a valid reply that did not answer the request, e.g. a write that was not properly
+        acknowledged."""
+        slot = self._slot(address, operation)
+        with self._lock:
+            self._latency[slot].record(elapsed * 1000)
+            self._counters[slot * len(COUNTER_NAMES) + outcome] += 1
+            if outcome == OUTCOME_OK and answered:
+                self._answered[slot] += 1
+                self._answered_time[slot] += elapsed
+            self.busy_time = self.busy_time + elapsed
+
+    def count(self, address, operation, counter):
+        """Increments one of the counters (e.g. COUNTER_RETRIES) for address and operation."""
+        slot = self._slot(address, operation)
+        with self._lock:
+            self._counters[slot * len(COUNTER_NAMES) + counter] += 1
+
+    def average_latency(self, address, operation):
+        """Returns the average round trip time in seconds of successful transactions with address for operation
+        that answered the request, or None if there have been none. Timeouts and errors are left out, as they take
+        as long as the timeout instead of the reply, and so are unconfirmed writes."""
+        slot = self._slot(address, operation)
+        with self._lock:
+            answered = self._answered[slot]
+            if not answered:
+                return None
+            return self._answered_time[slot] / answered
+
+    def utilization(self):
+        """Returns the fraction of the time since startup the bus spent on transactions."""
+        elapsed = time.time() - self.start_time
+        return self.busy_time / elapsed if elapsed > 0 else 0.0
+
+    def _slot_dict(self, slot):
+        counters = self._counters[slot * len(COUNTER_NAMES):(slot + 1) * len(COUNTER_NAMES)]
+        result = dict(zip(COUNTER_NAMES, counters))
+        result['latency_ms'] = self._latency[slot].as_dict()
+        return result
+
+    def _totals(self, slots):
+        """Returns the latency histogram and counters summed over slots. Must be called with the lock held."""
+        latency = Histogram(LATENCY_BOUNDS_MS)
+        counters = [0] * len(COUNTER_NAMES)
+        for slot in slots:
+            latency.merge(self._latency[slot])
+            for counter in range(len(COUNTER_NAMES)):
+                counters[counter] = counters[counter] + self._counters[slot * len(COUNTER_NAMES) + counter]
+        return latency, counters
+
+    def snapshot(self):
+        """Returns all metrics as a dictionary: totals per operation and, for each address that had
+        transactions, the metrics per operation."""
+        operations = range(len(OPERATION_NAMES))
+        with self._lock:
+            result = {'since': self.start_time, 'busy_time': self.busy_time, 'utilization': self.utilization(),
+                      'operations': {}, 'addresses': {}}
+            for operation in operations:
+                latency, counters = self._totals(self._slot(address, operation) for address in range(MAX_ADDRESS + 1))
+                if latency.count:
+                    totals = dict(zip(COUNTER_NAMES, counters))
+                    totals['latency_ms'] = latency.as_dict()
+                    result['operations'][OPERATION_NAMES[operation]] = totals
+            for address in range(MAX_ADDRESS + 1):
+                per_address = dict((OPERATION_NAMES[operation], self._slot_dict(self._slot(address, operation)))
+                                   for operation in operations
+                                   if self._latency[self._slot(address, operation)].count)
+                if per_address:
+                    result['addresses'][address] = per_address
+        return result
+
+    def report(self):
+        """Returns a list of strings: a summary line, one line per operation, and one line for each address
+        that had failed transactions."""
+        snapshot = self.snapshot()
+        lines = [u"%.1f s of transactions since %s, bus busy %.1f%%"
+                 % (snapshot['busy_time'], time.strftime('%Y-%m-%d %H:%M', time.localtime(snapshot['since'])),
+                    100 * snapshot['utilization'])]
+        for name in OPERATION_NAMES:
+            if name in snapshot['operations']:
+                lines.append(u"%-10s %s" % (name, _format_counters(snapshot['operations'][name])))
+        for address in sorted(snapshot['addresses']):
+            for name, metrics in sorted(snapshot['addresses'][address].items()):
+                if metrics['ok'] < metrics['latency_ms']['count'] or metrics['unexpected'] or metrics['retries']:
+                    lines.append(u"address %-2d %-10s %s" % (address, name, _format_counters(metrics)))
+        return lines
+
+
+def _format_counters(metrics):
+    latency = metrics['latency_ms']
+    return u"%d transactions: %d ok, %d timeouts, %d CRC errors, %d frame errors, %d unexpected, %d retries; " \
+           u"latency avg %d ms, p50 %d ms, p95 %d ms, max %d ms" \
+           % (latency['count'], metrics['ok'], metrics['timeouts'], metrics['crc_errors'], metrics['frame_errors'],
+              metrics['unexpected'], metrics['retries'], latency['average'], latency['p50'], latency['p95'],
+              latency['max'])
@@ -0,0 +1,120 @@
+# -*- coding: utf-8 -*-
+
+#  Adaptive poll scheduling. Each thermostat gets its own poll interval, derived from its last DCB: a zone that is
+#  heating is polled around the time it is expected to reach its set point, a zone that was just written to is
+#  polled soon after to pick up its reaction, and a zone that is satisfied or in frost protection is polled less
+#  often. A budget caps the fraction of bus time spent on polls, so that a bus full of busy zones still has room
+#  for actions and clock syncs.
+
+import threading
+import time
+
+MIN_POLL_INTERVAL = 60  # seconds; shortest interval between polls of a zone that is about to reach its set point
+MAX_POLL_INTERVAL = 3600  # seconds; longest interval between polls of any zone
+AFTER_WRITE_DELAY = 30  # seconds after a write at which the thermostat is polled to see how it reacted
+NEAR_SETPOINT_MARGIN = 1  # degrees from the set point at which a zone is about to switch its heating
+STABLE_BACKOFF = 3  # poll interval multiplier for zones that are satisfied or in frost protection
+RUN_MODE_FROST = 1  # runModeCode of a thermostat in frost protection mode
+POLL_BUDGET = 0.25  # largest fraction of bus time that polls may use
+POLL_BUDGET_BURST = 10.0  # bus seconds of polls that can be queued at once, e.g. right after startup
+DEFAULT_POLL_COST = 0.3  # estimated bus seconds per poll, until polls have been measured
+POLL_COST_SMOOTHING = 0.2  # weight of the latest poll in the moving average of the poll cost
+
+
+def poll_interval(record, base_interval):
+    """Returns the number of seconds until the next poll of a thermostat, given its last DCB record and the
+    configured poll interval."""
+    shortest = min(MIN_POLL_INTERVAL, base_interval)
+    backoff = min(base_interval * STABLE_BACKOFF, MAX_POLL_INTERVAL)
+    if not record.On or record.runModeCode == RUN_MODE_FROST:
+        return backoff
+
+    air_temp = record.airTemp
+    if air_temp is None:
+        return base_interval
+    distance = record.setRoomTemp - air_temp  # degrees still to go
+
+    if record.heatingOn:
+        if distance <= NEAR_SETPOINT_MARGIN:
+            return shortest
+        if record.rateOfChange:
+            # rateOfChange is the number of minutes the zone takes to heat up one degree:
+            expected = (distance - NEAR_SETPOINT_MARGIN) * record.rateOfChange * 60
+            return max(shortest, min(expected, base_interval))
+        return base_interval
+
+    if distance < -NEAR_SETPOINT_MARGIN:
+        # warm enough, and not about to call for heat:
+        return backoff
+    return base_interval
+
+
+class PollScheduler(object):
+    """Keeps the time of the next poll of each address on a bus, and hands out due polls within the poll
+    budget."""
+
+    def __init__(self, base_interval, budget=POLL_BUDGET):
+        self._lock = threading.Lock()
+        self.base_interval = base_interval
+        self.budget = budget
+        self._next_poll = dict()  # address -> time of its next poll
+        self._intervals = dict()  # address -> its current poll interval
+        self._tokens = POLL_BUDGET_BURST  # bus seconds of polls that may be queued now
+        self._last_refill = time.time()
+        self.poll_cost = DEFAULT_POLL_COST
+        self.reset_counters()
+
+    def reset_counters(self):
+        self.polls_queued = 0
+        self.polls_deferred = 0  # due polls held back by the budget
+        self.counters_reset_time = time.time()
+
+    def due(self, addresses, now=None):
+        """Returns the addresses, out of addresses, whose poll is due, most overdue first, as far as the poll
+        budget allows. Addresses that have never been polled are due right away. A returned address is
+        rescheduled a full poll interval later, in case its poll fails; polled() sets its actual next poll."""
+        if now is None:
+            now = time.time()
+        with self._lock:
+            self._tokens = min(POLL_BUDGET_BURST, self._tokens + (now - self._last_refill) * self.budget)
+            self._last_refill = now
+            due = sorted((self._next_poll.get(address, 0), address) for address in addresses
+                         if self._next_poll.get(address, 0) <= now)
+            result = []
+            for _, address in due:
+                if self._tokens < self.poll_cost:
+                    self.polls_deferred = self.polls_deferred + len(due) - len(result)
+                    break
+                self._tokens = self._tokens - self.poll_cost
+                self._next_poll[address] = now + self.base_interval
+                result.append(address)
+            self.polls_queued = self.polls_queued + len(result)
+            return result
+
+    def polled(self, address, record, elapsed=None):
+        """Schedules the next poll of address based on the record it returned, and updates the poll cost
+        estimate with the elapsed bus time. elapsed is None for a poll that was served from the DCB cache."""
+        interval = poll_interval(record, self.base_interval)
+        with self._lock:
+            if elapsed is not None:
+                self.poll_cost = (1 - POLL_COST_SMOOTHING) * self.poll_cost + POLL_COST_SMOOTHING * elapsed
+            self._next_poll[address] = time.time() + interval
+            self._intervals[address] = interval
+
+    def after_write(self, address):
+        """Brings the next poll of address forward to shortly after a write to it."""
+        with self._lock:
+            self._next_poll[address] = min(self._next_poll.get(address, 0), time.time() + AFTER_WRITE_DELAY)
+
+    def report(self):
+        """Returns a string with the poll intervals and the number of polls compared to a fixed interval."""
+        with self._lock:
+            elapsed = time.time() - self.counters_reset_time
+            intervals = list(self._intervals.values())
+            fixed = elapsed / self.base_interval * len(self._next_poll)
+            if not intervals:
+                return u"%d polls queued, %d deferred by the budget" % (self.polls_queued, self.polls_deferred)
+            return u"%d polls queued (%d at a fixed interval), %d deferred by the budget; intervals %d-%d s " \
+                   u"(avg %d s), est. %.2f s per poll" \
+                   % (self.polls_queued, fixed, self.polls_deferred, min(intervals), max(intervals),
+                      sum(intervals) / len(intervals), self.poll_cost)
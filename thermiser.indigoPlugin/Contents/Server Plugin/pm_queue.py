@@ -0,0 +1,225 @@
+# -*- coding: utf-8 -*-
+
+#  Priority job queue for the RS485 bus scheduler. Jobs are (function, arguments) tuples, queued in one of
+#  a fixed number of priority classes. The highest non-empty class is served first, unless a job in a lower
+#  class has waited longer than its starvation limit.
+#  Jobs can be queued with a key (e.g. the kind of job plus the device it is for). Only one job per key is
+#  kept in the queue: a duplicate is merged into the pending job, or replaces it if it supersedes it.
+#  Jobs can also be queued with a delay (used for retries); they only become eligible once the delay expires.
+
+import heapq
+import threading
+import time
+from collections import deque
+from pm_metrics import Histogram, WAIT_BOUNDS_S
+
+try:
+    from Queue import Empty
+except ImportError:
+    from queue import Empty
+
+PRIORITY_INTERACTIVE = 0  # user initiated writes (actions)
+PRIORITY_REFRESH = 1  # state refresh after a write
+PRIORITY_POLL = 2  # periodic polls
+PRIORITY_CLOCK_SYNC = 3  # periodic clock synchronisation
+PRIORITY_DISCOVERY = 4  # bus scans
+PRIORITY_NAMES = ['interactive', 'refresh', 'poll', 'clock sync', 'discovery']
+# longest time (seconds) a job of each class may wait before it is served ahead of higher classes:
+STARVATION_LIMITS = [None, 5, 30, 60, 60]
+
+
+class JobQueue(object):
+    """Thread-safe priority queue with per-class queue depth and wait time metrics.
+    get() follows the Queue.Queue conventions and raises Empty on timeout."""
+
+    def __init__(self):
+        self._lock = threading.Condition()
+        self._queues = [deque() for _ in PRIORITY_NAMES]
+        self._pending = dict()  # key -> entry for queued jobs that have a key
+        self._delayed = []  # heap of (due time, sequence number, entry) for jobs that are not yet eligible
+        self._sequence = 0
+        # wait time distribution of each class since startup; unlike the other metrics these are never reset:
+        self.wait_histograms = [Histogram(WAIT_BOUNDS_S) for _ in PRIORITY_NAMES]
+        self.reset_metrics()
+
+    def reset_metrics(self):
+        """Clears the per-class counters. Current queue depth is not affected."""
+        with self._lock:
+            self.enqueued = [0] * len(PRIORITY_NAMES)
+            self.served = [0] * len(PRIORITY_NAMES)
+            self.starvation_promotions = [0] * len(PRIORITY_NAMES)
+            self.merged = [0] * len(PRIORITY_NAMES)
+            self.replaced = [0] * len(PRIORITY_NAMES)
+            self.max_depth = [len(q) for q in self._queues]
+            self.total_wait = [0.0] * len(PRIORITY_NAMES)
+            self.max_wait = [0.0] * len(PRIORITY_NAMES)
+
+    def put(self, job, priority=PRIORITY_POLL, key=None, replace=False, delay=0):
+        """Queues job in the given priority class, optionally after a delay in seconds.
+        If a job with the same key is already queued, the new job is merged into it: with replace=True the
+        new job takes the place of the pending one, otherwise it is dropped. A pending job is moved up if the
+        new one has a higher priority.
+        Returns True if the job was queued, False if it was merged into a pending job."""
+        with self._lock:
+            if key is not None and key in self._pending:
+                entry = self._pending[key]
+                if replace:
+                    entry[1] = job
+                    self.replaced[priority] = self.replaced[priority] + 1
+                    if entry[4] is not None or delay > 0:
+                        # the new job comes with its own delay, e.g. none for a user action that replaces a
+                        # retry waiting out its backoff:
+                        self._remove(entry)
+                        entry[3] = min(entry[3], priority)
+                        self._schedule(entry, delay)
+                        self._lock.notify()
+                        return False
+                else:
+                    self.merged[priority] = self.merged[priority] + 1
+                if priority < entry[3]:
+                    if entry[4] is None:
+                        self._queues[entry[3]].remove(entry)
+                        self._queues[priority].append(entry)
+                    entry[3] = priority
+                return False
+
+            # entry: [queued at, job, key, priority, due time or None once eligible]
+            entry = [None, job, key, priority, None]
+            if key is not None:
+                self._pending[key] = entry
+            self.enqueued[priority] = self.enqueued[priority] + 1
+            self._schedule(entry, delay)
+            self._lock.notify()
+            return True
+
+    def _schedule(self, entry, delay):
+        """Adds an entry to the queue of its class, or to the delayed jobs if delay is positive. Must be called
+        with the lock held."""
+        entry[0] = time.time()
+        if delay > 0:
+            entry[4] = entry[0] + delay
+            self._sequence = self._sequence + 1
+            heapq.heappush(self._delayed, (entry[4], self._sequence, entry))
+        else:
+            entry[4] = None
+            self._append(entry)
+
+    def _remove(self, entry):
+        """Takes a pending entry out of its queue or the delayed jobs. Must be called with the lock held."""
+        if entry[4] is None:
+            self._queues[entry[3]].remove(entry)
+        else:
+            self._delayed = [item for item in self._delayed if item[2] is not entry]
+            heapq.heapify(self._delayed)
+
+    def _append(self, entry):
+        """Adds an eligible entry to the queue of its class. Must be called with the lock held."""
+        queue = self._queues[entry[3]]
+        queue.append(entry)
+        if len(queue) > self.max_depth[entry[3]]:
+            self.max_depth[entry[3]] = len(queue)
+
+    def _release_delayed(self, now):
+        """Moves delayed entries that have become due to their queues and returns the time at which the next
+        delayed entry becomes due, or None. Must be called with the lock held."""
+        while self._delayed and self._delayed[0][0] <= now:
+            due, _, entry = heapq.heappop(self._delayed)
+            entry[0] = due  # waiting time is counted from the moment the job became eligible
+            entry[4] = None
+            self._append(entry)
+        if self._delayed:
+            return self._delayed[0][0]
+        return None
+
+    def get(self, block=True, timeout=None):
+        """Removes and returns the next job. Raises Empty if no job is available within timeout seconds."""
+        with self._lock:
+            deadline = None if timeout is None else time.time() + timeout
+            while True:
+                now = time.time()
+                next_due = self._release_delayed(now)
+                if not self._is_empty():
+                    break
+                if not block or (deadline is not None and deadline <= now):
+                    raise Empty
+                wait_until = deadline
+                if next_due is not None and (wait_until is None or next_due < wait_until):
+                    wait_until = next_due
+                self._lock.wait(None if wait_until is None else wait_until - now)
+
+            priority = self._next_priority(now)
+            queued_at, job, key, _, _ = self._queues[priority].popleft()
+            if key is not None:
+                del self._pending[key]
+            wait = now - queued_at
+            self.served[priority] = self.served[priority] + 1
+            self.total_wait[priority] = self.total_wait[priority] + wait
+            if wait > self.max_wait[priority]:
+                self.max_wait[priority] = wait
+            self.wait_histograms[priority].record(wait)
+            return job
+
+    def _next_priority(self, now):
+        """Returns the class to serve next: the longest overdue starving class if any, else the highest
+        non-empty class. Must be called with the lock held and at least one job queued."""
+        highest = None
+        overdue = None
+        overdue_wait = 0
+        for priority, queue in enumerate(self._queues):
+            if not queue:
+                continue
+            if highest is None:
+                highest = priority
+                continue
+            limit = STARVATION_LIMITS[priority]
+            wait = now - queue[0][0]
+            if limit is not None and wait > limit and wait > overdue_wait:
+                overdue = priority
+                overdue_wait = wait
+
+        if overdue is not None:
+            self.starvation_promotions[overdue] = self.starvation_promotions[overdue] + 1
+            return overdue
+        return highest
+
+    def _is_empty(self):
+        for queue in self._queues:
+            if queue:
+                return False
+        return True
+
+    def empty(self):
+        """Returns True if no job is queued, including delayed jobs."""
+        with self._lock:
+            return self._is_empty() and not self._delayed
+
+    def qsize(self):
+        """Returns the number of queued jobs, including delayed jobs."""
+        with self._lock:
+            return sum(len(q) for q in self._queues) + len(self._delayed)
+
+    def depth(self, priority):
+        """Returns the number of eligible jobs currently queued in the given class."""
+        with self._lock:
+            return len(self._queues[priority])
+
+    def wait_snapshot(self):
+        """Returns a dictionary with the wait time histogram (seconds) of each class since startup."""
+        with self._lock:
+            return dict((name, self.wait_histograms[priority].as_dict())
+                        for priority, name in enumerate(PRIORITY_NAMES))
+
+    def metrics_report(self):
+        """Returns a list of strings, one per priority class, describing queue depth and wait times."""
+        lines = []
+        with self._lock:
+            for priority, name in enumerate(PRIORITY_NAMES):
+                served = self.served[priority]
+                average_wait = self.total_wait[priority] / served if served else 0.0
+                lines.append(u"%-11s queued %d (max %d), served %d, merged %d, replaced %d, "
+                             u"wait avg %.2f s / max %.2f s (p95 since startup %.1f s), starvation promotions %d"
+                             % (name, len(self._queues[priority]), self.max_depth[priority], served,
+                                self.merged[priority], self.replaced[priority], average_wait,
+                                self.max_wait[priority], self.wait_histograms[priority].percentile(0.95),
+                                self.starvation_promotions[priority]))
+        return lines
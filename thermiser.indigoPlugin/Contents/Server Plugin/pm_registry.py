@@ -0,0 +1,97 @@
+# -*- coding: utf-8 -*-
+
+#  In-memory registry of the thermostats the plugin is talking to, keyed by bus address and by Indigo device id.
+#  It is filled by deviceStartComm / deviceStopComm, so the scheduler and the menu items don't need to walk the
+#  Indigo device database and parse plugin props on every poll.
+
+import threading
+import time
+from collections import namedtuple
+
+# the last known values of a thermostat, taken from its most recent DCB read:
+DCBSummary = namedtuple('DCBSummary', ['model', 'softwareVersion', 'airTemp', 'setRoomTemp', 'heatingOn',
+                                       'hotWaterOn', 'readTime'])
+
+
+class RegisteredDevice(object):
+    """A thermostat known to the plugin: the Indigo device, its parsed address and model, and a DCB summary."""
+    __slots__ = ('device', 'address', 'model', 'summary')
+
+    def __init__(self, device, address, model):
+        self.device = device
+        self.address = address
+        self.model = model
+        self.summary = None
+
+    @property
+    def device_id(self):
+        return self.device.id
+
+
+class DeviceRegistry(object):
+    """Thread-safe lookup of registered devices by address and by device id."""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._by_address = dict()  # address -> RegisteredDevice
+        self._by_device_id = dict()  # Indigo device id -> RegisteredDevice
+
+    def add(self, device, address, model):
+        """Registers device at address, replacing an earlier registration of the same device. Returns the
+        RegisteredDevice that was previously registered at address for another device, or None."""
+        entry = RegisteredDevice(device, address, model)
+        with self._lock:
+            self._remove(device.id)
+            previous = self._by_address.get(address)
+            self._by_address[address] = entry
+            self._by_device_id[device.id] = entry
+            return previous
+
+    def remove(self, device_id):
+        """Unregisters the device with device_id. Returns its RegisteredDevice, or None if it wasn't registered."""
+        with self._lock:
+            return self._remove(device_id)
+
+    def _remove(self, device_id):
+        entry = self._by_device_id.pop(device_id, None)
+        if entry is not None and self._by_address.get(entry.address) is entry:
+            del self._by_address[entry.address]
+        return entry
+
+    def update_device(self, device):
+        """Replaces the Indigo device object of a registered device, e.g. after it was renamed."""
+        with self._lock:
+            entry = self._by_device_id.get(device.id)
+            if entry is not None:
+                entry.device = device
+
+    def update_summary(self, address, record):
+        """Stores a summary of a freshly read DCB record for the device at address."""
+        summary = DCBSummary(record.model, record.softwareVersion, record.airTemp, record.setRoomTemp,
+                             record.heatingOn, record.hotWaterOn, time.time())
+        with self._lock:
+            entry = self._by_address.get(address)
+            if entry is not None:
+                entry.model = record.model
+                entry.summary = summary
+
+    def by_address(self, address):
+        """Returns the RegisteredDevice at address, or None."""
+        return self._by_address.get(address)
+
+    def by_device_id(self, device_id):
+        """Returns the RegisteredDevice for an Indigo device id, or None."""
+        return self._by_device_id.get(device_id)
+
+    def addresses(self):
+        """Returns a set with the addresses of all registered devices."""
+        with self._lock:
+            return set(self._by_address)
+
+    def entries(self):
+        """Returns a list of all RegisteredDevices, in address order."""
+        with self._lock:
+            return [self._by_address[address] for address in sorted(self._by_address)]
+
+    def __len__(self):
+        return len(self._by_device_id)
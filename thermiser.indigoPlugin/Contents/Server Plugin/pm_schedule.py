@@ -0,0 +1,98 @@
+# -*- coding: utf-8 -*-
+
+#  Schedule text of the Upload Schedule action, parsed into schedule write registers (see pm_dcb). The text has
+#  one entry per line or separated by semicolons, each a day and its periods:
+#      weekday: 06:30 21, 08:30 16, 17:00 21, 22:30 16
+#      sat-sun: 07:30 21, 23:00 16
+#      hw weekday: 06:00-07:30, 17:00-18:00
+#  Days are weekday and weekend (5/2 mode), or mon to sun and ranges such as mon-fri (7 day mode). Heating periods
+#  are a start time and a temperature in degrees Celsius, hot water periods an on and an off time; "hw" before the
+#  day makes it a hot water entry. Up to 4 periods per day, the rest are filled with unused periods.
+
+import re
+from pm_dcb import *
+
+DAY_KEYS = ['mon', 'tue', 'wed', 'thu', 'fri', 'sat', 'sun']
+UNUSED_HOUR = 24  # hour of an unused period
+_ENTRY = re.compile(r'^(hw\s+)?([a-z]+)(?:\s*-\s*([a-z]+))?\s*:(.*)$')
+_HEATING_PERIOD = re.compile(r'^(\d{1,2}):(\d{2})\s+(\d{1,2})$')
+_HOT_WATER_PERIOD = re.compile(r'^(\d{1,2}):(\d{2})\s*-\s*(\d{1,2}):(\d{2})$')
+
+
+def _registers(hot_water, first, last):
+    """Returns the schedule write registers for a day or range of days."""
+    table = 'HotWater' if hot_water else 'Schedule'
+    if last is None and first in ('weekday', 'weekend'):
+        return [first + table]
+    if first not in DAY_KEYS or (last is not None and last not in DAY_KEYS):
+        raise ValueError(u"unknown day '%s'" % (first if first not in DAY_KEYS else last))
+    first_day = DAY_KEYS.index(first)
+    last_day = first_day if last is None else DAY_KEYS.index(last)
+    if last_day < first_day:
+        raise ValueError(u"day range %s-%s runs backwards" % (first, last))
+    return ['sevenDay%s%d' % (table, day + 1) for day in range(first_day, last_day + 1)]
+
+
+def _time(hour, minute):
+    if int(hour) > 23 or int(minute) > 59:
+        raise ValueError(u"invalid time %s:%s" % (hour, minute))
+    return int(hour), int(minute)
+
+
+def _periods(text, hot_water, min_temp, max_temp):
+    """Parses the comma separated periods of one entry into a full day of period tuples."""
+    periods = []
+    for period in [part.strip() for part in text.split(',') if part.strip()]:
+        if hot_water:
+            match = _HOT_WATER_PERIOD.match(period)
+            if match is None:
+                raise ValueError(u"hot water period '%s' is not like 06:00-07:30" % period)
+            periods.append(_time(*match.group(1, 2)) + _time(*match.group(3, 4)))
+        else:
+            match = _HEATING_PERIOD.match(period)
+            if match is None:
+                raise ValueError(u"heating period '%s' is not like 06:30 21" % period)
+            temp = int(match.group(3))
+            if not min_temp <= temp <= max_temp:
+                raise ValueError(u"temperature %d is not between %d and %d" % (temp, min_temp, max_temp))
+            periods.append(_time(*match.group(1, 2)) + (temp,))
+    if not periods:
+        raise ValueError(u"no periods")
+    starts = [period[:2] for period in periods]
+    if starts != sorted(starts):
+        raise ValueError(u"periods are not in time order")
+    if len(periods) > (HOT_WATER_PERIODS if hot_water else HEATING_PERIODS):
+        raise ValueError(u"more than %d periods" % (HOT_WATER_PERIODS if hot_water else HEATING_PERIODS))
+    if hot_water:
+        if any(period[:2] > period[2:] for period in periods):
+            raise ValueError(u"hot water goes off before it goes on")
+        unused = (UNUSED_HOUR, 0, UNUSED_HOUR, 0)
+        return periods + [unused] * (HOT_WATER_PERIODS - len(periods))
+    unused = (UNUSED_HOUR, 0, periods[-1][2])
+    return periods + [unused] * (HEATING_PERIODS - len(periods))
+
+
+def parse_schedule(text, min_temp, max_temp):
+    """Parses schedule text into a dictionary of schedule write register name (e.g. weekdaySchedule or
+    sevenDayHotWater1) -> list of period tuples. Raises ValueError with a description of the first error."""
+    schedules = dict()
+    for line in re.split(r'[;\n]', text):
+        line = line.strip().lower()
+        if not line:
+            continue
+        match = _ENTRY.match(line)
+        if match is None:
+            raise ValueError(u"'%s' is not a day followed by a colon and periods" % line)
+        hot_water = match.group(1) is not None
+        try:
+            registers = _registers(hot_water, match.group(2), match.group(3))
+            periods = _periods(match.group(4), hot_water, min_temp, max_temp)
+        except ValueError as error:
+            raise ValueError(u"%s: %s" % (line.split(':')[0], error))
+        for name in registers:
+            if name in schedules:
+                raise ValueError(u"%s: day is given twice" % line.split(':')[0])
+            schedules[name] = periods
+    if not schedules:
+        raise ValueError(u"no schedule given")
+    return schedules
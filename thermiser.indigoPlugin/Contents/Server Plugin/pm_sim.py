@@ -0,0 +1,443 @@
+#! /usr/bin/env python
+# -*- coding: utf-8 -*-
+
+#  Simulator of an RS485 bus with Heatmiser DT / PRT / PRT-HW thermostats, for load and latency testing without
+#  hardware. The thermostats hold complete DCBs (including a running clock and schedules), answer full and partial
+#  reads, and accept the writes PyMiser sends. The bus models the wire time at 4800 baud, the turnaround delay of
+#  the thermostats, dropped replies, corrupted replies and line noise in front of replies. Not used by the plugin
+#  itself.
+#
+#  The simulated bus can be used in-process through SimulatorPort (a transport, see pm_transport), or from the
+#  plugin through a pty or a TCP socket (connection type "Network Socket" in the plugin configuration):
+#      python pm_sim.py --devices 8
+#      python pm_sim.py --devices 32 --socket 127.0.0.1:4001 --drop 0.01 --corrupt 0.01 --noise 0.05
+
+import argparse
+import datetime
+import os
+import random
+import select
+import socket
+import struct
+import threading
+import time
+from pm_crc import *
+from pm_dcb import *
+from pymiser import BAUD_RATE, BITS_PER_BYTE, FUNCTION_READ, FUNCTION_WRITE, INTER_BYTE_TIMEOUT, MASTER_ADDRESS, \
+    READ_ALL, REPLY_TIMEOUT
+
+DEFAULT_TURNAROUND = 0.02  # seconds between the end of a request and the start of the reply
+MIN_REQUEST_SIZE = 10  # a read request: destination, length, source, function, start, count and CRC
+REPLY_CHUNK_SIZE = 8  # bytes the stream servers send at a time, paced at the wire rate
+MAX_NOISE_SIZE = 8  # largest number of random bytes of line noise in front of a reply
+SECONDS_PER_WEEK = 7 * 24 * 3600
+MODEL_IDS = {'DT': MODEL_DT, 'DT-E': MODEL_DT_E, 'PRT': MODEL_PRT, 'PRT-E': MODEL_PRT_E, 'PRT-HW': MODEL_PRT_HW}
+# a typical schedule: (hour, minute, temperature) heating periods and (on hour, on minute, off hour, off minute)
+# hot water periods. Unused hot water periods are 24:00.
+HEATING_DAY = [(6, 30, 21), (8, 30, 16), (17, 0, 21), (22, 30, 16)]
+HOT_WATER_DAY = [(6, 0, 7, 30), (17, 0, 18, 0), (24, 0, 24, 0), (24, 0, 24, 0)]
+_REGISTER_NAMES = dict((register, name) for name, (register, field_format) in WRITE_REGISTERS.items())
+
+
+def wire_time(size):
+    """Returns the time in seconds it takes to send size bytes over the bus."""
+    return size * BITS_PER_BYTE / float(BAUD_RATE)
+
+
+class SimulatedThermostat(object):
+    """A thermostat with a complete DCB. Its clock keeps running, optionally gaining clock_drift seconds a day,
+    and it heats while the air temperature is below the set temperature."""
+
+    def __init__(self, address, model_id=MODEL_PRT, seven_day=True, air_temp=19.0, set_temp=21, clock_drift=0.0):
+        self.address = address
+        self.model_id = model_id
+        self.layout = layout_for_model(model_id)
+        self.clock_drift = clock_drift
+        self.reads = 0
+        self.writes = 0
+
+        values = {'vendorID': 0, 'versionByte': 0x0c, 'modelID': model_id, 'switchDifferential': 1,
+                  'frostProtectionCode': 1, 'address': address, 'rateOfChange': 20,
+                  'programModeCode': 1 if seven_day else 0, 'frostProtectTemp': 12, 'setRoomTemp': set_temp,
+                  'floorMaxLimit': 28, 'On': 1, 'remoteAirTempRaw': TEMPERATURE_NOT_CONNECTED,
+                  'floorTempRaw': TEMPERATURE_NOT_CONNECTED, 'airTempRaw': int(air_temp * 10), 'hotWaterOn': 0}
+        dcb_length = self.layout.size
+        for table, (offset, size) in self.layout.schedules.items():
+            if seven_day or not table.startswith('sevenDay'):
+                dcb_length = max(dcb_length, offset + size)
+        values['dcbLen'] = dcb_length
+        self.dcb = self.layout.encode(values, dcb_length)
+        self._offsets = dict((name, offset) for name, offset, field_format in self.layout.fields)
+
+        for table, (offset, size) in self.layout.schedules.items():
+            day = HOT_WATER_DAY if 'HotWater' in table else HEATING_DAY
+            day_bytes = bytearray(value for period in day for value in period)
+            for position in range(offset, min(offset + size, dcb_length), len(day_bytes)):
+                self.dcb[position:position + len(day_bytes)] = day_bytes
+
+        now = datetime.datetime.now()
+        self.set_clock(now.isoweekday(), now.hour, now.minute, now.second)
+
+    def set_clock(self, weekday, hour, minute, second):
+        self._clock_seconds = ((weekday - 1) * 24 + hour) * 3600 + minute * 60 + second
+        self._clock_set_at = time.time()
+
+    def clock(self):
+        """Returns the current (weekday, hour, minute, second) of the thermostat's clock."""
+        elapsed = (time.time() - self._clock_set_at) * (1 + self.clock_drift / 86400.0)
+        seconds = int(self._clock_seconds + elapsed) % SECONDS_PER_WEEK
+        return seconds // 86400 + 1, seconds // 3600 % 24, seconds // 60 % 60, seconds % 60
+
+    def _put(self, name, value):
+        if name in self._offsets:
+            self.dcb[self._offsets[name]] = value
+
+    def read(self, start, count):
+        """Returns count bytes of the DCB from start (the whole DCB if count is READ_ALL), or None if the
+        range is outside the DCB."""
+        if 'weekDayNumber' in self._offsets:
+            for name, value in zip(CLOCK_FIELD_NAMES, self.clock()):
+                self._put(name, value)
+        air_temp = self.dcb[self._offsets['airTempRaw']] * 256 + self.dcb[self._offsets['airTempRaw'] + 1]
+        self._put('heatingOn', 1 if air_temp < self.dcb[self._offsets['setRoomTemp']] * 10 else 0)
+
+        if count == READ_ALL:
+            start, count = 0, len(self.dcb)
+        if start + count > len(self.dcb):
+            return None
+        self.reads = self.reads + 1
+        return self.dcb[start:start + count]
+
+    def write(self, register, payload):
+        """Writes payload to one write register, or to consecutive registers starting at register. Returns False
+        if the model lacks one of the registers or the payload doesn't end on a register boundary, in which case
+        the thermostat does not reply and nothing is written."""
+        fields = []
+        position = 0
+        while position < len(payload):
+            name = _REGISTER_NAMES.get(register + position)
+            if name is None or name not in self.layout.writable:
+                return False
+            size = struct.calcsize('>' + WRITE_REGISTERS[name][1])
+            if position + size > len(payload):
+                return False
+            if name in SCHEDULE_REGISTERS:
+                table, start = SCHEDULE_REGISTERS[name]
+                if self.layout.schedules[table][0] + start + size > len(self.dcb):
+                    return False
+            fields.append((name, payload[position:position + size]))
+            position = position + size
+
+        for name, value in fields:
+            if name == 'clock':
+                self.set_clock(*value)
+            elif name in SCHEDULE_REGISTERS:
+                table, start = SCHEDULE_REGISTERS[name]
+                offset = self.layout.schedules[table][0] + start
+                self.dcb[offset:offset + len(value)] = value
+            else:
+                offset = self._offsets[name]
+                self.dcb[offset:offset + len(value)] = value
+        self.writes = self.writes + 1
+        return True
+
+
+def make_thermostats(count, models=('DT', 'PRT', 'PRT-HW'), seed=0):
+    """Returns count thermostats at addresses 1..count, cycling through the given model names, with a spread of
+    temperatures."""
+    generator = random.Random(seed)
+    thermostats = []
+    for index in range(count):
+        thermostats.append(SimulatedThermostat(index + 1, MODEL_IDS[models[index % len(models)]],
+                                               seven_day=index % 2 == 0, air_temp=generator.uniform(15, 23),
+                                               set_temp=generator.choice([16, 18, 20, 21, 22])))
+    return thermostats
+
+
+class SimulatedBus(object):
+    """The thermostats on one bus, and the errors of the bus itself."""
+
+    def __init__(self, thermostats, turnaround=DEFAULT_TURNAROUND, drop_rate=0.0, corrupt_rate=0.0, seed=None,
+                 noise_rate=0.0):
+        self.thermostats = dict((thermostat.address, thermostat) for thermostat in thermostats)
+        self.turnaround = turnaround
+        self.drop_rate = drop_rate
+        self.corrupt_rate = corrupt_rate
+        self.noise_rate = noise_rate
+        self.random = random.Random(seed)
+        self.requests = 0
+        self.replies = 0
+        self.dropped = 0
+        self.corrupted = 0
+        self.noisy = 0
+        self.invalid = 0
+
+    def handle(self, request):
+        """Returns the reply of the addressed thermostat to a request frame, or None if nothing replies."""
+        request = bytearray(request)
+        self.requests = self.requests + 1
+        if len(request) < MIN_REQUEST_SIZE or request[1] != len(request) or request[2] != MASTER_ADDRESS \
+                or not verify_ccitt(request):
+            self.invalid = self.invalid + 1
+            return None
+        thermostat = self.thermostats.get(request[0])
+        if thermostat is None:
+            return None
+
+        start = request[4] + request[5] * 256
+        count = request[6] + request[7] * 256
+        if request[3] == FUNCTION_READ:
+            data = thermostat.read(start, count)
+            if data is None:
+                return None
+            body = bytearray([MASTER_ADDRESS, 0, 0, thermostat.address, FUNCTION_READ, start & 0xFF, start >> 8,
+                              len(data) & 0xFF, len(data) >> 8]) + data
+        elif request[3] == FUNCTION_WRITE:
+            payload = request[8:-2]
+            if len(payload) != count or not thermostat.write(start, payload):
+                return None
+            body = bytearray([MASTER_ADDRESS, 0, 0, thermostat.address, FUNCTION_WRITE])
+        else:
+            return None
+
+        if self.random.random() < self.drop_rate:
+            self.dropped = self.dropped + 1
+            return None
+        reply = body + bytearray(2)
+        reply[1] = len(reply) & 0xFF
+        reply[2] = len(reply) >> 8
+        crc().addCCITTtoBytearray(reply)
+        if self.random.random() < self.corrupt_rate:
+            self.corrupted = self.corrupted + 1
+            reply[self.random.randrange(len(reply))] ^= 1 << self.random.randrange(8)
+        if self.random.random() < self.noise_rate:
+            self.noisy = self.noisy + 1
+            noise = bytearray(self.random.randrange(256) for _ in range(self.random.randint(1, MAX_NOISE_SIZE)))
+            reply = noise + reply
+        self.replies = self.replies + 1
+        return reply
+
+    def report(self):
+        return u"%d thermostats, %d requests, %d replies, %d dropped, %d corrupted, %d with noise, %d invalid " \
+               u"requests" % (len(self.thermostats), self.requests, self.replies, self.dropped, self.corrupted,
+                              self.noisy, self.invalid)
+
+
+class SimulatorPort(object):
+    """A transport connected directly to a SimulatedBus. Reply bytes become readable at the time they would have
+    arrived over the wire, and reads time out like a serial port. time_scale speeds the simulation up
+    (0.5 runs it twice as fast, 0 removes all delays). With echo, the port reads back each request in front of
+    its reply, like a half-duplex adapter that doesn't suppress its own transmissions."""
+
+    def __init__(self, bus, time_scale=1.0, echo=False):
+        self.name = "sim://%d-thermostats" % len(bus.thermostats)
+        self.bus = bus
+        self.time_scale = time_scale
+        self.echo = echo
+        self.timeout = REPLY_TIMEOUT
+        self.inter_byte_timeout = INTER_BYTE_TIMEOUT
+        self._reply = bytearray()
+        self._position = 0
+        self._reply_start = 0
+
+    def open(self):
+        return True
+
+    def close(self):
+        pass
+
+    def _sleep_until(self, moment):
+        delay = moment - time.time()
+        if delay > 0:
+            time.sleep(delay)
+
+    def write(self, data):
+        reply = self.bus.handle(data)
+        self._reply = reply or bytearray()
+        self._position = 0
+        self._reply_start = time.time() + (wire_time(len(data)) + self.bus.turnaround) * self.time_scale
+        if self.echo:
+            # the echo arrives while the request is sent, and the reply follows it after the turnaround:
+            self._reply = bytearray(data) + self._reply
+            self._reply_start = time.time() + self.bus.turnaround * self.time_scale
+        return len(data)
+
+    def read(self, size):
+        now = time.time()
+        deadline = None if self.timeout is None else now + self.timeout * self.time_scale
+        end = min(len(self._reply), self._position + size)
+        if end == self._position:
+            # nothing (more) is coming:
+            if deadline is not None:
+                self._sleep_until(deadline)
+            return b''
+        arrival = self._reply_start + wire_time(end) * self.time_scale
+        if deadline is not None and arrival > deadline:
+            self._sleep_until(deadline)
+            arrived = int((deadline - self._reply_start) / (wire_time(1) * self.time_scale)) if self.time_scale else end
+            end = max(self._position, min(end, arrived))
+        else:
+            self._sleep_until(arrival)
+        data = bytes(self._reply[self._position:end])
+        self._position = end
+        return data
+
+    def flushInput(self):
+        self._position = len(self._reply)
+
+
+def _serve_stream(bus, receive, send, stop):
+    """Answers the requests received through receive() with send(), pacing the replies at the wire rate.
+    receive returns b'' when nothing arrived for a while, and None when the connection was closed."""
+    buffer = bytearray()
+    while not stop.is_set():
+        data = receive()
+        if data is None:
+            return
+        buffer = buffer + bytearray(data)
+        while len(buffer) >= 3:
+            length = buffer[1]
+            if length < MIN_REQUEST_SIZE or buffer[2] != MASTER_ADDRESS:
+                # not the start of a request; resynchronize on the next byte:
+                del buffer[0]
+                continue
+            if len(buffer) < length:
+                break
+            request = buffer[:length]
+            del buffer[:length]
+            reply = bus.handle(request)
+            if reply is None:
+                continue
+            # the request already arrived, but on the wire it would have taken this long:
+            time.sleep(wire_time(length) + bus.turnaround)
+            for start in range(0, len(reply), REPLY_CHUNK_SIZE):
+                chunk = reply[start:start + REPLY_CHUNK_SIZE]
+                time.sleep(wire_time(len(chunk)))
+                send(bytes(chunk))
+
+
+class PtyServer(object):
+    """Serves a SimulatedBus on a pseudo terminal; its device name can be used as a local serial port."""
+
+    def __init__(self, bus):
+        import tty
+        self.bus = bus
+        self._master, slave = os.openpty()
+        tty.setraw(slave)
+        self.port_name = os.ttyname(slave)
+        self._slave = slave
+        self._stop = threading.Event()
+        self._thread = None
+
+    def _receive(self):
+        if not select.select([self._master], [], [], 0.1)[0]:
+            return b''
+        try:
+            return os.read(self._master, 512)
+        except OSError:
+            return None
+
+    def _send(self, data):
+        os.write(self._master, data)
+
+    def start(self):
+        self._thread = threading.Thread(target=_serve_stream, args=(self.bus, self._receive, self._send, self._stop))
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        os.close(self._master)
+        os.close(self._slave)
+
+
+class SocketServer(object):
+    """Serves a SimulatedBus on a TCP port, like an Ethernet-RS485 gateway in raw socket mode. Port 0 picks a
+    free port; the port in use is available as port after construction."""
+
+    def __init__(self, bus, host="127.0.0.1", port=0):
+        self.bus = bus
+        self._listener = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self._listener.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        self._listener.bind((host, port))
+        self._listener.listen(5)
+        self.host, self.port = self._listener.getsockname()
+        self.url = "socket://%s:%d" % (self.host, self.port)
+        self._stop = threading.Event()
+        self._thread = None
+        self._connections = []  # threads serving accepted connections
+
+    def _accept(self):
+        while not self._stop.is_set():
+            if not select.select([self._listener], [], [], 0.1)[0]:
+                continue
+            connection, peer = self._listener.accept()
+            connection.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+            thread = threading.Thread(target=self._serve_connection, args=(connection,))
+            thread.daemon = True
+            thread.start()
+            self._connections.append(thread)
+
+    def _serve_connection(self, connection):
+        def receive():
+            if not select.select([connection], [], [], 0.1)[0]:
+                return b''
+            try:
+                return connection.recv(512) or None
+            except socket.error:
+                return None
+
+        try:
+            _serve_stream(self.bus, receive, connection.sendall, self._stop)
+        except socket.error:
+            pass
+        connection.close()
+
+    def start(self):
+        self._thread = threading.Thread(target=self._accept)
+        self._thread.daemon = True
+        self._thread.start()
+        return self
+
+    def stop(self):
+        """Stops serving and closes the listening socket and all connections, like a gateway that goes away."""
+        self._stop.set()
+        if self._thread is not None:
+            self._thread.join()
+        for thread in self._connections:
+            thread.join()
+        self._listener.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Simulated bus of Heatmiser thermostats")
+    parser.add_argument('--devices', type=int, default=8, help="number of thermostats, at addresses 1..N")
+    parser.add_argument('--models', default="DT,PRT,PRT-HW", help="comma separated models to cycle through")
+    parser.add_argument('--socket', metavar="HOST:PORT", help="serve the bus on a TCP socket instead of a pty")
+    parser.add_argument('--turnaround', type=float, default=DEFAULT_TURNAROUND * 1000, help="turnaround delay in ms")
+    parser.add_argument('--drop', type=float, default=0.0, help="fraction of replies that is dropped")
+    parser.add_argument('--corrupt', type=float, default=0.0, help="fraction of replies with a corrupted byte")
+    parser.add_argument('--noise', type=float, default=0.0, help="fraction of replies with line noise in front")
+    parser.add_argument('--seed', type=int, default=None, help="seed for the dropped and corrupted replies")
+    arguments = parser.parse_args()
+
+    simulated_bus = SimulatedBus(make_thermostats(arguments.devices, arguments.models.split(',')),
+                                 arguments.turnaround / 1000.0, arguments.drop, arguments.corrupt, arguments.seed,
+                                 arguments.noise)
+    if arguments.socket:
+        socket_host, _, socket_port = arguments.socket.rpartition(':')
+        server = SocketServer(simulated_bus, socket_host or "127.0.0.1", int(socket_port)).start()
+        print(u"Serving %d thermostats on %s" % (arguments.devices, server.url))
+    else:
+        server = PtyServer(simulated_bus).start()
+        print(u"Serving %d thermostats on %s" % (arguments.devices, server.port_name))
+    try:
+        while True:
+            time.sleep(10)
+            print(simulated_bus.report())
+    except KeyboardInterrupt:
+        server.stop()
+        print(simulated_bus.report())
@@ -0,0 +1,215 @@
+# -*- coding: utf-8 -*-
+
+#  Transports carry the bytes of a bus between PyMiser and the thermostats. PyMiser only uses write(), read(),
+#  flushInput() and the timeout attribute, which is the subset of the pyserial interface these transports provide:
+#  SerialTransport for a local serial port or an RFC2217 serial server (through pyserial), and TcpTransport for
+#  Ethernet-RS485 gateways that pass the bus through a raw TCP socket. The TCP connection is kept open between
+#  transactions and is reconnected automatically when it breaks, or when the gateway can't be reached at startup.
+#  open() returns False for a transport that is open but not (yet) connected.
+
+import select
+import socket
+import time
+import serial
+from pymiser import BAUD_RATE, INTER_BYTE_TIMEOUT, REPLY_TIMEOUT
+
+CONN_TYPE_LOCAL = "local"  # connection types of the Indigo serial port field
+CONN_TYPE_RFC2217 = "netRfc2217"
+CONN_TYPE_SOCKET = "netSocket"
+CONNECT_TIMEOUT = 5.0  # seconds to wait for a TCP connection to be established
+RECONNECT_DELAY = 5.0  # least number of seconds between attempts to re-establish a broken TCP connection
+KEEPALIVE_IDLE = 30  # seconds of idle time before TCP keepalive probes are sent
+KEEPALIVE_INTERVAL = 10  # seconds between keepalive probes
+KEEPALIVE_COUNT = 3  # unanswered keepalive probes after which the connection is considered broken
+
+
+def transport_for_prefs(prefs, port_field):
+    """Returns the transport for the Indigo serial port field port_field in prefs."""
+    conn_type = prefs.get(port_field + "_serialConnType", CONN_TYPE_LOCAL)
+    if conn_type == CONN_TYPE_SOCKET:
+        return TcpTransport.from_url(prefs.get(port_field + "_serialPortNetSocket", ""))
+    if conn_type == CONN_TYPE_RFC2217:
+        return SerialTransport(prefs.get(port_field + "_serialPortNetRfc2217", ""))
+    return SerialTransport(prefs.get(port_field + "_serialPortLocal", ""))
+
+
+class SerialTransport(object):
+    """A local serial port, or any port pyserial can open from a URL such as rfc2217://host:port."""
+
+    def __init__(self, port_name):
+        self.name = port_name
+        if "://" in port_name:
+            self.port = serial.serial_for_url(port_name, do_not_open=True)
+        else:
+            self.port = serial.Serial()
+            self.port.port = port_name
+        self.port.baudrate = BAUD_RATE
+        self.port.bytesize = serial.EIGHTBITS
+        self.port.parity = serial.PARITY_NONE
+        self.port.stopbits = serial.STOPBITS_ONE
+        self.port.timeout = REPLY_TIMEOUT
+        # replies are read frame by frame, so a short gap between bytes means the reply is incomplete:
+        if hasattr(self.port, "inter_byte_timeout"):
+            self.port.inter_byte_timeout = INTER_BYTE_TIMEOUT
+        else:
+            self.port.interCharTimeout = INTER_BYTE_TIMEOUT
+
+    @property
+    def timeout(self):
+        return self.port.timeout
+
+    @timeout.setter
+    def timeout(self, value):
+        self.port.timeout = value
+
+    def open(self):
+        self.port.open()
+        return True
+
+    def close(self):
+        self.port.close()
+
+    def write(self, data):
+        return self.port.write(data)
+
+    def read(self, size):
+        return self.port.read(size)
+
+    def flushInput(self):
+        self.port.flushInput()
+
+
+class TcpTransport(object):
+    """A persistent raw TCP connection to a serial server, e.g. socket://192.168.1.20:4001. Nagle's algorithm is
+    disabled so that each frame is sent immediately, and TCP keepalive detects gateways that went away. A broken
+    connection is re-established on the next write, at most once every RECONNECT_DELAY seconds."""
+
+    def __init__(self, host, port):
+        self.name = "socket://%s:%d" % (host, port)
+        self.host = host
+        self.port = port
+        self.timeout = REPLY_TIMEOUT
+        self.inter_byte_timeout = INTER_BYTE_TIMEOUT
+        self.connects = 0  # number of times the connection was (re-)established
+        self.last_error = None  # socket.error of the last failed connection attempt
+        self._socket = None
+        self._last_connect_attempt = 0
+
+    @classmethod
+    def from_url(cls, url):
+        """Creates a transport from a socket://host:port URL."""
+        address = url.split("://", 1)[-1].split("/", 1)[0]
+        host, _, port = address.rpartition(":")
+        if not host or not port.isdigit():
+            raise ValueError("Invalid serial server address: %s (expected socket://host:port)" % url)
+        return cls(host, int(port))
+
+    def open(self):
+        """Connects to the serial server. Returns False if it can't be reached, in which case the connection is
+        retried like a broken one."""
+        self.close()
+        try:
+            self._connect()
+        except socket.error as error:
+            self.last_error = error
+            return False
+        return True
+
+    def close(self):
+        if self._socket is not None:
+            try:
+                self._socket.close()
+            except socket.error:
+                pass
+            self._socket = None
+
+    def _connect(self):
+        self._last_connect_attempt = time.time()
+        sock = socket.create_connection((self.host, self.port), CONNECT_TIMEOUT)
+        sock.setsockopt(socket.IPPROTO_TCP, socket.TCP_NODELAY, 1)
+        sock.setsockopt(socket.SOL_SOCKET, socket.SO_KEEPALIVE, 1)
+        # keepalive timing options differ per platform (TCP_KEEPALIVE is the macOS name of TCP_KEEPIDLE):
+        for option_name, value in (("TCP_KEEPIDLE", KEEPALIVE_IDLE), ("TCP_KEEPALIVE", KEEPALIVE_IDLE),
+                                   ("TCP_KEEPINTVL", KEEPALIVE_INTERVAL), ("TCP_KEEPCNT", KEEPALIVE_COUNT)):
+            option = getattr(socket, option_name, None)
+            if option is not None:
+                try:
+                    sock.setsockopt(socket.IPPROTO_TCP, option, value)
+                except socket.error:
+                    pass
+        sock.setblocking(False)
+        self._socket = sock
+        self.connects = self.connects + 1
+
+    def _ensure_connected(self):
+        """Returns True if connected, reconnecting if the connection broke and the reconnect delay has passed."""
+        if self._socket is not None:
+            return True
+        if time.time() - self._last_connect_attempt < RECONNECT_DELAY:
+            return False
+        try:
+            self._connect()
+            return True
+        except socket.error as error:
+            self.last_error = error
+            return False
+
+    def write(self, data):
+        """Sends data. If the connection is down the data is dropped and 0 is returned, so that the transaction
+        fails like it would on a silent bus."""
+        if not self._ensure_connected():
+            return 0
+        data = bytes(data)
+        try:
+            # frames are small, so unless the connection is broken this returns after the first send:
+            sent = 0
+            while sent < len(data):
+                select.select([], [self._socket], [], self.timeout)
+                sent = sent + self._socket.send(data[sent:])
+            return sent
+        except socket.error:
+            self.close()
+            return 0
+
+    def read(self, size):
+        """Reads up to size bytes, like pyserial: returns when size bytes have been read, the timeout expired, or
+        no byte arrived for inter_byte_timeout seconds after the first one."""
+        if self._socket is None:
+            return b''
+        data = b''
+        deadline = None if self.timeout is None else time.time() + self.timeout
+        while len(data) < size:
+            if data and self.inter_byte_timeout is not None:
+                wait = self.inter_byte_timeout
+                if deadline is not None:
+                    wait = min(wait, max(0, deadline - time.time()))
+            elif deadline is not None:
+                wait = max(0, deadline - time.time())
+            else:
+                wait = None
+            readable = select.select([self._socket], [], [], wait)[0]
+            if not readable:
+                break
+            try:
+                chunk = self._socket.recv(size - len(data))
+            except socket.error:
+                self.close()
+                break
+            if not chunk:
+                # the server closed the connection:
+                self.close()
+                break
+            data = data + chunk
+        return data
+
+    def flushInput(self):
+        """Discards any bytes that have been received but not read."""
+        if self._socket is None:
+            return
+        try:
+            while select.select([self._socket], [], [], 0)[0]:
+                if not self._socket.recv(4096):
+                    self.close()
+                    return
+        except socket.error:
+            self.close()
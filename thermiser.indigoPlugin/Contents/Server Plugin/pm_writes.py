@@ -0,0 +1,70 @@
+# -*- coding: utf-8 -*-
+
+#  Write planner: turns a set of field changes for one thermostat into as few write frames as possible. A write
+#  frame covers a range of consecutive registers, so changes to adjacent registers (e.g. hot water at 42 and the
+#  clock at 43) go in one frame. Changes separated by a small gap also share a frame if every register in the gap
+#  is a known write register whose current value is known (e.g. from the DCB cache): the gap is filled with the
+#  current values, which costs a few bytes of wire time instead of a whole transaction. The values must have been
+#  read moments ago (GAP_FILL_MAX_AGE), as filling a gap overwrites whatever was set on the keypad since.
+#  Registers that are not in WRITE_REGISTERS are never written, so changes on either side of an undefined
+#  register (e.g. set temperature at 18 and hold time at 32) always take separate frames.
+
+import struct
+from pm_dcb import *
+
+# largest gap (bytes) filled with current values to merge two writes; a separate write costs about 17 bytes of
+# frame and acknowledgement plus the turnaround of the thermostat
+MAX_GAP_FILL = 16
+GAP_FILL_MAX_AGE = 5  # seconds since the DCB was read for its values to be used to fill gaps
+MAX_WRITE_PAYLOAD = 245  # the frame length is a single byte, and a frame has 10 bytes besides the payload
+# write registers in register order: (register, size, field name)
+REGISTERS = sorted((register, struct.calcsize('>' + field_format), name)
+                   for name, (register, field_format) in WRITE_REGISTERS.items())
+
+
+def _gap_fill(start, end, current_value, writable):
+    """Returns the payload for registers start..end-1 from their current values, or None if the gap can't be
+    filled: it is too large, contains a register that isn't defined or writable, or a value isn't known."""
+    if end - start > MAX_GAP_FILL:
+        return None
+    payload = bytearray()
+    position = start
+    for register, size, name in REGISTERS:
+        if register < start:
+            continue
+        if register >= end:
+            break
+        if register != position or register + size > end or name not in writable:
+            return None
+        value = current_value(name)
+        if value is None:
+            return None
+        payload = payload + encode_field(name, value)[1]
+        position = register + size
+    if position != end:
+        return None
+    return payload
+
+
+def plan_writes(changes, current_value=None, writable=()):
+    """Plans the write frames for changes, a dictionary of field name -> value. current_value(name) returns the
+    current value of a field, or None if it isn't known, and writable is the set of fields the model can write;
+    without them no gaps are filled.
+    Returns a list of (register, payload, names) tuples in register order, where names are the changed fields
+    the frame writes."""
+    segments = sorted(encode_field(name, value) + ([name],) for name, value in changes.items())
+    plan = []
+    for register, payload, names in segments:
+        if plan:
+            last_register, last_payload, last_names = plan[-1]
+            end = last_register + len(last_payload)
+            fill = None
+            if register == end:
+                fill = bytearray()
+            elif current_value is not None and register > end:
+                fill = _gap_fill(end, register, current_value, writable)
+            if fill is not None and len(last_payload) + len(fill) + len(payload) <= MAX_WRITE_PAYLOAD:
+                plan[-1] = (last_register, last_payload + fill + payload, last_names + names)
+                continue
+        plan.append((register, payload, names))
+    return plan
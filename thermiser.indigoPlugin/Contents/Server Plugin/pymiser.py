@@ -29,139 +29,68 @@
 # last modified 17 jun 2020
 
 import datetime
+import time
+from pm_cache import *
 from pm_crc import *
+from pm_dcb import *
+from pm_frame import *
+from pm_metrics import *
+from pm_writes import *
 
 FUNCTION_READ = 0
 FUNCTION_WRITE = 1
-MASTER_ADDRESS = 0x81  # address of 'master' unit, i.e. this computer.
-MAX_REPLY_SIZE = 200
-MODEL_NAMES = ['DT', 'DT-E', 'PRT', 'PRT-E', 'PRT-HW']
-SENSOR_NAMES = ['built-in air only', 'remote air only', 'floor only', 'built-in air + floor', 'remote-air + floor']
-FROST_PROTECTION_NAMES = ['disabled', 'enabled']
-RUN_MODE_NAMES = ['heating', 'frost protection']
-PROGRAM_MODE_NAMES = ['5/2 mode', '7 day mode']
-UNKNOWN_NAME = '(unknown)'
+REPLY_TIMEOUT = 0.5  # seconds to wait for the first byte of a reply
+INTER_BYTE_TIMEOUT = 0.1  # seconds of silence after which a reply is considered incomplete
+BAUD_RATE = 4800
+BITS_PER_BYTE = 10  # 8 data bits plus start and stop bit
+READ_ALL = 0xFFFF  # byte count that requests the whole DCB
+# most bytes read while waiting for a reply: room for a reply plus as much again in front of it (the echo of the
+# request on half-duplex adapters, the rest of an earlier reply or line noise). A device or line that keeps
+# sending bytes can't keep the bus busy for longer than this takes on the wire, plus the reply timeout.
+MAX_RECEIVE_SIZE = 2 * MAX_REPLY_SIZE
+# seconds to wait for a reply to a discovery probe: the probe request alone takes 21 ms at 4800 baud, and this
+# leaves a slow thermostat plenty of turnaround time while keeping a scan of empty addresses short
+PROBE_TIMEOUT = REPLY_TIMEOUT / 2
+PROBE_COUNT = 5  # DCB bytes read by a discovery probe: DCB length, vendor, version and model
+PARTIAL_READ_MAX_FAILURES = 3  # failed partial reads after which an address falls back to full reads for good
+SECONDS_PER_WEEK = 7 * 24 * 3600
+# results of write transactions; only the last two are true, so results can also be tested as booleans:
+WRITE_INVALID = None  # the write was not sent because its arguments are invalid
+WRITE_FAILED = 0  # no valid reply was received
+WRITE_OK = 1  # the device acknowledged the write
+WRITE_UNCONFIRMED = 2  # a valid frame was received, but it is not a proper acknowledgement from the device
 MIN_TEMP_C = 5
 MAX_TEMP_C = 35
 TEMP_UNIT_CELSIUS = 0
 TEMP_UNIT_FAHRENHEIT = 1
 TEMP_UNIT_SYMBOL_CELSIUS = u"℃"
 TEMP_UNIT_SYMBOL_FAHRENHEIT = u"℉"
+# operation under which writes to each field are counted in the transaction metrics:
+WRITE_OPERATIONS = {'setRoomTemp': OP_SET_TEMP, 'hotWaterOn': OP_SET_HW, 'clock': OP_CLOCK_SYNC}
+WRITE_OPERATIONS.update((name, OP_SCHEDULE) for name in SCHEDULE_REGISTERS)
 
 
 class PyMiser(object):
     def __init__(self, owner):
         self.crc = crc()  # CRC calculator object
         self.owner = owner  # Indigo plugin
-        self.deviceInfo = dict()
+        self.cache = DCBCache()  # last DCB record read from each address
+        self.metrics = TransactionMetrics()
+        self.last_outcome = OUTCOME_OK  # outcome of the last _read_frame call
+        self.decoder = FrameDecoder()  # receive buffer, kept for the counters of skipped bytes
+        # poll profile: layouts of devices that have been read in full, so that polls can read just the
+        # scalar fields at the start of the DCB and skip the schedule tables.
+        self.poll_layouts = dict()  # address -> DCBLayout
+        self.full_reply_sizes = dict()  # address -> size of the last full DCB reply
+        self.partial_read_failures = dict()  # address -> partial reads that failed since the last success
+        self.partial_read_unsupported = set()  # addresses that don't handle partial reads
+        self.dcb_bytes_read = 0
+        self.dcb_bytes_saved = 0
 
     def fahrenheit (self, celsius):
         """ Converts celsius to Fahrenheit"""
         return celsius * (9.0 / 5.0) + 32
 
-    def _parseDCB(self, dcb):
-        """Returns a dictionary with the contents of the dcb"""
-        result = {'frameLength': dcb[2] * 256 + dcb[1], 'address': dcb[3]}
-        dcb_offset = 9  # type: int
-        result['dcbLen'] = dcb[dcb_offset] * 256 + dcb[dcb_offset+1]
-        vendor_id = dcb[dcb_offset+2]
-        if vendor_id == 0:
-            result['vendor'] = 'Heatmiser'
-        else:
-            result['vendor'] = 'o.e.m.'
-
-        result['softwareVersion'] = dcb[dcb_offset + 3] & 0x7f
-        result['floorLimitState'] = dcb[dcb_offset + 3] >> 7
-
-        model_id = dcb[dcb_offset + 4]
-        result['modelID'] = model_id
-        if 0 <= model_id < len(MODEL_NAMES):
-            result['model'] = MODEL_NAMES[model_id]
-        else:
-            result['model'] = UNKNOWN_NAME
-
-        if dcb[dcb_offset + 5] == 0:
-            result['temperatureFormat'] = 'C'
-        else:
-            result['temperatureFormat'] = 'F'
-
-        result['switchDifferential'] = dcb[dcb_offset + 6]
-
-        frost_protection_code = dcb[dcb_offset + 7]
-        if 0 <= frost_protection_code < len(FROST_PROTECTION_NAMES):
-            result['frostProtection'] = FROST_PROTECTION_NAMES[frost_protection_code]
-        else:
-            result['frostProtection'] = UNKNOWN_NAME
-
-        result['calibrationOffset'] = dcb[dcb_offset +8] * 256 + dcb[dcb_offset+9]
-        result['outputDelay'] = dcb[dcb_offset+10]
-        # offset +11 is the address, which we already know, so we're ignoring it.
-        result['upDownKeyLimit'] = dcb[dcb_offset+12]
-
-        sensor_selection_code = dcb[dcb_offset+13]
-        result['sensorSelectionCode'] = sensor_selection_code
-        if 0 <= sensor_selection_code < len(SENSOR_NAMES):
-            result['sensor'] = SENSOR_NAMES[sensor_selection_code]
-        else:
-            result['sensor'] = UNKNOWN_NAME
-
-        result['optimumStart'] = dcb[dcb_offset+14]
-        result['rateOfChange'] = dcb[dcb_offset+15]
-
-        program_mode_code = dcb[dcb_offset+16]
-        result['programModeCode'] = program_mode_code
-        if 0 <= program_mode_code < len(PROGRAM_MODE_NAMES):
-            result['programMode'] = PROGRAM_MODE_NAMES[program_mode_code]
-
-        result['frostProtectTemp'] = dcb[dcb_offset+17]
-        result['setRoomTemp'] = dcb[dcb_offset+18]
-        result['floorMaxLimit'] = dcb[dcb_offset + 19]
-        result['floorMaxLimitEnable'] = dcb[dcb_offset + 19]
-        result['On'] = dcb[dcb_offset + 21]
-        result['keyLock'] = dcb[dcb_offset + 22]
-
-        run_mode_code = dcb[dcb_offset + 23]
-        if 0 <= run_mode_code < len(RUN_MODE_NAMES):
-            result['runMode'] = RUN_MODE_NAMES[run_mode_code]
-        else:
-            result['runMode'] = UNKNOWN_NAME
-
-        result['holidayHours'] = dcb[dcb_offset + 24] * 256 + dcb[dcb_offset+25]
-        result['tempHoldMinutes'] = dcb[dcb_offset + 26] * 256 + dcb[dcb_offset+27]
-
-        remote_air_temp = (dcb[dcb_offset + 28] * 256 + dcb[dcb_offset+29]) / 10
-        if remote_air_temp == 0xFFFF:
-            remote_air_temp = None
-        result['remoteAirTemp'] = remote_air_temp
-
-        floor_temp = (dcb[dcb_offset + 30] * 256 + dcb[dcb_offset + 31]) / 10
-        if floor_temp == 0xFFFF:
-            floor_temp = None
-        result['floorTemp'] = floor_temp
-
-        air_temp = (dcb[dcb_offset + 32] * 256 + dcb[dcb_offset + 33]) / 10
-        if air_temp == 0xFFFF:
-            air_temp = None
-        result['airTemp'] = air_temp
-        result['heatingOn'] = dcb[dcb_offset+35]
-
-        # This is where the DCB finishes for DT / DT-E model
-        if model_id == 0 or model_id == 1:
-            return result
-
-        # PRT-HW has an extra byte in the DCB for hot water, so after this everything shifts by one byte.
-        if model_id == 4:
-            result['hotWaterOn'] = dcb[dcb_offset+36]
-            # shift subsequent offsets:
-            dcb_offset = dcb_offset + 1
-
-        result['weekDayNumber'] = dcb[dcb_offset+36]
-        result['timeHour'] = dcb[dcb_offset+37]
-        result['timeMinute'] = dcb[dcb_offset+38]
-        result['timeSecond'] = dcb[dcb_offset+39]
-
-        return result
-
     def _form_frame(self, destination, start, end, payload):
         """Returns a valid frame including checksum based on start and end addresses and payload."""
         if payload is None:
@@ -187,26 +116,311 @@ class PyMiser(object):
                 offset = offset + 1
         return self.crc.addCCITTtoBytearray(frame)
 
-    def _request_dcb(self, destination):
-        """Requests a DCD from the device at address destination and returns the raw reply."""
-        frame = self._form_frame(destination, 0, 0xFFFF, None)
-        self.owner.comm_port.write(frame)
-        reply = bytearray(self.owner.comm_port.read(MAX_REPLY_SIZE))
-
-        if self.crc.verifyCCITTfromByteArray(reply):
+    def _read_frame(self, source=None):
+        """Reads a reply frame (from the device at address source, if given) from the comm port and returns it, or
+        None if no valid frame arrived. The decoder skips bytes around the frame (see pm_frame), and the length is
+        taken from the frame header, so we return as soon as the frame is complete instead of waiting for the
+        serial timeout to expire. Reading stops after MAX_RECEIVE_SIZE bytes, or the time they take on the wire plus
+        the timeout. Sets last_outcome to one of the OUTCOME_ results."""
+        comm_port = self.owner.comm_port
+        decoder = self.decoder
+        crc_rejects = decoder.crc_rejects
+        received = 0
+        start = time.time()
+        deadline = start + comm_port.timeout + MAX_RECEIVE_SIZE * BITS_PER_BYTE / float(BAUD_RATE)
+        overrun = False
+        # the comm port timeout limits each read call, and a full PRT-HW DCB takes longer than that to arrive at
+        # 4800 baud, so keep reading for as long as bytes keep coming in, within the limits:
+        while True:
+            chunk = comm_port.read(min(decoder.wanted, MAX_RECEIVE_SIZE - received))
+            if not chunk:
+                break
+            received = received + len(chunk)
+            decoder.feed(chunk)
+            reply = decoder.next_frame(source)
+            if reply is not None:
+                self.last_outcome = OUTCOME_OK
+                return reply
+            if received >= MAX_RECEIVE_SIZE or time.time() > deadline:
+                overrun = True
+                break
+
+        if overrun:
+            self.owner.debugLog(u"_read_frame: no valid frame in %d bytes received in %.1f s - giving up"
+                                % (received, time.time() - start))
+            self.last_outcome = OUTCOME_FRAME_ERROR
+        elif not received:
+            self.owner.detailDebugLog(u"_read_frame: no reply")
+            self.last_outcome = OUTCOME_TIMEOUT
+        elif decoder.crc_rejects > crc_rejects:
+            self.owner.detailDebugLog(u"_read_frame: reply with incorrect CRC")
+            self.last_outcome = OUTCOME_CRC_ERROR
+        else:
+            self.owner.detailDebugLog(u"_read_frame: no valid frame in %d bytes received" % received)
+            self.last_outcome = OUTCOME_FRAME_ERROR
+        return None
+
+    def _is_acknowledgement(self, reply, address):
+        """Returns True if reply is a proper acknowledgement of a write to the device at address."""
+        return len(reply) == MIN_REPLY_SIZE and reply[3] == address and reply[4] == FUNCTION_WRITE
+
+    def _transact(self, frame, timeout=None, operation=OP_POLL, write=False):
+        """Sends a frame and returns the validated reply, or None if no valid reply was received.
+        timeout overrides the reply timeout of the comm port for this transaction. The round trip is recorded
+        in the metrics under the destination address and operation; for a write frame, a reply that is not a
+        proper acknowledgement is left out of the average latency."""
+        comm_port = self.owner.comm_port
+        start = time.time()
+        # whatever is left from an earlier reply can't be the reply to this request; after a failed transaction
+        # the rest of its reply may still be on its way, or waiting in the input buffer of the port:
+        self.decoder.clear()
+        if self.last_outcome != OUTCOME_OK:
+            comm_port.flushInput()
+        if timeout is None:
+            comm_port.write(frame)
+            reply = self._read_frame(frame[0])
+        else:
+            saved_timeout = comm_port.timeout
+            comm_port.timeout = timeout
+            try:
+                comm_port.write(frame)
+                reply = self._read_frame(frame[0])
+            finally:
+                comm_port.timeout = saved_timeout
+        answered = reply is not None and (not write or self._is_acknowledgement(reply, frame[0]))
+        self.metrics.record(frame[0], operation, time.time() - start, self.last_outcome, answered)
+        return reply
+
+    def _request_dcb(self, destination, start=0, count=READ_ALL, timeout=None, operation=OP_POLL):
+        """Requests a DCD (or count bytes of it from offset start) from the device at address destination
+        and returns the raw reply."""
+        frame = self._form_frame(destination, start, count, None)
+        reply = self._transact(frame, timeout, operation)
+        if reply is None or count == READ_ALL:
             return reply
+
+        # a partial reply echoes the start offset, and must at least contain the requested bytes:
+        if reply[5] + reply[6] * 256 != start or len(reply) < DCB_OFFSET + count + 2:
+            self.owner.detailDebugLog(u"_request_dcb: unexpected reply to partial read from address %d" % destination)
+            self.metrics.count(destination, operation, COUNTER_UNEXPECTED)
+            return None
+        return reply
+
+    def probe(self, address, timeout=PROBE_TIMEOUT):
+        """Checks whether a device answers at address with a minimal read and a short timeout, so that scanning
+        empty addresses is quick. Returns the model ID of the device, or None if there was no valid reply;
+        last_outcome then tells whether nothing answered (OUTCOME_TIMEOUT) or the reply was invalid."""
+        reply = self._request_dcb(address, 0, PROBE_COUNT, timeout, OP_PROBE)
+        if reply is None:
+            return None
+        return reply[DCB_OFFSET + 4]
+
+    def read_device_info(self, address, max_age=0, fields=None, full_read=False):
+        """Returns the DCB record of the device at the specified address, or None if it could not be read.
+        A cached record younger than max_age seconds (None: the cache ttl) in which none of the given fields
+        are stale is returned without a bus transaction.
+        Once a device has been read in full, subsequent reads only fetch the scalar fields (the poll profile)
+        unless full_read is set."""
+        if max_age != 0 and not full_read:
+            record = self.cache.get(address, max_age, fields)
+            if record is not None:
+                return record
+
+        layout = None
+        if not full_read and address not in self.partial_read_unsupported:
+            layout = self.poll_layouts.get(address)
+
+        if layout is None:
+            reply = self._request_dcb(address)
         else:
+            reply = self._request_dcb(address, 0, layout.size)
+        if reply is None:
+            if layout is not None:
+                self._partial_read_failed(address)
             return None
 
-    def update_device_info(self, address):
-        """Requests dcd from device at specified address and populates the deviceInfo dictionary"""
-        reply = self._request_dcb(address)
-        if reply is not None:
-            self.deviceInfo = self._parseDCB(reply)
-            if self.deviceInfo:
-                return True
+        record = decode_dcb(reply)
+        if record is None:
+            return None
 
-        return False
+        self.dcb_bytes_read = self.dcb_bytes_read + len(reply)
+        if layout is None:
+            self.poll_layouts[address] = record.layout
+            self.full_reply_sizes[address] = len(reply)
+        else:
+            self.partial_read_failures.pop(address, None)
+            self.dcb_bytes_saved = self.dcb_bytes_saved + max(0, self.full_reply_sizes[address] - len(reply))
+
+        self.cache.put(address, record)
+        return record
+
+    def _partial_read_failed(self, address):
+        """Makes the next read of address a full read, and stops using partial reads for it after
+        PARTIAL_READ_MAX_FAILURES failures in a row."""
+        self.poll_layouts.pop(address, None)
+        failures = self.partial_read_failures.get(address, 0) + 1
+        self.partial_read_failures[address] = failures
+        if failures >= PARTIAL_READ_MAX_FAILURES:
+            self.partial_read_unsupported.add(address)
+            self.owner.debugLog(u"Partial DCB reads failed %d times for address %d - using full reads from now on"
+                                % (failures, address))
+
+    def wire_savings_report(self):
+        """Returns a string describing how many DCB bytes partial reads kept off the wire."""
+        total = self.dcb_bytes_read + self.dcb_bytes_saved
+        if total == 0:
+            return u"no DCB reads"
+        return u"%d DCB bytes read, %d bytes (%d%%, %.1f s of wire time) saved by partial reads" \
+               % (self.dcb_bytes_read, self.dcb_bytes_saved, 100 * self.dcb_bytes_saved / total,
+                  self.dcb_bytes_saved * BITS_PER_BYTE / float(BAUD_RATE))
+
+    def _write_field(self, address, name, value):
+        """Writes value to the register for field name of the device at address and returns one of the
+        WRITE_ results."""
+        return self.write_fields(address, {name: value})[name]
+
+    def write_fields(self, address, changes):
+        """Writes changes (a dictionary of field name -> value) to the device at address in as few write frames
+        as possible (see pm_writes), filling small gaps between registers from the DCB cache if it was read less
+        than GAP_FILL_MAX_AGE seconds ago and has no stale fields. Returns a dictionary of field name -> WRITE_
+        result; the fields in one frame share the result of its acknowledgement.
+        Acknowledged writes are patched into the DCB cache, unconfirmed ones make the cached fields stale."""
+        record, read_time, stale = self.cache.current(address, GAP_FILL_MAX_AGE)
+        if record is None or stale:
+            plan = plan_writes(changes)
+        else:
+            def current_value(name):
+                if name in CLOCK_FIELD_NAMES or name == 'clock':
+                    return None
+                if name in SCHEDULE_REGISTERS:
+                    return record.schedule_register(name)
+                return getattr(record, name, None)
+            plan = plan_writes(changes, current_value, record.layout.writable)
+
+        results = dict()
+        for register, payload, names in plan:
+            frame = self._form_frame(address, register, len(payload), payload)
+            operation = WRITE_OPERATIONS.get(names[0], OP_POLL)
+            if len(names) > 1:
+                self.owner.detailDebugLog(u"write_fields: writing %s to address %d in one frame"
+                                          % (u", ".join(names), address))
+            reply = self._transact(frame, None, operation, write=True)
+            if reply is None:
+                result = WRITE_FAILED
+            elif not self._is_acknowledgement(reply, address):
+                self.owner.debugLog(u"write_fields: unexpected acknowledgement of %s write from address %d"
+                                    % (u", ".join(names), address))
+                self.metrics.count(address, operation, COUNTER_UNEXPECTED)
+                result = WRITE_UNCONFIRMED
+            else:
+                result = WRITE_OK
+            self._update_cache(address, dict((name, changes[name]) for name in names), result)
+            for name in names:
+                results[name] = result
+        return results
+
+    def _update_cache(self, address, written, result):
+        """Patches acknowledged field values into the cached DCB, and marks the fields of an unconfirmed write as
+        stale. Clock writes can't be patched in, so they make the clock fields stale; acknowledged schedule writes
+        are patched into the raw DCB if it holds their tables, otherwise the tables become stale."""
+        if result == WRITE_FAILED:
+            return
+        patch = dict()
+        stale = []
+        schedules = dict()
+        for name, value in written.items():
+            if name == 'clock':
+                stale.extend(CLOCK_FIELD_NAMES)
+            elif name in SCHEDULE_REGISTERS:
+                schedules[name] = value
+            elif result == WRITE_OK:
+                patch[name] = value
+            else:
+                stale.append(name)
+        if schedules:
+            raw = self._patched_schedules(address, schedules) if result == WRITE_OK else None
+            if raw is None:
+                stale.extend(SCHEDULE_REGISTERS[name][0] for name in schedules)
+            else:
+                patch['raw'] = raw
+        if patch:
+            self.cache.patch(address, **patch)
+        if stale:
+            self.cache.invalidate(address, stale)
+
+    def _patched_schedules(self, address, written):
+        """Returns the raw reply of the cached DCB of address with the schedule registers in written (name ->
+        value) patched in, or None if the cached DCB doesn't hold all of their tables or one of them is stale."""
+        record, read_time, stale = self.cache.current(address)
+        if record is None:
+            return None
+        raw = bytearray(record.raw)
+        for name, value in written.items():
+            table, start = SCHEDULE_REGISTERS[name]
+            if table in stale or record._table(table) is None:
+                return None
+            position = DCB_OFFSET + record.layout.schedules[table][0] + start
+            payload = encode_field(name, value)[1]
+            raw[position:position + len(payload)] = payload
+        return raw
+
+    def read_schedules(self, address, max_age=None):
+        """Returns the DCB record of the device at address with all of its schedule tables (see the schedule
+        properties of the record), or None if it could not be read. The cached record is used if it is a full DCB
+        younger than max_age seconds (None: the cache ttl) and none of its tables are stale; otherwise the DCB is
+        read in full."""
+        record, read_time, stale = self.cache.current(address, max_age)
+        if record is not None and len(record.raw) >= DCB_OFFSET + record.dcbLen and \
+                not stale.intersection(SCHEDULE_NAMES):
+            return record
+        return self.read_device_info(address, full_read=True)
+
+    def write_schedules(self, address, schedules, max_age=None):
+        """Programs schedules, a dictionary of schedule write register name (e.g. weekdaySchedule or
+        sevenDayHotWater2, see pm_dcb) -> list of periods, into the device at address. Heating temperatures are
+        in degrees Celsius, and converted for devices that use Fahrenheit.
+        The schedules are compared with the device's DCB (see read_schedules), and only the registers that differ
+        are written, in as few frames as possible. Returns a tuple of a dictionary of written register name ->
+        WRITE_ result, which is empty if nothing changed, and a list of the registers that the model or its
+        program mode does not have, which are left out. Returns (None, None) if the DCB could not be read."""
+        record = self.read_schedules(address, max_age)
+        if record is None:
+            return None, None
+        changes = dict()
+        missing = []
+        for name, periods in schedules.items():
+            current = record.schedule_register(name) if name in record.layout.writable else None
+            if current is None:
+                missing.append(name)
+                continue
+            if record.temperatureFormat == 'F' and 'Schedule' in name:
+                periods = [(hour, minute, int(round(self.fahrenheit(temp)))) for hour, minute, temp in periods]
+            payload = encode_field(name, [value for period in periods for value in period])[1]
+            if payload != current:
+                changes[name] = payload
+        if not changes:
+            return dict(), missing
+        self.owner.detailDebugLog(u"write_schedules: %d of %d schedule registers of address %d changed"
+                                  % (len(changes), len(schedules) - len(missing), address))
+        return self.write_fields(address, changes), missing
+
+    def clock_drift(self, address):
+        """Returns the number of seconds the clock of the device at address is ahead of local time (negative if
+        it is behind), from the last DCB read from it, or None if there is no cached DCB, the clock was written
+        since it was read, or the model has no clock.
+        The thermostats count whole seconds, so the result is accurate to within a second."""
+        record, read_time, stale = self.cache.current(address, SECONDS_PER_WEEK)
+        if record is None or record.weekDayNumber is None or stale.intersection(CLOCK_FIELD_NAMES):
+            return None
+        # the clock was sampled when the device sent its reply, i.e. before the reply was transferred:
+        sampled = datetime.datetime.fromtimestamp(read_time - len(record.raw) * BITS_PER_BYTE / float(BAUD_RATE))
+        local_seconds = ((sampled.isoweekday() - 1) * 24 + sampled.hour) * 3600 + sampled.minute * 60 + \
+            sampled.second + sampled.microsecond / 1e6
+        # the device reports whole seconds, so on average its clock is half a second past what it reports:
+        device_seconds = ((record.weekDayNumber - 1) * 24 + record.timeHour) * 3600 + record.timeMinute * 60 + \
+            record.timeSecond + 0.5
+        # the difference within the week, between -3.5 and +3.5 days:
+        return (device_seconds - local_seconds + SECONDS_PER_WEEK / 2) % SECONDS_PER_WEEK - SECONDS_PER_WEEK / 2
 
     def syncClock(self, address, currentRoomSetTemp, temperature_unit):
         """Updates device clock to current local time"""
@@ -225,87 +439,98 @@ class PyMiser(object):
 
         return True
 
+    def _clock_value(self, address):
+        """Returns the (weekday, hour, minute, second) to write to the clock of the device at address."""
+        # the device sets its clock once it has received the write, so send the time it will be by then: the
+        # measured round trip of earlier acknowledged clock writes minus the acknowledgement, or else the time it takes to send
+        # the write. Rounded to the nearest second, as the clock only counts whole seconds.
+        request_size = 10 + 4
+        round_trip = self.metrics.average_latency(address, OP_CLOCK_SYNC)
+        if round_trip is None:
+            delay = request_size * BITS_PER_BYTE / float(BAUD_RATE)
+        else:
+            delay = max(0.0, round_trip - MIN_REPLY_SIZE * BITS_PER_BYTE / float(BAUD_RATE))
+        dt = datetime.datetime.now() + datetime.timedelta(seconds=delay + 0.5)
+        return dt.isoweekday(), dt.hour, dt.minute, dt.second
+
     def _syncClock(self, address):
-        dt = datetime.datetime.now()
-        weekday = dt.isoweekday()
-        second = dt.second + 2  # the +2 is to compensate for the time it takes to set the clock
-        if second > 59:
-            second = second - 59
-        payload = [weekday, dt.hour, dt.minute, second]
-        frame = self._form_frame(address, 43, len(payload), payload)
-        self.owner.comm_port.write(frame)
-        reply = bytearray(self.owner.comm_port.read(MAX_REPLY_SIZE)) # read up to 200 bytes
+        result = self._write_field(address, 'clock', self._clock_value(address))
 
-        if reply is None:
-            self.owner.errorLog(u"syncClock: no reply from address %d" % address)
+        if result == WRITE_FAILED:
+            self.owner.errorLog(u"syncClock: no valid reply from address %d" % address)
             return False
 
-        if len(reply) != 7:
+        if result == WRITE_UNCONFIRMED:
             self.owner.errorLog(u"syncClock: received reply with incorrect length of reply from address %d" % address)
             return False
 
-        if not self.crc.verifyCCITTfromByteArray(reply):
-            self.owner.errorLog(u"syncClock: received reply with incorrect CRC from address %d" % address)
-            if self.owner.detailed_debug:
-                self.owner.debugLog(u"syncClock: received OK reply from address %d" % address)
-            return False
+        if self.owner.detailed_debug:
+            self.owner.debugLog(u"syncClock: received OK reply from address %d" % address)
         return True
 
+    def set_temp_range(self, temperature_unit):
+        """ returns the lowest and highest temperature that set_temp accepts in the given unit"""
+        if temperature_unit == TEMP_UNIT_FAHRENHEIT:
+            return self.fahrenheit(MIN_TEMP_C), self.fahrenheit(MAX_TEMP_C)
+        return MIN_TEMP_C, MAX_TEMP_C
+
     def set_temp(self, address, temp, temperature_unit):
-        """ sets the desired temperature for device with given address"""
+        """ sets the desired temperature for device with given address and returns one of the WRITE_ results"""
         if address is None:
             self.owner.errorLog(u"setTemp: no address specified.")
-            return False
+            return WRITE_INVALID
 
         if temp is None:
             self.owner.errorLog(u"setTemp: no temperature specified.")
-            return False
+            return WRITE_INVALID
 
+        minimum_set_temperature, maximum_set_temperature = self.set_temp_range(temperature_unit)
         if temperature_unit == TEMP_UNIT_FAHRENHEIT:
-            minimum_set_temperature = self.fahrenheit(MIN_TEMP_C)
-            maximum_set_temperature = self.fahrenheit(MAX_TEMP_C)
             temperature_unit_symbol = TEMP_UNIT_SYMBOL_FAHRENHEIT
         else:
-            minimum_set_temperature = MIN_TEMP_C
-            maximum_set_temperature = MAX_TEMP_C
             temperature_unit_symbol = TEMP_UNIT_SYMBOL_CELSIUS
 
         if temp < minimum_set_temperature:
             self.owner.errorLog(u"setTemp: specified temp (%d) is below minimum (%d deg %s)"
                                 % (temp, minimum_set_temperature, temperature_unit_symbol))
-            return False
+            return WRITE_INVALID
 
         if temp > maximum_set_temperature:
             self.owner.errorLog(u"setTemp: specified temp (%d) is above maximum (%d deg %s)"
                                 % (temp, maximum_set_temperature, temperature_unit_symbol))
-            return False
+            return WRITE_INVALID
 
-        payload = [temp]
-        frame = self._form_frame(address, 18, len(payload), payload)
-
-        self.owner.comm_port.write(frame)
-        reply = bytearray(self.owner.comm_port.read(MAX_REPLY_SIZE)) # read up to 200 bytes
-
-        if self.crc.verifyCCITTfromByteArray(reply):
+        result = self._write_field(address, 'setRoomTemp', temp)
+        if result:
             if self.owner.detailed_debug:
                 self.owner.debugLog(u"setTemp: received OK reply from address %d" % address)
-            return True
         else:
-            self.owner.errorLog(u"setTemp: received reply with incorrect CRC from address %d" % address)
-            return False
-
+            self.owner.errorLog(u"setTemp: no valid reply from address %d" % address)
+        return result
 
-    def set_hw_on_state(self, address, state):
+    def set_hw_on_state(self, address, state, sync_clock=False):
+        """ overrides hot water (state 1) or returns it to the programmed schedule (state 0) and returns one of
+        the WRITE_ results. With sync_clock the clock, which is the next register, is set in the same write
+        frame, and the set temperature is re-sent afterwards as in syncClock."""
         if address is None:
             self.owner.errorLog(u"set_hw_on_state: no address specified.")
-            return False
-        payload = [state]
-        frame = self._form_frame(address, 42, len(payload), payload)
-        self.owner.comm_port.write(frame)
-        reply = bytearray(self.owner.comm_port.read(MAX_REPLY_SIZE))
-        if self.crc.verifyCCITTfromByteArray(reply):
-            self.owner.detailDebugLog(u"setTemp: received OK reply from address %d" % address)
-            return True
-        else:
-            return False
+            return WRITE_INVALID
+        changes = {'hotWaterOn': state}
+        record = None
+        if sync_clock:
+            record = self.cache.get(address, None, ('setRoomTemp',))
+            if record is not None:
+                changes['clock'] = self._clock_value(address)
+        result = self.write_fields(address, changes)['hotWaterOn']
+        if result:
+            self.owner.detailDebugLog(u"set_hw_on_state: received OK reply from address %d" % address)
+        if result == WRITE_OK and record is not None:
+            if record.temperatureFormat == 'F':
+                temperature_unit = TEMP_UNIT_FAHRENHEIT
+            else:
+                temperature_unit = TEMP_UNIT_CELSIUS
+            if not self.set_temp(address, record.setRoomTemp, temperature_unit):
+                self.owner.errorLog(u"set_hw_on_state: re-setting temperature post clock-sync did not work for "
+                                    u"address %d" % address)
+        return result
 